@@ -53,7 +53,8 @@ try:
         price INT,
         color VARCHAR(200),
         img_paths TEXT[],
-        embedding vector(384)
+        embedding vector(384),
+        text_hash TEXT
     );
     """
 
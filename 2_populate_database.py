@@ -1,78 +1,151 @@
+import argparse
 import json
-import psycopg2
-import numpy as np
-from pgvector.psycopg2 import register_vector
-from sentence_transformers import SentenceTransformer
-
-# --- Database Connection Details (same as before) ---
-
-DB_NAME = "fashion_db"
-DB_USER = "postgres"
-DB_PASSWORD = "postgres"
-DB_HOST = "localhost"
-DB_PORT = "5432"
-
-# === WHAT IS BEING DONE HERE (THE CHANGE) ===
-# Instead of a hardcoded list, we now load the data from the external JSON file.
-# This is much more scalable and manageable.
-try:
-    print("Loading product data from products.json...")
-    with open('products.json', 'r', encoding='utf-8') as f:
-        raw_data = json.load(f)
-    print(f"Successfully loaded {len(raw_data)} products from file.")
-except FileNotFoundError:
-    print("Error: 'products.json' not found. Please make sure the file is in the same directory as the script.")
-    exit() # Stop the script if the data file doesn't exist.
-except json.JSONDecodeError:
-    print("Error: Could not parse 'products.json'. Please check if it is a valid JSON format.")
-    exit() # Stop the script if the JSON is malformed.
+import os
+from db_utils import connect
+from model_registry import TEXT_MODEL_NAME, embedding_namespace, models
+from ingestion import (
+    PRODUCT_COLUMNS,
+    PipelineProgress,
+    batched,
+    copy_rows_binary,
+    get_searchable_text,
+    iter_json_array,
+    product_row,
+    text_hash,
+)
+
+# === WHAT IS BEING DONE HERE ===
+# The catalog is streamed through three stages so memory stays flat no matter
+# how many products there are:
+#   1. parse   - products.json is read incrementally, one product at a time.
+#   2. encode  - products are embedded in fixed-size batches.
+#   3. copy    - each batch is written with a binary COPY into a temporary
+#                staging table.
+# Once everything is staged, a single set-based INSERT ... ON CONFLICT moves
+# it into 'products'.
+#
+# Each product stores a hash of its searchable text + model name and backend
+# (e.g. "all-MiniLM-L6-v2:onnx-int8"), so switching backends re-embeds
+# everything instead of mixing float32 and int8 vectors. Products whose
+# hash is unchanged are staged without an embedding and keep their old one, so
+# a re-run only encodes what actually changed. Products missing from the file
+# are deleted (unless --keep-missing is given).
+
+PRODUCTS_JSON = os.environ.get("PRODUCTS_JSON", "products.json")
+BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "256"))
 
+STAGING_COLUMNS = PRODUCT_COLUMNS + ["embedding", "text_hash"]
+# What the stored hashes are keyed on: the model under the configured backend.
+EMBEDDING_KEY = embedding_namespace(TEXT_MODEL_NAME)
+STAGING_TYPES = [
+    "text", "text", "text", "text", "text", "text", "text", "text",
+    "text", "text", "text", "text", "text", "int4", "text", "text[]", "vector", "text",
+]
+_ATTRIBUTE_COLUMNS = [c for c in PRODUCT_COLUMNS if c != "id"]
 
-def get_searchable_text(item):
-    """Combines key product attributes into a single string for embedding."""
-    return f"A {item['color']} {item['gender']} {item['category']} for {item['occasion']}. Style: {item['style']} with a {item['neckline']} neckline. Details: {item['summary']}"
+# Later rows win when the same id appears twice, like the old row-by-row upsert.
+# Rows whose embedding wasn't recomputed and whose attributes are unchanged are
+# left untouched.
+UPSERT_SQL = f"""
+    INSERT INTO products ({', '.join(STAGING_COLUMNS)})
+    SELECT DISTINCT ON (id) {', '.join(STAGING_COLUMNS)}
+    FROM products_staging
+    ORDER BY id, seq DESC
+    ON CONFLICT (id) DO UPDATE SET
+        {', '.join(f'{c}=EXCLUDED.{c}' for c in _ATTRIBUTE_COLUMNS)},
+        embedding = COALESCE(EXCLUDED.embedding, products.embedding),
+        text_hash = EXCLUDED.text_hash
+    WHERE EXCLUDED.embedding IS NOT NULL
+       OR ({', '.join(f'products.{c}' for c in _ATTRIBUTE_COLUMNS)})
+          IS DISTINCT FROM ({', '.join(f'EXCLUDED.{c}' for c in _ATTRIBUTE_COLUMNS)});
+"""
+
+DELETE_MISSING_SQL = """
+    DELETE FROM products p
+    WHERE NOT EXISTS (SELECT 1 FROM products_staging s WHERE s.id = p.id);
+"""
+
+parser = argparse.ArgumentParser(description="Load products.json into the products table.")
+parser.add_argument("--full", action="store_true",
+                    help="Re-encode every product, ignoring the stored text hashes.")
+parser.add_argument("--keep-missing", action="store_true",
+                    help="Don't delete products that are no longer in the source file.")
+args = parser.parse_args()
+
+if not os.path.exists(PRODUCTS_JSON):
+    print(f"Error: '{PRODUCTS_JSON}' not found. Please make sure the file is in the same directory as the script.")
+    exit() # Stop the script if the data file doesn't exist.
 
-# Load the sentence transformer model
-print("Loading sentence transformer model...")
-model = SentenceTransformer('all-MiniLM-L6-v2')
-print("Model loaded.")
+# Load the sentence transformer model (PyTorch or ONNX, see EMBEDDING_BACKEND)
+model = models.get("text")
 
-# Generate embeddings
-print("Generating embeddings for all products...")
-searchable_texts = [get_searchable_text(item) for item in raw_data]
-embeddings = model.encode(searchable_texts)
-print(f"Generated {len(embeddings)} embeddings.")
+progress = PipelineProgress(["parse", "encode", "copy", "upsert"])
+unchanged_count = 0
 
-# Connect to the database and insert data (this part is unchanged)
 try:
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT)
+    conn = connect()
     cur = conn.cursor()
-    register_vector(conn)
     print("\nSuccessfully connected to the database.")
 
-    print("Inserting data into the 'products' table...")
-    for item, embedding in zip(raw_data, embeddings):
-        
-        cur.execute(
-            """
-            INSERT INTO products (
-                id, category, gender, description, summary, neckline, sleeve, length, style, 
-                fabric, occasion, season, special_design, price, color, img_paths, embedding
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (id) DO UPDATE SET
-                category=EXCLUDED.category, summary=EXCLUDED.summary, price=EXCLUDED.price, embedding=EXCLUDED.embedding;
-            """,
-            (
-                item['id'], item['category'], item['gender'], item['description'], item['summary'],
-                item['neckline'], item['sleeve'], item['length'], item['style'], item['fabric'],
-                item['occasion'], item['season'], item['special_design'], item['price'],
-                item['color'].strip(), item['img_paths'], np.array(embedding)
-            )
-        )
-    
+    known_hashes = {}
+    if not args.full:
+        cur.execute("SELECT id, text_hash FROM products WHERE embedding IS NOT NULL AND text_hash IS NOT NULL")
+        known_hashes = dict(cur.fetchall())
+        print(f"Found {len(known_hashes)} products with up-to-date hash information.")
+
+    cur.execute(
+        """
+        CREATE TEMP TABLE products_staging (LIKE products INCLUDING DEFAULTS) ON COMMIT DROP;
+        ALTER TABLE products_staging ADD COLUMN seq BIGSERIAL;
+        """
+    )
+
+    print(f"Streaming products from {PRODUCTS_JSON} in batches of {BATCH_SIZE}...")
+    batches = batched(iter_json_array(PRODUCTS_JSON), BATCH_SIZE)
+    while True:
+        with progress.stage("parse", 0):
+            batch = next(batches, None)
+        if not batch:
+            break
+        progress.rows["parse"] += len(batch)
+
+        hashes = [text_hash(item, EMBEDDING_KEY) for item in batch]
+        changed = [i for i, (item, h) in enumerate(zip(batch, hashes))
+                   if known_hashes.get(item['id']) != h]
+        unchanged_count += len(batch) - len(changed)
+
+        embeddings = [None] * len(batch)
+        if changed:
+            with progress.stage("encode", len(changed)):
+                encoded = model.encode(
+                    [get_searchable_text(batch[i]) for i in changed], batch_size=BATCH_SIZE
+                )
+            for i, embedding in zip(changed, encoded):
+                embeddings[i] = embedding
+
+        with progress.stage("copy", len(batch)):
+            rows = [product_row(item) + [embedding, h]
+                    for item, embedding, h in zip(batch, embeddings, hashes)]
+            copy_rows_binary(cur, "products_staging", STAGING_COLUMNS, STAGING_TYPES, rows)
+
+    print("Upserting staged rows into the 'products' table...")
+    with progress.stage("upsert", 0):
+        cur.execute(UPSERT_SQL)
+    upserted = cur.rowcount
+    progress.rows["upsert"] = upserted
+
+    deleted = 0
+    if not args.keep_missing:
+        cur.execute(DELETE_MISSING_SQL)
+        deleted = cur.rowcount
+    progress.report(final=True)
+
     conn.commit()
-    print(f"Successfully inserted/updated {len(raw_data)} products.")
+    print(f"Successfully inserted/updated {upserted} products "
+          f"({progress.rows['encode']} re-encoded, {unchanged_count} unchanged, {deleted} deleted).")
 
+except json.JSONDecodeError as e:
+    print(f"Error: Could not parse '{PRODUCTS_JSON}'. Please check if it is a valid JSON format. ({e})")
 except Exception as e:
     print(f"An error occurred: {e}")
 
@@ -81,4 +154,4 @@ finally:
         cur.close()
     if 'conn' in locals() and conn:
         conn.close()
-    print("Database connection closed.")
\ No newline at end of file
+    print("Database connection closed.")
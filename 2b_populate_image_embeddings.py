@@ -1,77 +1,160 @@
-import json
-import psycopg2
-import numpy as np
-from pgvector.psycopg2 import register_vector
-from sentence_transformers import SentenceTransformer
-from PIL import Image
+import argparse
+import io
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from psycopg2.extras import execute_values
+from db_utils import connect
+from model_registry import IMAGE_MODEL_NAME, embedding_namespace, models
+from ingestion import (
+    PipelineProgress,
+    batched,
+    image_hash,
+    image_path_for,
+    iter_json_array,
+    load_image,
+)
 
-# --- Database Connection Details ---
-DB_NAME = "fashion_db"
-DB_USER = "postgres"
-DB_PASSWORD = "postgres"
-DB_HOST = "localhost"
-DB_PORT = "5432"
-
-# === Load the CLIP model ===
-print("Loading CLIP model...")
-model = SentenceTransformer('clip-ViT-B-32')
-print("Model loaded.")
-
-# === Load the product data from products.json ===
-print("Loading product data from products.json...")
-with open('products.json', 'r', encoding='utf-8') as f:
-    products_data = json.load(f)
-
-try:
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
-    cur = conn.cursor()
-    register_vector(conn)
-    print("\nSuccessfully connected to the database.")
-
-    print("Generating and updating image embeddings...")
+# === WHAT IS BEING DONE HERE ===
+# Image embeddings are generated in a three-stage pipeline:
+#   1. decode  - worker threads (or processes) open and downscale the images,
+#                one batch ahead of the encoder.
+#   2. encode  - CLIP embeds a whole batch in one forward pass.
+#   3. write   - the batch is written with one UPDATE ... FROM (VALUES ...)
+#                and committed, so an interrupted run loses at most one batch.
+# Each product stores a hash of its image bytes + model name and backend
+# (e.g. "clip-ViT-B-32:onnx-int8"), so switching backends re-embeds
+# everything instead of mixing float32 and int8 vectors. Products whose
+# embedding is already stored under the same hash are skipped, so re-running
+# the script resumes where the previous run stopped and a catalog sync only
+# re-embeds images that actually changed.
+
+PRODUCTS_JSON = os.environ.get("PRODUCTS_JSON", "products.json")
+BATCH_SIZE = int(os.environ.get("IMAGE_BATCH_SIZE", "64"))
+DECODE_WORKERS = int(os.environ.get("DECODE_WORKERS", str(os.cpu_count() or 1)))
+# What the stored hashes are keyed on: the model under the configured backend.
+EMBEDDING_KEY = embedding_namespace(IMAGE_MODEL_NAME)
+
+UPDATE_SQL = """
+    UPDATE products AS p SET image_embedding = v.embedding, image_hash = v.image_hash
+    FROM (VALUES %s) AS v(id, embedding, image_hash)
+    WHERE p.id = v.id
+"""
+
+# Returned by the workers for images whose hash matches the stored one.
+UNCHANGED = "unchanged"
+
+
+def _decode(item, known_hash):
+    """
+    Runs in a worker. Returns (product_id, image, hash, None) for images that
+    need embedding, or (product_id, None, None, reason) otherwise.
+    """
+    image_path = image_path_for(item)
+    if not os.path.exists(image_path):
+        return item['id'], None, None, f"Image not found: {image_path}"
+    try:
+        with open(image_path, "rb") as f:
+            data = f.read()
+        digest = image_hash(data, EMBEDDING_KEY)
+        if digest == known_hash:
+            return item['id'], None, None, UNCHANGED
+        return item['id'], load_image(io.BytesIO(data)), digest, None
+    except Exception as e:
+        return item['id'], None, None, f"Could not read {image_path}: {e}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate CLIP image embeddings for all products.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=DECODE_WORKERS,
+                        help="Number of image decode workers.")
+    parser.add_argument("--processes", action="store_true",
+                        help="Decode in worker processes instead of threads.")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-embed every product, ignoring the stored image hashes.")
+    args = parser.parse_args()
+
+    # === Load the CLIP model (PyTorch or ONNX, see EMBEDDING_BACKEND) ===
+    model = models.get("image")
+
+    executor_cls = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    progress = PipelineProgress(["decode", "encode", "write"])
     success_count = 0
     skipped_count = 0
+    unchanged_count = 0
+
+    try:
+        conn = connect()
+        cur = conn.cursor()
+        print("\nSuccessfully connected to the database.")
+
+        known_hashes = {}
+        if not args.force:
+            cur.execute(
+                "SELECT id, image_hash FROM products "
+                "WHERE image_embedding IS NOT NULL AND image_hash IS NOT NULL"
+            )
+            known_hashes = dict(cur.fetchall())
+            conn.commit()
+            if known_hashes:
+                print(f"Resuming: {len(known_hashes)} products already have image embeddings.")
+
+        print("Generating and updating image embeddings...")
+        with executor_cls(max_workers=args.workers) as executor:
+            batches = batched(iter_json_array(PRODUCTS_JSON), args.batch_size)
+
+            def submit(batch):
+                if not batch:
+                    return None
+                return [executor.submit(_decode, item, known_hashes.get(item['id'])) for item in batch]
+
+            # Keep one batch decoding in the background while the current one is encoded.
+            in_flight = submit(next(batches, None))
+            while in_flight:
+                with progress.stage("decode", len(in_flight)):
+                    decoded = [future.result() for future in in_flight]
+                in_flight = submit(next(batches, None))
+
+                ready = []
+                for product_id, image, digest, problem in decoded:
+                    if problem == UNCHANGED:
+                        unchanged_count += 1
+                    elif image is None:
+                        print(f"[Warning] {problem} (product {product_id}). Skipping.")
+                        skipped_count += 1
+                    else:
+                        ready.append((product_id, image, digest))
+                if not ready:
+                    continue
+
+                with progress.stage("encode", len(ready)):
+                    embeddings = model.encode(
+                        [image for _, image, _ in ready], batch_size=args.batch_size
+                    )
+
+                with progress.stage("write", len(ready)):
+                    execute_values(
+                        cur, UPDATE_SQL,
+                        [(product_id, embedding, digest)
+                         for (product_id, _, digest), embedding in zip(ready, embeddings)],
+                        template="(%s, %s::vector, %s)",
+                    )
+                    conn.commit()
+                success_count += len(ready)
+
+        progress.report(final=True)
+        print(f"\n✅ Finished updating embeddings.")
+        print(f"✅ Success: {success_count} | ⏭️ Unchanged: {unchanged_count} | ⚠️ Skipped (missing/unreadable): {skipped_count}")
+
+    except Exception as e:
+        print(f"\n❌ An error occurred: {e}")
+    finally:
+        if 'cur' in locals():
+            cur.close()
+        if 'conn' in locals():
+            conn.close()
+        print("Database connection closed.")
+
 
-    for item in products_data:
-        product_id = item['id']
-
-        # --- Adjust the image path to use 'static/' as base directory ---
-        relative_img_path = item['img_paths'][0].lstrip('/')  # removes leading slash
-        image_path = os.path.join("static", relative_img_path)
-
-        if not os.path.exists(image_path):
-            print(f"[Warning] Image not found for product {product_id}: {image_path}. Skipping.")
-            skipped_count += 1
-            continue
-
-        # --- Generate image embedding ---
-        image = Image.open(image_path)
-        image_embedding = model.encode(image)
-
-        # --- Update in database ---
-        cur.execute(
-            "UPDATE products SET image_embedding = %s WHERE id = %s",
-            (np.array(image_embedding), product_id)
-        )
-        print(f"  ✅ Updated image embedding for product: {product_id}")
-        success_count += 1
-
-    conn.commit()
-    print(f"\n✅ Finished updating embeddings.")
-    print(f"✅ Success: {success_count} | ⚠️ Skipped (not found): {skipped_count}")
-
-except Exception as e:
-    print(f"\n❌ An error occurred: {e}")
-finally:
-    if 'cur' in locals():
-        cur.close()
-    if 'conn' in locals():
-        conn.close()
-    print("Database connection closed.")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# === Cache Settings ===
+# The memory tier is always on. The SQLite tier is enabled by pointing
+# ANALYSIS_CACHE_PATH at a file, and keeps results across restarts.
+
+ANALYSIS_CACHE_SIZE = int(os.environ.get("ANALYSIS_CACHE_SIZE", "2048"))
+ANALYSIS_CACHE_TTL = float(os.environ.get("ANALYSIS_CACHE_TTL", str(7 * 24 * 3600)))
+ANALYSIS_CACHE_PATH = os.environ.get("ANALYSIS_CACHE_PATH") or None
+
+# Words that look plural but must not be singularised ("shorts" is a category,
+# "short" is a length).
+_INVARIANT_WORDS = {"shorts", "pants", "jeans", "leggings", "trousers", "glasses"}
+
+
+def _singularize(word):
+    if word in _INVARIANT_WORDS or len(word) <= 3 or word.isdigit():
+        return word
+    if word.endswith(("sses", "shes", "ches", "xes")):
+        return word[:-2]
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+# Comparison operators carry the price filter's direction, so they become
+# words before punctuation is dropped: "dress < 2000" and "dress > 2000" must
+# not share a cache entry.
+_COMPARISONS = [("<=", " under "), (">=", " over "), ("<", " under "), (">", " over ")]
+
+
+def _is_word_char(ch):
+    # Letters and digits in any script, plus combining marks: \w alone splits
+    # Devanagari words at their vowel signs ("लाल" -> "ल ल").
+    return ch.isalnum() or ch == "-" or unicodedata.category(ch).startswith("M")
+
+
+def normalize_query(query: str):
+    """
+    Reduces a query to its cache key form.
+
+    "Red dresses under ₹2000 " and "red dress under 2000" both become
+    "red dress under 2000", and so does "red dresses < 2000". A query with no
+    words at all (only punctuation) keys on its lowercased, whitespace-collapsed
+    text, so unrelated queries never share the empty key.
+    """
+    lowered = query.lower()
+    text = lowered.replace(",", "")
+    for operator, word in _COMPARISONS:
+        text = text.replace(operator, word)
+    text = "".join(ch if _is_word_char(ch) else " " for ch in text)
+    words = re.findall(r"[^\s-]+(?:-[^\s-]+)*", text)
+    if not words:
+        return " ".join(lowered.split())
+    return " ".join(_singularize(word) for word in words)
+
+
+def prompt_fingerprint(model: str, prompt: str):
+    """Identifies the model + prompt pair; changing either invalidates the cache."""
+    return hashlib.sha256(f"{model}\n{prompt}".encode("utf-8")).hexdigest()[:16]
+
+
+class AnalysisCache:
+    """
+    Two-tier cache of LLM query analyses keyed on the normalized query.
+
+    Values are stored as JSON strings so every hit hands out a fresh dict that
+    callers are free to modify.
+    """
+
+    def __init__(self, namespace, max_size=ANALYSIS_CACHE_SIZE, ttl=ANALYSIS_CACHE_TTL,
+                 path=ANALYSIS_CACHE_PATH):
+        self.namespace = namespace
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+
+        self._memory = OrderedDict()   # key -> (stored_at, json)
+        self._lock = threading.Lock()
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+
+        self._db = None
+        if path:
+            self._open_disk_tier(path)
+
+    # --- Disk tier ---
+
+    def _open_disk_tier(self, path):
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS query_analysis (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    analysis TEXT NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """
+            )
+            # Entries written for another prompt/model can never be hit again.
+            db.execute("DELETE FROM query_analysis WHERE namespace != ?", (self.namespace,))
+            db.execute(
+                "DELETE FROM query_analysis WHERE stored_at < ?", (time.time() - self.ttl,)
+            )
+            db.commit()
+            self._db = db
+        except sqlite3.Error as e:
+            print(f"Analysis cache: disk tier disabled ({e})")
+            self._db = None
+
+    # --- Public API ---
+
+    def get(self, query: str):
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if now - stored_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return json.loads(value)
+                del self._memory[key]
+                self._stats["expirations"] += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT stored_at, analysis FROM query_analysis WHERE namespace = ? AND key = ?",
+                    (self.namespace, key),
+                ).fetchone()
+                if row is not None:
+                    stored_at, value = row
+                    if now - stored_at <= self.ttl:
+                        self._remember(key, stored_at, value)
+                        self._stats["disk_hits"] += 1
+                        return json.loads(value)
+                    self._db.execute(
+                        "DELETE FROM query_analysis WHERE namespace = ? AND key = ?",
+                        (self.namespace, key),
+                    )
+                    self._db.commit()
+                    self._stats["expirations"] += 1
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, query: str, analysis: dict):
+        key = normalize_query(query)
+        value = json.dumps(analysis)
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            self._stats["stores"] += 1
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO query_analysis (namespace, key, stored_at, analysis) "
+                        "VALUES (?, ?, ?, ?)",
+                        (self.namespace, key, now, value),
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"Analysis cache: could not persist entry ({e})")
+
+    def invalidate(self, query: str = None):
+        """Drops one query, or the whole cache when no query is given."""
+        with self._lock:
+            if query is None:
+                self._memory.clear()
+                if self._db is not None:
+                    self._db.execute("DELETE FROM query_analysis")
+                    self._db.commit()
+                return
+            key = normalize_query(query)
+            self._memory.pop(key, None)
+            if self._db is not None:
+                self._db.execute(
+                    "DELETE FROM query_analysis WHERE namespace = ? AND key = ?",
+                    (self.namespace, key),
+                )
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+            stats["max_size"] = self.max_size
+            stats["disk_enabled"] = self._db is not None
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        return stats
+
+    # --- Internals ---
+
+    def _remember(self, key, stored_at, value):
+        self._memory[key] = (stored_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
@@ -25,24 +25,87 @@ if "chat" not in st.session_state:
         "text": " Hi there! I'm your Fashion Assistant. Ask me about any fashion item or upload an image to get started."
     })
 
+
+def render_products(products):
+    for p in products:
+        pid = p["id"]
+        info = product_details.get(pid, {})
+
+        st.image(f"{API_URL}/static{p['image']}", width=250, caption=pid)
+        st.markdown(f"**{p['summary']}**")  # Show summary above, not inside expander
+        st.markdown(f" ₹{p['price']} &nbsp;&nbsp;  *{p['color']}*")
+
+        with st.expander(" Show Similiar Images "):
+            # Only additional images and color here
+            if "img_paths" in info:
+                st.markdown("** More Images:**")
+                img_cols = st.columns(4)
+                for i, img_path in enumerate(info["img_paths"]):
+                    with img_cols[i % 4]:
+                        st.image(f"{API_URL}/static{img_path}", use_container_width=True)
+
+            st.markdown(f"🎨 **Available Colors:** {p.get('color', 'Unknown')}")
+
+
+def describe_analysis(analysis):
+    if not analysis:
+        return "Searching..."
+    filters = analysis.get("filters") or {}
+    if not filters:
+        return f"Searching for *{analysis.get('refined_query', '')}*..."
+    parts = ", ".join(f"{key}: {value}" for key, value in filters.items())
+    return f"Searching for *{analysis.get('refined_query', '')}* ({parts})..."
+
+
+def stream_search(query):
+    """Yields (event, data) pairs from /search/stream as they arrive."""
+    with requests.post(f"{API_URL}/search/stream", data={"query": query}, stream=True) as res:
+        res.raise_for_status()
+        event = None
+        for line in res.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                yield event, json.loads(line[len("data:"):])
+
+
 # === Chat Input and Image Upload ===
 user_query = st.chat_input("Type your fashion query or upload an image below...")
 uploaded_img = st.file_uploader("📷 Upload a fashion image", type=["jpg", "jpeg", "png"])
 
 # === Handle Text Input ===
+# Results are streamed: the parsed filters show up first, then a preview from
+# the speculative search (if it beats the LLM), replaced by the final products.
+# Once the search is done the message joins the chat history below.
 if user_query:
     st.session_state.chat.append({"type": "user", "text": user_query})
-    with st.spinner("Thinking..."):
-        res = requests.post(f"{API_URL}/search", data={"query": user_query})
-        if res.status_code == 200:
-            response = res.json()
-            st.session_state.chat.append({
-                "type": "bot",
-                "text": response["response_text"],
-                "products": response["products"]
-            })
-        else:
-            st.session_state.chat.append({"type": "bot", "text": " Something went wrong while processing your query."})
+    live = st.empty()
+    response_text = "Here are some results:"
+    products = []
+    try:
+        with live.container(), st.chat_message("assistant"):
+            status = st.empty()
+            status.markdown("Thinking...")
+            results = st.empty()
+            for event, data in stream_search(user_query):
+                if event == "analysis":
+                    status.markdown(describe_analysis(data["analysis"]))
+                elif event == "products":
+                    with results.container():
+                        render_products(data["products"])
+                    products = data["products"]
+                elif event == "done":
+                    response_text = data["response_text"]
+                elif event == "error":
+                    raise RuntimeError(data["detail"])
+        st.session_state.chat.append({
+            "type": "bot",
+            "text": response_text,
+            "products": products
+        })
+    except Exception:
+        st.session_state.chat.append({"type": "bot", "text": " Something went wrong while processing your query."})
+    live.empty()
 
 # === Handle Image Upload ===
 if uploaded_img is not None:
@@ -69,21 +132,4 @@ for msg in st.session_state.chat:
             st.image(msg["image"], width=250)
 
         if msg.get("products"):
-            for p in msg["products"]:
-                pid = p["id"]
-                info = product_details.get(pid, {})
-
-                st.image(f"{API_URL}/static{p['image']}", width=250, caption=pid)
-                st.markdown(f"**{p['summary']}**")  # Show summary above, not inside expander
-                st.markdown(f" ₹{p['price']} &nbsp;&nbsp;  *{p['color']}*")
-
-                with st.expander(" Show Similiar Images "):
-                    # Only additional images and color here
-                    if "img_paths" in info:
-                        st.markdown("** More Images:**")
-                        img_cols = st.columns(4)
-                        for i, img_path in enumerate(info["img_paths"]):
-                            with img_cols[i % 4]:
-                                st.image(f"{API_URL}/static{img_path}", use_container_width=True)
-
-                    st.markdown(f"🎨 **Available Colors:** {p.get('color', 'Unknown')}")
+            render_products(msg["products"])
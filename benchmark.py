@@ -0,0 +1,480 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from ingestion import image_path_for, iter_json_array
+from stub_ollama import StubOllama
+
+# === End-to-end load benchmark ===
+# Measures throughput and p50/p95/p99 latency of /search, /similar-by-image and
+# /upload-and-search at several concurrency levels, with nothing on the network:
+#   - the LLM is stub_ollama.py: canned analyses after --llm-latency-ms,
+#   - the catalog is products.json, served by the in-process numpy backend
+#     (default) or by a local PostgreSQL + pgvector (--backend postgres),
+#   - queries are generated from catalog attributes with a fixed seed, so two
+#     runs send exactly the same requests.
+# The app is started with uvicorn for the run (or use --url for a running one).
+# Results go to a JSON file; --compare prints the change against an earlier
+# run and exits non-zero when throughput or p95 regressed past --tolerance.
+#
+#   python benchmark.py --concurrency 1,8,32 --requests 300
+#   python benchmark.py --compare benchmark_results/before.json
+#   python benchmark.py --output dual.json && \
+#     python benchmark.py --text-search-model clip --compare dual.json   # single-model mode
+#   python benchmark.py --backend postgres --output full.json && \
+#     python benchmark.py --backend postgres --vector-storage binary --compare full.json
+#   (the shadow columns must exist: python vector_storage.py add; recall is
+#    measured separately by python vector_storage.py recall)
+
+BENCHMARK_RESULTS_DIR = os.environ.get("BENCHMARK_RESULTS_DIR", "benchmark_results")
+ENDPOINTS = ["search", "similar-by-image", "upload-and-search"]
+# Per-endpoint server counters snapshotted after each endpoint's runs.
+STATS_ENDPOINTS = ["/speculation-stats", "/parser-stats", "/encoder-stats",
+                   "/embedding-cache-stats", "/pool-stats"]
+
+
+# === Workload ===
+
+def _first(value, default):
+    # Catalog attributes can hold several values ("White , Blue") or placeholders.
+    value = (value or "").split(",")[0].strip()
+    return value if value and value.lower() not in ("unknown", "any", "none", "n/a") else default
+
+
+def _plural(category):
+    return category.lower().replace("_", " ")
+
+
+def _singular(category):
+    word = _plural(category)
+    if word.endswith("es") and word[:-2].endswith(("ss", "sh", "ch", "x")):
+        return word[:-2]
+    return word[:-1] if word.endswith("s") and not word.endswith("ss") else word
+
+
+def build_query_mix(products, count, seed):
+    """
+    Returns [(query, analysis)]: natural-language queries built from catalog
+    attributes, each with the analysis a well-behaved LLM would return for it.
+    The templates range from rule-parser friendly to vague, so every
+    /search path (rules, LLM, speculation) gets exercised.
+    """
+    rng = random.Random(seed)
+    templates = [
+        lambda p: (f"{p['color']} {_singular(p['category'])}",
+                   f"{p['color']} {_singular(p['category'])}",
+                   {"category": p["category"], "color": p["color"]}),
+        lambda p: (f"show me {p['color']} {_plural(p['category'])} for {p['gender'].lower()} "
+                   f"under {p['budget']}",
+                   f"{p['color']} {_singular(p['category'])}",
+                   {"category": p["category"], "color": p["color"], "gender": p["gender"],
+                    "price_lt": p["budget"]}),
+        lambda p: (f"i need something {p['style']} to wear for {p['occasion']}",
+                   f"{p['style']} {p['occasion']} outfit",
+                   {}),
+        lambda p: (f"{p['neckline']} {_singular(p['category'])} in {p['fabric']}",
+                   f"{p['neckline']} {p['fabric']} {_singular(p['category'])}",
+                   {"category": p["category"], "neckline": p["neckline"]}),
+        lambda p: (f"{_plural(p['category'])} above {p['floor']} with {p['special_design']}",
+                   f"{_singular(p['category'])} with {p['special_design']}",
+                   {"category": p["category"], "price_gt": p["floor"]}),
+    ]
+    mix = []
+    for _ in range(count):
+        product = rng.choice(products)
+        price = int(product.get("price") or 1000)
+        attrs = {
+            "category": product["category"],
+            "color": _first(product.get("color"), "black").lower(),
+            "gender": _first(product.get("gender"), "Women"),
+            "style": _first(product.get("style"), "casual"),
+            "occasion": _first(product.get("occasion"), "everyday"),
+            "neckline": _first(product.get("neckline"), "round neck"),
+            "fabric": _first(product.get("fabric"), "cotton"),
+            "special_design": _first(product.get("special_design"), "prints"),
+            "budget": int(round(price * rng.uniform(1.1, 2.0), -2)),
+            "floor": max(int(round(price * rng.uniform(0.3, 0.8), -2)), 100),
+        }
+        query, refined, filters = rng.choice(templates)(attrs)
+        if "color" in filters:
+            filters["color"] = filters["color"].title()
+        mix.append((query, {"refined_query": refined, "filters": filters}))
+    return mix
+
+
+def build_workload(products_json, static_dir, queries, seed):
+    products = list(iter_json_array(products_json))
+    rng = random.Random(seed)
+    mix = build_query_mix(products, queries, seed)
+    images = []
+    for product in products:
+        path = image_path_for(product, static_dir)
+        if os.path.exists(path):
+            images.append((product["id"], path))
+    rng.shuffle(images)
+    return mix, images
+
+
+# === Seeding ===
+
+def seed_numpy_store(path, products_json, dtype, force=False):
+    if not force and os.path.exists(os.path.join(path, "meta.json")):
+        print(f"Using the existing vector store in {path}/ (--reseed to rebuild it).")
+        return
+    from numpy_backend import export_from_json
+    print(f"Encoding {products_json} into {path}/ ...")
+    export_from_json(path, dtype, products_json, 64)
+
+
+def seed_postgres(products_json):
+    # 1_setup_database.py drops and recreates the products table.
+    env = dict(os.environ, PRODUCTS_JSON=products_json)
+    for script in ["1_setup_database.py", "2_populate_database.py",
+                   "2b_populate_image_embeddings.py", "precompute_neighbors.py"]:
+        print(f"Running {script} ...")
+        subprocess.run([sys.executable, script], check=True, env=env)
+
+
+# === App under test ===
+
+def start_app(port, env, timeout):
+    """Starts uvicorn and waits for /ready; returns (process, url, startup seconds, /ready body)."""
+    start = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning"],
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited with code {process.returncode} during startup.")
+        try:
+            # /ready turns 200 once the store or pool is open and the models are warm.
+            response = requests.get(f"{url}/ready", timeout=2)
+            if response.ok:
+                return process, url, round(time.monotonic() - start, 2), response.json()
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"The app did not come up within {timeout:.0f}s.")
+
+
+def process_memory_mb(pid):
+    """Current and peak resident memory of a process (Linux only; None elsewhere)."""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return {"rss_mb": round(int(fields["VmRSS"].split()[0]) / 1024, 1),
+                "peak_rss_mb": round(int(fields["VmHWM"].split()[0]) / 1024, 1)}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def stop_app(process):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+# === Load generation ===
+
+def _request_factory(endpoint, url, mix, images):
+    """Returns make(i) -> (url, requests kwargs) for the i-th request to `endpoint`."""
+    if endpoint == "search":
+        def make(i):
+            return f"{url}/search", {"data": {"query": mix[i % len(mix)][0]}}
+    elif endpoint == "similar-by-image":
+        def make(i):
+            return f"{url}/similar-by-image", {"data": {"product_id": images[i % len(images)][0]}}
+    else:
+        cache = {}
+
+        def make(i):
+            _, path = images[i % len(images)]
+            if path not in cache:
+                with open(path, "rb") as f:
+                    cache[path] = f.read()
+            return f"{url}/upload-and-search", {
+                "files": {"file": (os.path.basename(path), cache[path], "image/jpeg")}
+            }
+    return make
+
+
+def run_level(endpoint, url, mix, images, concurrency, total, warmup, timeout):
+    """Closed-loop load: `concurrency` clients each send their next request as soon as the last returns."""
+    make = _request_factory(endpoint, url, mix, images)
+    sessions = threading.local()
+    counter = iter(range(warmup + total))
+    counter_lock = threading.Lock()
+    latencies = []
+    errors = {}
+    state = {"start": None}
+
+    def client():
+        session = getattr(sessions, "session", None)
+        if session is None:
+            session = sessions.session = requests.Session()
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+                if i == warmup and state["start"] is None:
+                    state["start"] = time.perf_counter()
+            if i is None:
+                return
+            target, kwargs = make(i)
+            start = time.perf_counter()
+            try:
+                response = session.post(target, timeout=timeout, **kwargs)
+                ok = response.ok
+                key = str(response.status_code)
+            except requests.RequestException as e:
+                ok, key = False, type(e).__name__
+            elapsed = time.perf_counter() - start
+            if i < warmup:
+                continue
+            with counter_lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[key] = errors.get(key, 0) + 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(client) for _ in range(concurrency)]:
+            future.result()
+    wall = time.perf_counter() - (state["start"] or time.perf_counter())
+
+    result = {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": total,
+        "ok": len(latencies),
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall > 0 else 0.0,
+    }
+    if latencies:
+        ms = np.array(latencies) * 1000
+        result["latency_ms"] = {
+            "mean": round(float(ms.mean()), 2),
+            "p50": round(float(np.percentile(ms, 50)), 2),
+            "p95": round(float(np.percentile(ms, 95)), 2),
+            "p99": round(float(np.percentile(ms, 99)), 2),
+            "max": round(float(ms.max()), 2),
+        }
+    return result
+
+
+def server_stats(url):
+    stats = {}
+    for path in STATS_ENDPOINTS:
+        try:
+            response = requests.get(f"{url}{path}", timeout=5)
+            if response.ok:
+                stats[path.strip("/")] = response.json()
+        except (requests.RequestException, ValueError):
+            pass
+    return stats
+
+
+# === Reporting ===
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results):
+    print(f"\n{'endpoint':<20}{'conc':>6}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'errors':>8}")
+    for r in results:
+        lat = r.get("latency_ms", {})
+        print(f"{r['endpoint']:<20}{r['concurrency']:>6}{r['throughput_rps']:>10.1f}"
+              f"{lat.get('p50', float('nan')):>10.1f}{lat.get('p95', float('nan')):>10.1f}"
+              f"{lat.get('p99', float('nan')):>10.1f}{sum(r['errors'].values()):>8}")
+
+
+def compare(baseline, current, tolerance):
+    """Prints per-level deltas; returns the number of regressions past `tolerance`."""
+    before = {(r["endpoint"], r["concurrency"]): r for r in baseline["results"]}
+    regressions = 0
+    for key, label in (("startup_seconds", "startup s"), ("memory_after_warmup", "RSS MB"),
+                       ("memory_at_end", "RSS MB at end")):
+        old, new = baseline.get("server", {}).get(key), current.get("server", {}).get(key)
+        if isinstance(old, dict):
+            old, new = old.get("rss_mb"), (new or {}).get("rss_mb")
+        if old and new:
+            print(f"{label:<20}{new:>10.1f} ({new / old - 1:+.0%} vs {old:.1f})")
+    print(f"\n{'endpoint':<20}{'conc':>6}{'rps':>18}{'p95 ms':>20}")
+    for r in current["results"]:
+        old = before.get((r["endpoint"], r["concurrency"]))
+        if old is None or "latency_ms" not in old or "latency_ms" not in r:
+            continue
+        rps_change = r["throughput_rps"] / old["throughput_rps"] - 1 if old["throughput_rps"] else 0.0
+        p95_change = r["latency_ms"]["p95"] / old["latency_ms"]["p95"] - 1 if old["latency_ms"]["p95"] else 0.0
+        regressed = rps_change < -tolerance or p95_change > tolerance
+        regressions += regressed
+        print(f"{r['endpoint']:<20}{r['concurrency']:>6}"
+              f"{r['throughput_rps']:>10.1f} ({rps_change:+.0%})"
+              f"{r['latency_ms']['p95']:>12.1f} ({p95_change:+.0%})"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the search API with local stand-ins.")
+    parser.add_argument("--backend", choices=["numpy", "postgres"], default="numpy")
+    parser.add_argument("--reseed", action="store_true",
+                        help="Rebuild the numpy store, or reload the database (drops products!).")
+    parser.add_argument("--products-json", default=os.environ.get("PRODUCTS_JSON", "products.json"))
+    parser.add_argument("--static-dir", default="static")
+    parser.add_argument("--vector-store", default=os.environ.get("VECTOR_STORE_DIR", "vector_store"))
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS),
+                        help="Comma-separated subset of: " + ", ".join(ENDPOINTS))
+    parser.add_argument("--concurrency", default="1,8,32",
+                        help="Comma-separated concurrency levels.")
+    parser.add_argument("--requests", type=int, default=200, help="Measured requests per level.")
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured requests per level.")
+    parser.add_argument("--queries", type=int, default=500, help="Distinct queries in the mix.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0)
+    parser.add_argument("--llm-jitter-ms", type=float, default=50.0)
+    parser.add_argument("--llm-invalid-json-rate", type=float, default=0.0)
+    parser.add_argument("--text-search-model", choices=["minilm", "clip"], default=None,
+                        help="TEXT_SEARCH_MODEL for the app (clip: single-model mode).")
+    parser.add_argument("--embedding-backend", choices=["torch", "onnx"], default=None,
+                        help="EMBEDDING_BACKEND for the app.")
+    parser.add_argument("--vector-storage", choices=["full", "half", "binary"], default=None,
+                        help="VECTOR_STORAGE for the app (postgres backend).")
+    parser.add_argument("--ollama-port", type=int, default=0, help="0 picks a free port.")
+    parser.add_argument("--port", type=int, default=8765, help="Port for the app under test.")
+    parser.add_argument("--url", default=None,
+                        help="Benchmark an already running app instead of starting one "
+                             "(it should use OLLAMA_HOST pointing at --ollama-port).")
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--request-timeout", type=float, default=60.0)
+    parser.add_argument("--output", default=None,
+                        help="Results file (default: benchmark_results/<timestamp>.json).")
+    parser.add_argument("--compare", default=None, help="Earlier results file to diff against.")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Relative throughput drop / p95 rise counted as a regression.")
+    args = parser.parse_args()
+
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    levels = [int(c) for c in args.concurrency.split(",")]
+    mix, images = build_workload(args.products_json, args.static_dir, args.queries, args.seed)
+    if not images and any(e != "search" for e in endpoints):
+        parser.error(f"No product images found under {args.static_dir}/.")
+    print(f"Workload: {len(mix)} queries, {len(images)} product images.")
+
+    if args.url is None:
+        if args.backend == "numpy":
+            seed_numpy_store(args.vector_store, args.products_json, args.dtype, args.reseed)
+        elif args.reseed:
+            seed_postgres(args.products_json)
+
+    stub = StubOllama(dict(mix), args.llm_latency_ms, args.llm_jitter_ms,
+                      args.llm_invalid_json_rate, port=args.ollama_port, seed=args.seed).start()
+    print(f"Stub Ollama on {stub.url} ({args.llm_latency_ms:.0f} ± {args.llm_jitter_ms:.0f} ms).")
+
+    process, server = None, {}
+    try:
+        if args.url is None:
+            env = dict(os.environ, OLLAMA_HOST=stub.url, SAVE_UPLOADS="0",
+                       SEARCH_BACKEND=args.backend,
+                       VECTOR_STORE_DIR=args.vector_store)
+            if args.text_search_model:
+                env["TEXT_SEARCH_MODEL"] = args.text_search_model
+            if args.embedding_backend:
+                env["EMBEDDING_BACKEND"] = args.embedding_backend
+            if args.vector_storage:
+                env["VECTOR_STORAGE"] = args.vector_storage
+            print("Starting the app (model loading can take a while)...")
+            process, url, startup_seconds, ready = start_app(args.port, env, args.startup_timeout)
+            # Memory and cold start are what single-model mode and the ONNX
+            # backend change most, so they're recorded next to the latencies.
+            server = {"startup_seconds": startup_seconds, "ready": ready,
+                      "memory_after_warmup": process_memory_mb(process.pid)}
+            print(f"App ready in {startup_seconds:.1f}s.")
+        else:
+            url = args.url.rstrip("/")
+
+        results, stats = [], {}
+        for endpoint in endpoints:
+            for concurrency in levels:
+                print(f"  {endpoint} x{concurrency} ...")
+                results.append(run_level(endpoint, url, mix, images, concurrency, args.requests,
+                                         args.warmup, args.request_timeout))
+            stats[endpoint] = server_stats(url)
+        if process is not None:
+            server["memory_at_end"] = process_memory_mb(process.pid)
+    finally:
+        if process is not None:
+            stop_app(process)
+        stub_stats = stub.stats()
+        stub.stop()
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "backend": args.backend,
+            "text_search_model": args.text_search_model,
+            "embedding_backend": args.embedding_backend,
+            "vector_storage": args.vector_storage,
+            "url": args.url,
+            "seed": args.seed,
+            "queries": len(mix),
+            "images": len(images),
+            "requests_per_level": args.requests,
+            "warmup_per_level": args.warmup,
+            "llm_latency_ms": args.llm_latency_ms,
+            "llm_jitter_ms": args.llm_jitter_ms,
+            "llm_invalid_json_rate": args.llm_invalid_json_rate,
+        },
+        "server": server,
+        "results": results,
+        "server_stats": stats,
+        "stub_ollama": stub_stats,
+    }
+    output = args.output or os.path.join(BENCHMARK_RESULTS_DIR,
+                                         time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print_table(results)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.tolerance)
+        if regressions:
+            print(f"\n{regressions} level(s) regressed by more than {args.tolerance:.0%}.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
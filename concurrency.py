@@ -0,0 +1,165 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# === Encoding Executor ===
+# Model forward passes are CPU-bound and release the GIL inside torch, so a small
+# thread pool keeps them off the event loop without oversubscribing the cores.
+# MAX_PENDING_ENCODES bounds how many jobs may queue up behind the workers.
+
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", str(min(4, os.cpu_count() or 1))))
+MAX_PENDING_ENCODES = int(os.environ.get("MAX_PENDING_ENCODES", "64"))
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = None
+
+
+def get_encode_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=ENCODE_WORKERS, thread_name_prefix="encode"
+                )
+    return _executor
+
+
+async def run_encode(fn, *args, **kwargs):
+    """Runs a blocking encode call on the bounded executor and awaits its result."""
+    global _pending
+    if _pending is None:
+        _pending = asyncio.Semaphore(MAX_PENDING_ENCODES)
+    loop = asyncio.get_running_loop()
+    async with _pending:
+        return await loop.run_in_executor(
+            get_encode_executor(), lambda: fn(*args, **kwargs)
+        )
+
+
+def shutdown_encode_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+# === Micro-batching ===
+# Concurrent requests each need one embedding, but a forward pass over 32 items
+# costs far less than 32 passes over one. A MicroBatcher queues single items,
+# groups them into a batch of up to ENCODE_BATCH_SIZE items or whatever
+# arrived within ENCODE_BATCH_WAIT_MS of the first, and runs one batched
+# encode on the executor, resolving each caller's future with its row.
+
+ENCODE_BATCH_SIZE = int(os.environ.get("ENCODE_BATCH_SIZE", "32"))
+ENCODE_BATCH_WAIT_MS = float(os.environ.get("ENCODE_BATCH_WAIT_MS", "5"))
+
+
+class MicroBatcher:
+    def __init__(self, encode_batch, max_batch_size=ENCODE_BATCH_SIZE,
+                 max_wait_ms=ENCODE_BATCH_WAIT_MS, name="encode"):
+        self.encode_batch = encode_batch   # list of items -> sequence of results
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self._queue = None
+        self._worker = None
+        self._in_flight = set()
+        self._stats = {
+            "batches": 0,
+            "items": 0,
+            "failed_batches": 0,
+            "largest_batch": 0,
+            "last_batch_size": 0,
+            "wait_seconds": 0.0,
+            "encode_seconds": 0.0,
+        }
+
+    async def submit(self, item):
+        """Queues one item and waits for its encoded result."""
+        if self._worker is None or self._worker.done():
+            self._queue = self._queue or asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._collect())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Don't wait for this batch: the next one can fill up meanwhile and
+            # run on another executor thread.
+            task = loop.create_task(self._encode(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _encode(self, batch):
+        started = time.perf_counter()
+        try:
+            results = await run_encode(self.encode_batch, [item for item, _, _ in batch])
+        except Exception as e:
+            self._stats["failed_batches"] += 1
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finished = time.perf_counter()
+
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():   # the caller may have gone away
+                future.set_result(result)
+
+        stats = self._stats
+        stats["batches"] += 1
+        stats["items"] += len(batch)
+        stats["largest_batch"] = max(stats["largest_batch"], len(batch))
+        stats["last_batch_size"] = len(batch)
+        stats["wait_seconds"] += sum(started - queued_at for _, _, queued_at in batch)
+        stats["encode_seconds"] += finished - started
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for task in list(self._in_flight):
+            task.cancel()
+        while self._queue is not None and not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError(f"{self.name} batcher closed"))
+        self._queue = None
+
+    def stats(self):
+        stats = dict(self._stats)
+        batches, items = stats["batches"], stats["items"]
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "in_flight_batches": len(self._in_flight),
+            "batches": batches,
+            "items": items,
+            "failed_batches": stats["failed_batches"],
+            "avg_batch_size": items / batches if batches else 0.0,
+            "largest_batch": stats["largest_batch"],
+            "last_batch_size": stats["last_batch_size"],
+            "avg_wait_ms": 1000 * stats["wait_seconds"] / items if items else 0.0,
+            "avg_encode_ms": 1000 * stats["encode_seconds"] / batches if batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+        }
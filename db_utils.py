@@ -0,0 +1,370 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+import asyncpg
+import psycopg2
+from pgvector.asyncpg import register_vector as register_vector_async
+from pgvector.psycopg2 import register_vector
+from metrics import observe_stage
+
+# --- Database Connection Details ---
+
+DB_NAME = os.environ.get("DB_NAME", "fashion_db")
+DB_USER = os.environ.get("DB_USER", "postgres")
+DB_PASSWORD = os.environ.get("DB_PASSWORD", "postgres")
+DB_HOST = os.environ.get("DB_HOST", "localhost")
+DB_PORT = os.environ.get("DB_PORT", "5432")
+
+# --- Pool Settings ---
+# POOL_MIN_SIZE connections are opened up front so the first requests don't pay
+# for TCP/auth setup; POOL_MAX_SIZE is a hard cap, callers wait for a free slot.
+POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "2"))
+POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "10"))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+# A connection idle for longer than this is pinged before it is handed out.
+HEALTH_CHECK_INTERVAL = float(os.environ.get("DB_HEALTH_CHECK_INTERVAL", "30"))
+
+
+def connect():
+    """Opens a new connection with pgvector support registered."""
+    conn = psycopg2.connect(
+        dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT
+    )
+    register_vector(conn)
+    # register_vector runs a type lookup; don't leave that transaction open.
+    conn.commit()
+    return conn
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes free within the pool timeout."""
+
+
+class ConnectionPool:
+    """
+    A bounded, thread-safe pool of psycopg2 connections.
+
+    Connections are created with `connect()`, so the vector type is registered
+    exactly once per connection instead of once per request.
+    """
+
+    def __init__(self, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 timeout=POOL_TIMEOUT, health_check_interval=HEALTH_CHECK_INTERVAL):
+        if min_size > max_size:
+            raise ValueError("min_size cannot be larger than max_size")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle = deque()          # (conn, last_used) pairs, most recent on the right
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "health_checks": 0,
+            "health_check_failures": 0,
+            "timeouts": 0,
+        }
+
+    # --- Lifecycle ---
+
+    def prewarm(self):
+        """Opens connections until at least `min_size` exist."""
+        while True:
+            with self._cond:
+                if self._closed or len(self._idle) + self._in_use >= self.min_size:
+                    return
+                self._in_use += 1  # reserve the slot while connecting
+            try:
+                conn = self._create()
+            except Exception:
+                with self._cond:
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._in_use -= 1
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def close(self):
+        """Closes all idle connections; busy ones are closed when returned."""
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    # --- Checkout / Return ---
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed")
+                while not self._idle and self._in_use >= self.max_size:
+                    waited = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No database connection available within {self.timeout}s"
+                        )
+                    self._cond.wait(remaining)
+                    if self._closed:
+                        raise PoolTimeout("Connection pool is closed")
+                self._in_use += 1
+                entry = self._idle.pop() if self._idle else None
+                self._stats["checkouts"] += 1
+                if waited:
+                    self._stats["waits"] += 1
+                    self._stats["wait_time_total"] += time.monotonic() - start
+
+            try:
+                if entry is None:
+                    return self._create()
+                conn, last_used = entry
+                if self._is_healthy(conn, last_used):
+                    return conn
+                self._discard(conn)
+            except Exception:
+                self._release_slot()
+                raise
+            # The idle connection was dead: give the slot back and try again.
+            self._release_slot()
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.status != psycopg2.extensions.STATUS_READY:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        else:
+            discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            if not discard and not self._closed:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+                return
+            self._cond.notify()
+        self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of the block.
+
+        The transaction is committed on success and rolled back on error.
+        Connections that broke during the block are dropped from the pool.
+        """
+        start = time.perf_counter()
+        conn = self.getconn()
+        observe_stage("pool_acquire", time.perf_counter() - start)
+        try:
+            yield conn
+            conn.commit()
+        except Exception as e:
+            broken = conn.closed or isinstance(
+                e, (psycopg2.OperationalError, psycopg2.InterfaceError)
+            )
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            self.putconn(conn, discard=broken)
+            raise
+        else:
+            self.putconn(conn)
+
+    # --- Stats ---
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": len(self._idle) + self._in_use,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+            })
+        return stats
+
+    # --- Internals ---
+
+    def _create(self):
+        conn = connect()
+        with self._cond:
+            self._stats["connections_created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._stats["connections_discarded"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _release_slot(self):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        with self._cond:
+            self._stats["health_checks"] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            with self._cond:
+                self._stats["health_check_failures"] += 1
+            return False
+
+
+# === Shared Pool ===
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Returns the process-wide pool, creating and pre-warming it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool()
+                try:
+                    pool.prewarm()
+                except Exception as e:
+                    # Serving can still proceed; connections are opened on demand.
+                    print(f"Could not pre-warm the database pool: {e}")
+                _pool = pool
+    return _pool
+
+
+def get_connection():
+    """Context manager yielding a pooled connection: `with get_connection() as conn:`."""
+    return get_pool().connection()
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def pool_stats():
+    if _pool is None:
+        stats = {"size": 0, "in_use": 0, "idle": 0,
+                 "min_size": POOL_MIN_SIZE, "max_size": POOL_MAX_SIZE}
+    else:
+        stats = _pool.stats()
+    stats["async"] = async_pool_stats()
+    return stats
+
+
+# === Async Pool (used by the FastAPI request path) ===
+
+_async_pool = None
+_async_pool_lock = None
+
+
+async def _init_async_connection(conn):
+    await register_vector_async(conn)
+
+
+async def get_async_pool():
+    """Returns the process-wide asyncpg pool, creating it on first use."""
+    global _async_pool, _async_pool_lock
+    if _async_pool is None:
+        if _async_pool_lock is None:
+            import asyncio
+            _async_pool_lock = asyncio.Lock()
+        async with _async_pool_lock:
+            if _async_pool is None:
+                _async_pool = await asyncpg.create_pool(
+                    database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
+                    host=DB_HOST, port=int(DB_PORT),
+                    min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                    # asyncpg pings idle connections itself; this recycles them too.
+                    max_inactive_connection_lifetime=HEALTH_CHECK_INTERVAL * 10,
+                    init=_init_async_connection,
+                )
+    return _async_pool
+
+
+@asynccontextmanager
+async def async_connection():
+    """
+    `async with async_connection() as conn:` checks out a pooled asyncpg
+    connection, recording how long the checkout took.
+    """
+    start = time.perf_counter()
+    pool = await get_async_pool()
+    conn = await pool.acquire()
+    observe_stage("pool_acquire", time.perf_counter() - start)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+async def close_async_pool():
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
+
+
+def async_pool_stats():
+    if _async_pool is None:
+        return {"size": 0, "in_use": 0, "idle": 0,
+                "min_size": POOL_MIN_SIZE, "max_size": POOL_MAX_SIZE}
+    size = _async_pool.get_size()
+    idle = _async_pool.get_idle_size()
+    return {
+        "min_size": _async_pool.get_min_size(),
+        "max_size": _async_pool.get_max_size(),
+        "size": size,
+        "in_use": size - idle,
+        "idle": idle,
+    }
+
+
+def to_asyncpg_placeholders(sql):
+    """Rewrites psycopg2-style `%s` placeholders into asyncpg's `$1, $2, ...`."""
+    parts = sql.split("%s")
+    out = [parts[0]]
+    for i, part in enumerate(parts[1:], start=1):
+        out.append(f"${i}")
+        out.append(part)
+    return "".join(out)
@@ -0,0 +1,188 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# === Cache Settings ===
+# Refined queries repeat heavily ("red dress", "black coat"), so their vectors
+# are cached instead of re-running the model. The memory tier is bounded by
+# bytes, not entries. The SQLite tier is enabled by pointing
+# EMBEDDING_CACHE_PATH at a file and lets a restarted worker start warm.
+
+EMBEDDING_CACHE_BYTES = int(os.environ.get("EMBEDDING_CACHE_BYTES", str(32 * 1024 * 1024)))
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH") or None
+# The disk tier keeps at most this many entries per model (least recently used go first).
+EMBEDDING_CACHE_DISK_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_DISK_ENTRIES", "200000"))
+
+
+def cache_key(text: str):
+    # Only whitespace is normalized: anything else may change the embedding.
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class EmbeddingCache:
+    """
+    LRU cache of text -> float32 vector for one model, with a byte budget.
+
+    Vectors are kept as raw float32 buffers; hits come back as read-only
+    arrays over that buffer, so a cached vector can't be modified by a caller.
+    """
+
+    def __init__(self, namespace, max_bytes=EMBEDDING_CACHE_BYTES, path=EMBEDDING_CACHE_PATH,
+                 max_disk_entries=EMBEDDING_CACHE_DISK_ENTRIES):
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+
+        self._memory = OrderedDict()   # key -> bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+        }
+
+        self._db = None
+        if path:
+            self._open_disk_tier(path)
+
+    # --- Disk tier ---
+
+    def _open_disk_tier(self, path):
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    used_at REAL NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """
+            )
+            db.execute(
+                """
+                DELETE FROM embeddings WHERE namespace = ? AND key NOT IN (
+                    SELECT key FROM embeddings WHERE namespace = ? ORDER BY used_at DESC LIMIT ?
+                )
+                """,
+                (self.namespace, self.namespace, self.max_disk_entries),
+            )
+            db.commit()
+            self._db = db
+        except sqlite3.Error as e:
+            print(f"Embedding cache: disk tier disabled ({e})")
+            self._db = None
+
+    # --- Public API ---
+
+    def get(self, text: str):
+        key = cache_key(text)
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return np.frombuffer(value, dtype=np.float32)
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT vector FROM embeddings WHERE namespace = ? AND key = ?",
+                    (self.namespace, key),
+                ).fetchone()
+                if row is not None:
+                    value = bytes(row[0])
+                    self._remember(key, value)
+                    self._touch(key)
+                    self._stats["disk_hits"] += 1
+                    return np.frombuffer(value, dtype=np.float32)
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, text: str, vector):
+        key = cache_key(text)
+        value = np.asarray(vector, dtype=np.float32).tobytes()
+        with self._lock:
+            self._remember(key, value)
+            self._stats["stores"] += 1
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO embeddings (namespace, key, used_at, vector) "
+                        "VALUES (?, ?, ?, ?)",
+                        (self.namespace, key, time.time(), value),
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"Embedding cache: could not persist entry ({e})")
+
+    def get_or_encode(self, text: str, encode):
+        """Returns the cached vector for `text`, or computes it with `encode(text)` and caches it."""
+        vector = self.get(text)
+        if vector is None:
+            vector = encode(text)
+            self.put(text, vector)
+        return vector
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings WHERE namespace = ?", (self.namespace,))
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+            stats["memory_bytes"] = self._bytes
+            stats["max_bytes"] = self.max_bytes
+            stats["disk_enabled"] = self._db is not None
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        return stats
+
+    # --- Internals ---
+
+    @staticmethod
+    def _size(key, value):
+        return len(key.encode("utf-8")) + len(value)
+
+    def _remember(self, key, value):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._bytes -= self._size(key, old)
+        self._memory[key] = value
+        self._bytes += self._size(key, value)
+        while self._bytes > self.max_bytes and len(self._memory) > 1:
+            old_key, old_value = self._memory.popitem(last=False)
+            self._bytes -= self._size(old_key, old_value)
+            self._stats["evictions"] += 1
+
+    def _touch(self, key):
+        # Keeps the disk tier's LRU order roughly right; failures only cost warmth.
+        try:
+            self._db.execute(
+                "UPDATE embeddings SET used_at = ? WHERE namespace = ? AND key = ?",
+                (time.time(), self.namespace, key),
+            )
+            self._db.commit()
+        except sqlite3.Error:
+            pass
@@ -0,0 +1,201 @@
+import asyncio
+import os
+import time
+
+import numpy as np
+
+from embedding_server import pack_images, parse_address, read_frame, write_frame
+
+# === Embedding server client ===
+# With EMBEDDING_SERVER set (a Unix socket path or host:port), query and
+# upload embeddings come from embedding_server.py instead of models loaded in
+# this process. Every call takes an in-process fallback: if the server can't be
+# reached, errors out or takes longer than EMBEDDING_SERVER_TIMEOUT, the item
+# is encoded locally (loading the model on first use) and the server is left
+# alone for EMBEDDING_SERVER_RETRY seconds before it is tried again.
+# `on_fallback` (if set) is called each time the client switches to in-process
+# encoding, so the app can load its local models before traffic needs them.
+
+EMBEDDING_SERVER = os.environ.get("EMBEDDING_SERVER") or None
+EMBEDDING_SERVER_TIMEOUT = float(os.environ.get("EMBEDDING_SERVER_TIMEOUT", "5"))
+EMBEDDING_SERVER_RETRY = float(os.environ.get("EMBEDDING_SERVER_RETRY", "10"))
+
+
+class EmbeddingServerUnavailable(Exception):
+    pass
+
+
+class EmbeddingClient:
+    def __init__(self, address=EMBEDDING_SERVER, timeout=EMBEDDING_SERVER_TIMEOUT,
+                 retry_after=EMBEDDING_SERVER_RETRY):
+        self.address = address
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._connect_lock = None
+        self._write_lock = None
+        self._pending = {}   # request id -> future
+        self._next_id = 0
+        self._down_until = 0.0
+        self._last_error = None
+        self.on_fallback = None
+        self._stats = {"remote_requests": 0, "remote_items": 0, "fallback_items": 0,
+                       "failures": 0, "connects": 0}
+
+    @property
+    def enabled(self):
+        return bool(self.address)
+
+    # --- Connection ---
+
+    async def _connect(self):
+        if self._writer is not None and not self._writer.is_closing():
+            return
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+            self._write_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is not None and not self._writer.is_closing():
+                return
+            kind, host, port = parse_address(self.address)
+            try:
+                if kind == "tcp":
+                    opening = asyncio.open_connection(host, port)
+                else:
+                    opening = asyncio.open_unix_connection(host)
+                self._reader, self._writer = await asyncio.wait_for(opening, self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise EmbeddingServerUnavailable(f"cannot connect to {self.address}: {e}") from e
+            self._stats["connects"] += 1
+            self._reader_task = asyncio.ensure_future(self._read_responses(self._reader))
+
+    async def _read_responses(self, reader):
+        try:
+            while True:
+                header, payload = await read_frame(reader)
+                future = self._pending.pop(header.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result((header, payload))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            self._disconnect(EmbeddingServerUnavailable(f"connection lost: {e!r}"))
+
+    def _disconnect(self, error):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def _request(self, header, payload=b""):
+        await self._connect()
+        self._next_id += 1
+        request_id = header["id"] = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            async with self._write_lock:
+                write_frame(self._writer, header, payload)
+                await self._writer.drain()
+            response, body = await asyncio.wait_for(future, self.timeout)
+        except (ConnectionError, AttributeError) as e:
+            # AttributeError: the connection dropped (writer reset) mid-request.
+            self._disconnect(EmbeddingServerUnavailable(f"connection lost: {e!r}"))
+            raise EmbeddingServerUnavailable(str(e)) from e
+        except asyncio.TimeoutError as e:
+            raise EmbeddingServerUnavailable(f"no answer within {self.timeout}s") from e
+        finally:
+            self._pending.pop(request_id, None)
+        if not response.get("ok"):
+            raise EmbeddingServerUnavailable(response.get("error", "unknown error"))
+        return response, body
+
+    # --- Encoding ---
+
+    async def encode(self, model, items):
+        """(n, dim) float32 vectors for `items` (strings, or PIL images for "image") from the server."""
+        if model == "image":
+            shapes, payload = pack_images(items)
+            header = {"op": "encode", "model": model, "shapes": shapes}
+        else:
+            header, payload = {"op": "encode", "model": model, "texts": list(items)}, b""
+        response, body = await self._request(header, payload)
+        self._stats["remote_requests"] += 1
+        self._stats["remote_items"] += len(items)
+        return np.frombuffer(body, dtype=np.float32).reshape(response["shape"])
+
+    def _available(self):
+        return self.enabled and time.monotonic() >= self._down_until
+
+    def _failed(self, error):
+        self._stats["failures"] += 1
+        if self._last_error is None:
+            print(f"[embedding-client] {error}; encoding in-process for {self.retry_after:.0f}s.")
+            if self.on_fallback is not None:
+                self.on_fallback()
+        self._last_error = str(error)
+        self._down_until = time.monotonic() + self.retry_after
+
+    async def encode_many(self, model, items, fallback):
+        """
+        Vectors for `items` from the server, or from `await fallback(items)`
+        when the server is disabled or failing.
+        """
+        if self._available():
+            try:
+                vectors = await self.encode(model, items)
+                self._last_error = None
+                return list(vectors)
+            except EmbeddingServerUnavailable as e:
+                self._failed(e)
+        self._stats["fallback_items"] += len(items)
+        return await fallback(items)
+
+    async def encode_one(self, model, item, fallback):
+        """Like encode_many for a single item; `fallback(item)` returns its vector."""
+        if self._available():
+            try:
+                vector = (await self.encode(model, [item]))[0]
+                self._last_error = None
+                return vector
+            except EmbeddingServerUnavailable as e:
+                self._failed(e)
+        self._stats["fallback_items"] += 1
+        return await fallback(item)
+
+    # --- Health ---
+
+    async def ping(self):
+        """The server's stats (with "ready"), or None if it can't be reached."""
+        if not self.enabled:
+            return None
+        try:
+            response, _ = await self._request({"op": "ping"})
+        except EmbeddingServerUnavailable as e:
+            # A dead server is noticed here too, not only by the next encode.
+            self._failed(e)
+            return None
+        return response.get("stats")
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        self._disconnect(EmbeddingServerUnavailable("client closed"))
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update({
+            "enabled": self.enabled,
+            "address": self.address,
+            "connected": self._writer is not None and not self._writer.is_closing(),
+            "in_fallback": self.enabled and time.monotonic() < self._down_until,
+            "last_error": self._last_error,
+        })
+        return stats
+
+
+embedding_client = EmbeddingClient()
@@ -0,0 +1,252 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+from concurrency import MicroBatcher, run_encode, shutdown_encode_executor
+from model_registry import SERVING_MODELS, models
+
+# === Embedding server ===
+# One process owns the models and encodes for every API worker on the node, so
+# `uvicorn --workers N` holds one copy of each model instead of N, and
+# concurrent requests from all workers share the same micro-batches. The API
+# talks to it over a Unix socket (or host:port) when EMBEDDING_SERVER is set;
+# see embedding_client.py for the client and its in-process fallback.
+#
+#   python embedding_server.py                         # serves SERVING_MODELS
+#   python embedding_server.py --stand-in              # no models: fake vectors, for tests
+#
+# Wire format: each frame is two big-endian uint32 lengths (JSON header,
+# binary payload) followed by the header and the payload. Requests:
+#   {"id", "op": "encode", "model", "texts": [...]}                  no payload
+#   {"id", "op": "encode", "model", "shapes": [[h, w], ...]}         RGB uint8 pixels
+#   {"id", "op": "ping"}
+# Responses echo the id: {"id", "ok": true, "shape": [n, dim]} with float32
+# rows as the payload, or {"id", "ok": false, "error": "..."}.
+
+EMBEDDING_SERVER_SOCKET = os.environ.get("EMBEDDING_SERVER_SOCKET", "/tmp/embedding_server.sock")
+# Fake vector sizes used by --stand-in, per registry key.
+STAND_IN_DIMENSIONS = {"text": 384, "clip_text": 512, "image": 512}
+
+_FRAME = struct.Struct(">II")
+
+
+# === Framing (shared with embedding_client.py) ===
+
+async def read_frame(reader):
+    header_length, payload_length = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+    header = json.loads(await reader.readexactly(header_length))
+    payload = await reader.readexactly(payload_length) if payload_length else b""
+    return header, payload
+
+
+def write_frame(writer, header, payload=b""):
+    header_bytes = json.dumps(header).encode("utf-8")
+    writer.write(_FRAME.pack(len(header_bytes), len(payload)) + header_bytes)
+    if payload:
+        writer.write(payload)
+
+
+def pack_images(images):
+    """PIL images -> (shapes, payload) for an encode request."""
+    arrays = [np.asarray(image.convert("RGB"), dtype=np.uint8) for image in images]
+    return [list(a.shape[:2]) for a in arrays], b"".join(a.tobytes() for a in arrays)
+
+
+def unpack_images(shapes, payload):
+    from PIL import Image
+    images, offset = [], 0
+    for height, width in shapes:
+        size = height * width * 3
+        pixels = np.frombuffer(payload, dtype=np.uint8, count=size, offset=offset)
+        images.append(Image.fromarray(pixels.reshape(height, width, 3), "RGB"))
+        offset += size
+    return images
+
+
+def parse_address(address):
+    """'host:port' -> ("tcp", host, port); anything else is a Unix socket path."""
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit() and "/" not in address:
+        return "tcp", host, int(port)
+    return "unix", address, None
+
+
+# === Server ===
+
+def _stand_in_vectors(key, items):
+    # Deterministic unit vectors seeded by the input: same input, same vector.
+    vectors = []
+    for item in items:
+        data = item.encode("utf-8") if isinstance(item, str) else np.asarray(item).tobytes()
+        seed = int.from_bytes(hashlib.sha256(data).digest()[:8], "big")
+        vector = np.random.default_rng(seed).standard_normal(STAND_IN_DIMENSIONS[key])
+        vectors.append((vector / np.linalg.norm(vector)).astype(np.float32))
+    return np.stack(vectors)
+
+
+class EmbeddingServer:
+    def __init__(self, address=EMBEDDING_SERVER_SOCKET, model_keys=None, stand_in=False,
+                 stand_in_latency_ms=0.0):
+        self.address = address
+        self.model_keys = list(model_keys or SERVING_MODELS)
+        self.stand_in = stand_in
+        self.stand_in_latency = stand_in_latency_ms / 1000
+        # One batcher per model: requests from every connected worker share it.
+        self.batchers = {
+            key: MicroBatcher(lambda items, key=key: self._encode(key, items), name=f"server-{key}")
+            for key in self.model_keys
+        }
+        self._server = None
+        self._warm_up = None
+        self._stats = {"connections": 0, "open_connections": 0, "requests": 0, "items": 0,
+                       "errors": 0}
+
+    def _encode(self, key, items):
+        if self.stand_in:
+            if self.stand_in_latency:
+                time.sleep(self.stand_in_latency)
+            return _stand_in_vectors(key, items)
+        return models.get(key).encode(items, batch_size=len(items))
+
+    def ready(self):
+        return self.stand_in or models.is_ready(self.model_keys)
+
+    def stats(self):
+        return {
+            "ready": self.ready(),
+            "stand_in": self.stand_in,
+            "models": self.model_keys if self.stand_in else {
+                key: status for key, status in models.status().items() if key in self.model_keys
+            },
+            "batchers": {key: batcher.stats() for key, batcher in self.batchers.items()},
+            **self._stats,
+        }
+
+    async def _encode_request(self, header, payload):
+        key = header.get("model")
+        if key not in self.batchers:
+            raise ValueError(f"model {key!r} is not served here (serving {self.model_keys})")
+        if "texts" in header:
+            items = list(header["texts"])
+        else:
+            items = await run_encode(unpack_images, header["shapes"], payload)
+        vectors = await asyncio.gather(*(self.batchers[key].submit(item) for item in items))
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(items), -1)
+        self._stats["requests"] += 1
+        self._stats["items"] += len(items)
+        return {"shape": list(matrix.shape)}, matrix.tobytes()
+
+    async def _respond(self, writer, lock, header, payload):
+        request_id = header.get("id")
+        try:
+            if header.get("op") == "ping":
+                response, body = {"stats": self.stats()}, b""
+            elif header.get("op") == "encode":
+                response, body = await self._encode_request(header, payload)
+            else:
+                raise ValueError(f"unknown op {header.get('op')!r}")
+            response.update({"id": request_id, "ok": True})
+        except Exception as e:
+            self._stats["errors"] += 1
+            response, body = {"id": request_id, "ok": False, "error": str(e)}, b""
+        try:
+            async with lock:
+                write_frame(writer, response, body)
+                await writer.drain()
+        except ConnectionError:
+            pass   # the worker went away; nobody is waiting for this answer
+
+    async def _handle(self, reader, writer):
+        # Requests on one connection are answered as they finish, not in order.
+        self._stats["connections"] += 1
+        self._stats["open_connections"] += 1
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                header, payload = await read_frame(reader)
+                task = asyncio.ensure_future(self._respond(writer, lock, header, payload))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._stats["open_connections"] -= 1
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def start(self):
+        kind, host, port = parse_address(self.address)
+        if kind == "tcp":
+            self._server = await asyncio.start_server(self._handle, host, port)
+        else:
+            if os.path.exists(host):
+                os.remove(host)   # left over from a previous run
+            self._server = await asyncio.start_unix_server(self._handle, host)
+        return self
+
+    async def _warm_up_models(self):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, models.warm_up, self.model_keys)
+        except Exception as e:
+            print(f"Model warm-up failed: {e}")
+
+    async def serve_forever(self):
+        await self.start()
+        mode = "stand-in vectors" if self.stand_in else ", ".join(self.model_keys)
+        print(f"Embedding server listening on {self.address} ({mode}).")
+        if not self.stand_in:
+            # Accept connections right away; until warm, requests wait for the load.
+            self._warm_up = asyncio.ensure_future(self._warm_up_models())
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for batcher in self.batchers.values():
+            await batcher.close()
+        kind, path, _ = parse_address(self.address)
+        if kind == "unix" and os.path.exists(path):
+            os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve embeddings to the API workers over a local socket.")
+    parser.add_argument("--address", default=EMBEDDING_SERVER_SOCKET,
+                        help="Unix socket path, or host:port for TCP.")
+    parser.add_argument("--models", default=",".join(SERVING_MODELS),
+                        help="Registry keys to serve (text, clip_text, image).")
+    parser.add_argument("--stand-in", action="store_true",
+                        help="Serve deterministic fake vectors instead of loading models.")
+    parser.add_argument("--stand-in-latency-ms", type=float, default=0.0,
+                        help="With --stand-in: simulated encode time per batch.")
+    args = parser.parse_args()
+
+    server = EmbeddingServer(args.address, [k for k in args.models.split(",") if k],
+                             args.stand_in, args.stand_in_latency_ms)
+
+    async def run():
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown_encode_executor()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,147 @@
-import psycopg2
+import asyncio
 import numpy as np
 import json
-from pgvector.psycopg2 import register_vector
-from sentence_transformers import SentenceTransformer
+import os
+import time
+from concurrency import MicroBatcher, run_encode
+from db_utils import async_connection, get_connection, to_asyncpg_placeholders
+from metrics import is_slow, observe_stage, record_slow_query, should_explain, stage_timer
+from search_planner import planner, plan_attempts
+from numpy_backend import get_vector_store
+from embedding_cache import EmbeddingCache
+from embedding_client import embedding_client
+from model_registry import QUERY_MODEL, embedding_namespace, models
+from vector_storage import candidate_sql, rerank_count, rerank_sql, shadow_column
 from query_analysis import analyze_query_with_llm  # Make sure this file has `system_prompt` not `system_plugin`
 
-# --- Database Connection Details ---
 
-DB_NAME = "fashion_db"
-DB_USER = "postgres"
-DB_PASSWORD = "postgres"
-DB_HOST = "localhost"
-DB_PORT = "5432"
+# Refined queries repeat a lot, so their embeddings are cached per model.
+# CLIP query vectors get a namespace of their own: uploads are cached under CLIP's.
+query_embedding_cache = EmbeddingCache(
+    namespace=embedding_namespace(models.name(QUERY_MODEL)) + (":text" if QUERY_MODEL == "clip_text" else "")
+)
+
+
+def _encode_texts(texts):
+    return models.get(QUERY_MODEL).encode(texts, batch_size=len(texts))
+
+
+# Concurrent searches share one forward pass (see concurrency.MicroBatcher).
+text_batcher = MicroBatcher(_encode_texts, name="text")
+
+# === Search Backend ===
+# 'postgres' (default) runs the searches below in the database; 'numpy' serves
+# them from the memory-mapped store built by `python numpy_backend.py export`.
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "postgres")
+# Serve /similar-by-image from product_image_neighbors when a product has a
+# precomputed list; live search is the fallback.
+USE_PRECOMPUTED_NEIGHBORS = os.environ.get("USE_PRECOMPUTED_NEIGHBORS", "1") != "0"
+# Text queries rank against this vector column (CLIP-only mode: the image embeddings).
+TEXT_SEARCH_COLUMN = "image_embedding" if QUERY_MODEL == "clip_text" else "embedding"
+# In CLIP-only mode products without an image embedding (the image failed to
+# load, or 2b_populate_image_embeddings.py hasn't run) have nothing to rank on,
+# so text searches skip them like the numpy backend's has_image mask does.
+SKIP_NULL_SEARCH_VECTORS = TEXT_SEARCH_COLUMN == "image_embedding"
+# With VECTOR_STORAGE=half|binary, index searches pick candidates on these
+# compact columns and re-rank them on the full vectors (see vector_storage.py).
+TEXT_SHADOW = shadow_column(TEXT_SEARCH_COLUMN)
+IMAGE_SHADOW = shadow_column("image_embedding")
+
+# === ANN Search Settings ===
+# Per-query recall/speed knobs for the indexes built by manage_indexes.py.
+# None keeps the server default (hnsw.ef_search = 40, ivfflat.probes = 1).
+HNSW_EF_SEARCH = int(os.environ["HNSW_EF_SEARCH"]) if os.environ.get("HNSW_EF_SEARCH") else None
+IVFFLAT_PROBES = int(os.environ["IVFFLAT_PROBES"]) if os.environ.get("IVFFLAT_PROBES") else None
+
+
+def _search_settings(ef_search=None, probes=None):
+    """(setting, value) pairs to apply for one query, falling back to the defaults above."""
+    ef_search = ef_search if ef_search is not None else HNSW_EF_SEARCH
+    probes = probes if probes is not None else IVFFLAT_PROBES
+    settings = []
+    if ef_search is not None:
+        settings.append(("hnsw.ef_search", str(int(ef_search))))
+    if probes is not None:
+        settings.append(("ivfflat.probes", str(int(probes))))
+    return settings
+
+
+def _apply_search_settings(cur, ef_search=None, probes=None):
+    # is_local = true: the setting ends with the transaction, so it never leaks
+    # into the next request that reuses this pooled connection.
+    for name, value in _search_settings(ef_search, probes):
+        cur.execute("SELECT set_config(%s, %s, true)", (name, value))
+
+
+async def _apply_search_settings_async(conn, ef_search=None, probes=None):
+    for name, value in _search_settings(ef_search, probes):
+        await conn.execute("SELECT set_config($1, $2, true)", name, value)
+
+
+# === Timed SQL ===
+# Every search statement is timed as the "sql" stage. Statements slower than
+# SLOW_QUERY_MS (see metrics.py) are logged with their EXPLAIN ANALYZE output.
+
+def _execute(cur, sql, params, ef_search=None, probes=None):
+    start = time.perf_counter()
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    duration = time.perf_counter() - start
+    observe_stage("sql", duration)
+    if is_slow(duration):
+        plan = None
+        if should_explain():
+            # Same transaction, so the same search settings are in effect.
+            cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+            plan = "\n".join(row[0] for row in cur.fetchall())
+        record_slow_query(sql, params, duration, plan)
+    return rows
+
+
+_explains = set()   # running EXPLAIN tasks, kept referenced until done
+
+
+async def _explain_async(sql, params, ef_search, probes, duration):
+    try:
+        async with async_connection() as conn, conn.transaction():
+            await _apply_search_settings_async(conn, ef_search, probes)
+            plan_rows = await conn.fetch(
+                to_asyncpg_placeholders("EXPLAIN (ANALYZE, BUFFERS) " + sql), *params
+            )
+        plan = "\n".join(row[0] for row in plan_rows)
+    except Exception as e:
+        plan = f"EXPLAIN failed: {e}"
+    record_slow_query(sql, params, duration, plan)
+
+
+async def _fetch(conn, sql, params, ef_search=None, probes=None):
+    start = time.perf_counter()
+    rows = await conn.fetch(to_asyncpg_placeholders(sql), *params)
+    duration = time.perf_counter() - start
+    observe_stage("sql", duration)
+    if is_slow(duration):
+        if should_explain():
+            # On its own connection, after this request has its rows.
+            task = asyncio.ensure_future(_explain_async(sql, params, ef_search, probes, duration))
+            _explains.add(task)
+            task.add_done_callback(_explains.discard)
+        else:
+            record_slow_query(sql, params, duration)
+    return rows
 
 
-print("Loading sentence transformer model...")
-model = SentenceTransformer('all-MiniLM-L6-v2')
-print("Model loaded.")
+def _as_int(value):
+    # The LLM sometimes returns prices as strings ("2000") or floats.
+    return int(float(value))
 
-def find_filtered_similar_products(analysis: dict, top_k: int = 5):
-    """
-    Performs a filtered semantic search in the database.
 
-    Args:
-        analysis (dict): Output from the LLM: refined query + filters.
-        top_k (int): Number of results to return.
+def build_filter_clauses(filters: dict):
+    """
+    Translates the LLM filters into SQL conditions.
 
     Returns:
-        list: List of product dictionaries.
+        tuple: (list of WHERE fragments using %s placeholders, list of params)
     """
-    refined_query = analysis['refined_query']
-    filters = analysis.get('filters', {})
-
-    # Create embedding
-    query_embedding = model.encode(refined_query)
-
-    # Build WHERE clause
     where_clauses = []
     params = []
 
@@ -59,102 +165,568 @@ def find_filtered_similar_products(analysis: dict, top_k: int = 5):
 
     if 'price_lt' in filters:
         where_clauses.append("price < %s")
-        params.append(filters['price_lt'])
+        params.append(_as_int(filters['price_lt']))
 
     if 'price_gt' in filters:
         where_clauses.append("price > %s")
-        params.append(filters['price_gt'])
+        params.append(_as_int(filters['price_gt']))
+
+    if SKIP_NULL_SEARCH_VECTORS:
+        where_clauses.append(f"{TEXT_SEARCH_COLUMN} IS NOT NULL")
+
+    return where_clauses, params
+
+
+TEXT_RESULT_COLUMNS = "id, summary, price, color, img_paths"
+# Over-fetching plans filter a candidate subquery, which must carry the filter columns.
+FILTERABLE_COLUMNS = "id, summary, price, color, img_paths, category, neckline"
+# ... including the search vector when its IS NOT NULL is one of them.
+_CANDIDATE_COLUMNS = (f"{FILTERABLE_COLUMNS}, {TEXT_SEARCH_COLUMN}" if SKIP_NULL_SEARCH_VECTORS
+                      else FILTERABLE_COLUMNS)
+
+
+def plan_text_search(filters: dict, query_embedding, top_k: int, ef_search: int = None,
+                     columns: str = TEXT_RESULT_COLUMNS):
+    """Returns the planner's choice for a text search and the SQL attempts that implement it."""
+    where_clauses, params = build_filter_clauses(filters)
+    query_embedding = np.array(query_embedding)
+    ef_search = ef_search if ef_search is not None else HNSW_EF_SEARCH
+    if TEXT_SHADOW is not None:
+        # Planned for the re-rank pool, so over-fetching aims at that many rows.
+        plan = planner.plan(filters, rerank_count(top_k), column=TEXT_SHADOW.name)
+        # Small filtered subsets are ranked exactly on the full vectors instead.
+        if plan.strategy != "exact_scan":
+            return plan, _rerank_attempts(plan, where_clauses, params, query_embedding, top_k,
+                                          columns, ef_search)
+    plan = planner.plan(filters, top_k, column=TEXT_SEARCH_COLUMN)
+    attempts = plan_attempts(
+        plan, where_clauses, params, query_embedding, top_k,
+        columns, _CANDIDATE_COLUMNS, ef_search=ef_search,
+    )
+    return plan, attempts
+
+
+def _rerank_attempts(plan, where_clauses, params, query_embedding, top_k, columns, ef_search):
+    # Each of the plan's attempts becomes the candidate pass: it ranks by the
+    # compact column and keeps rerank_count(top_k) rows, with their full
+    # vectors, which the outer query orders by exact distance.
+    candidates = rerank_count(top_k)
+    for sql, attempt_params, attempt_ef in plan_attempts(
+        plan, where_clauses, params, query_embedding, candidates,
+        f"{columns}, {TEXT_SEARCH_COLUMN}", f"{FILTERABLE_COLUMNS}, {TEXT_SEARCH_COLUMN}",
+        ef_search=ef_search, operator=TEXT_SHADOW.operator, query_sql=TEXT_SHADOW.query_sql,
+    ):
+        if plan.method == "hnsw":
+            attempt_ef = max(attempt_ef or 0, candidates)
+        yield (rerank_sql(sql, columns, TEXT_SEARCH_COLUMN),
+               attempt_params + [query_embedding, top_k], attempt_ef)
+
+
+def _text_result(row):
+    return {
+        "id": row[0],
+        "summary": row[1],
+        "price": row[2],
+        "color": row[3],
+        "image": row[4][0] if row[4] else None
+    }
+
+
+def _candidate_result(row):
+    # Rows selected with FILTERABLE_COLUMNS: the text result plus the filter columns.
+    result = _text_result(row)
+    result["category"] = row[5]
+    result["neckline"] = row[6]
+    return result
+
+
+def matches_filters(product: dict, filters: dict):
+    """In-memory twin of build_filter_clauses, for products from _candidate_result."""
+    if 'category' in filters and product["category"] != filters['category']:
+        return False
+    for column in ('color', 'neckline'):
+        if column in filters:
+            wanted = filters[column] if isinstance(filters[column], list) else [filters[column]]
+            if product[column] not in wanted:
+                return False
+    price = product["price"]
+    if 'price_lt' in filters and (price is None or price >= _as_int(filters['price_lt'])):
+        return False
+    if 'price_gt' in filters and (price is None or price <= _as_int(filters['price_gt'])):
+        return False
+    return True
+
+
+def _image_result(row):
+    return {
+        "id": row[0], "summary": row[1], "price": row[2], "color": row[3],
+        "neckline": row[4], "image": row[5][0] if row[5] else None
+    }
+
+
+SIMILAR_BY_IMAGE_SQL = """
+    SELECT id, summary, price, color, neckline, img_paths 
+    FROM products 
+    WHERE id != %s
+    ORDER BY image_embedding <=> %s 
+    LIMIT %s
+"""
+
+# Neighbor lists written by precompute_neighbors.py; one primary-key lookup.
+PRECOMPUTED_NEIGHBORS_SQL = """
+    SELECT p.id, p.summary, p.price, p.color, p.neckline, p.img_paths
+    FROM product_image_neighbors n
+    CROSS JOIN LATERAL unnest(n.neighbor_ids[1:%s]) WITH ORDINALITY AS u(id, ord)
+    JOIN products p ON p.id = u.id
+    WHERE n.product_id = %s
+    ORDER BY u.ord
+"""
+
+SIMILAR_BY_IMAGE_EMBEDDING_SQL = """
+    SELECT id, summary, price, color, neckline, img_paths 
+    FROM products 
+    ORDER BY image_embedding <=> %s 
+    LIMIT %s
+"""
+
+IMAGE_RESULT_COLUMNS = "id, summary, price, color, neckline, img_paths"
+
+
+def _image_search_query(image_embedding, top_k, ef_search=None, exclude_id=None):
+    """(sql, params, ef_search) for a live nearest-image search."""
+    image_embedding = np.array(image_embedding)
+    if IMAGE_SHADOW is None:
+        if exclude_id is None:
+            return SIMILAR_BY_IMAGE_EMBEDDING_SQL, (image_embedding, top_k), ef_search
+        return SIMILAR_BY_IMAGE_SQL, (exclude_id, image_embedding, top_k), ef_search
+    candidates = rerank_count(top_k)
+    where_sql, where_params = ("id != %s", (exclude_id,)) if exclude_id is not None else ("TRUE", ())
+    sql = rerank_sql(candidate_sql(IMAGE_SHADOW, IMAGE_RESULT_COLUMNS, where_sql),
+                     IMAGE_RESULT_COLUMNS, "image_embedding")
+    ef_search = ef_search if ef_search is not None else HNSW_EF_SEARCH
+    return (sql, where_params + (image_embedding, candidates, image_embedding, top_k),
+            max(ef_search or 0, candidates))
+
+
+def find_filtered_similar_products(analysis: dict, top_k: int = 5, ef_search: int = None,
+                                   probes: int = None):
+    """
+    Performs a filtered semantic search in the database.
+
+    Args:
+        analysis (dict): Output from the LLM: refined query + filters.
+        top_k (int): Number of results to return.
+        ef_search (int): Optional HNSW candidate list size for this query.
+        probes (int): Optional number of IVFFlat lists to probe for this query.
 
-    # Final SQL assembly
-    sql_query = "SELECT id, summary, price, color, img_paths FROM products"
-    if where_clauses:
-        sql_query += " WHERE " + " AND ".join(where_clauses)
-    sql_query += " ORDER BY embedding <=> %s LIMIT %s"
+    Returns:
+        list: List of product dictionaries.
+    """
+    refined_query = analysis['refined_query']
+    filters = analysis.get('filters', {})
 
-    # Final parameters: filters + embedding + limit
-    final_params = params + [np.array(query_embedding), top_k]
+    # Create embedding (or reuse the cached one)
+    query_embedding = query_embedding_cache.get(refined_query)
+    if query_embedding is None:
+        with stage_timer("encode_text"):
+            query_embedding = models.get(QUERY_MODEL).encode(refined_query)
+        query_embedding_cache.put(refined_query, query_embedding)
 
-    # Execute the query
+    # Execute the query, using whichever strategy suits the filters' selectivity
     results = []
     try:
-        conn = psycopg2.connect(
-            
-            dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT
-        )
-        register_vector(conn)
-        cur = conn.cursor()
-
-        cur.execute(sql_query, tuple(final_params))
-        rows = cur.fetchall()
-
-        for row in rows:
-            results.append({
-                "id": row[0],
-                "summary": row[1],
-                "price": row[2],
-                "color": row[3],
-                "image": row[4][0] if row[4] else None
-            })
+        if SEARCH_BACKEND == "numpy":
+            return get_vector_store().search_text(query_embedding, filters, top_k)
+
+        planner.ensure_fresh()
+        plan, attempts = plan_text_search(filters, query_embedding, top_k, ef_search)
+        attempt_count = 0
+        with get_connection() as conn, conn.cursor() as cur:
+            for sql_query, final_params, attempt_ef_search in attempts:
+                attempt_count += 1
+                _apply_search_settings(cur, attempt_ef_search, probes)
+                rows = _execute(cur, sql_query, tuple(final_params), attempt_ef_search, probes)
+                if len(rows) >= top_k:
+                    break
+        planner.record(plan, attempt_count)
+
+        results = [_text_result(row) for row in rows]
 
     except Exception as e:
         print(f"An error occurred during search: {e}")
-    finally:
-        if 'cur' in locals(): cur.close()
-        if 'conn' in locals(): conn.close()
 
     return results
 
 # Add this new function to 'filtered_retrieval.py'
 
-def find_similar_by_image(product_id: str, top_k: int = 5):
+_neighbor_lookups = {"precomputed": 0, "live": 0}
+
+
+def neighbor_lookup_stats():
+    return dict(_neighbor_lookups)
+
+
+def _precomputed_neighbors(conn, cur, product_id, top_k):
+    """Rows from the precomputed neighbor list, or None if there isn't a full one."""
+    try:
+        rows = _execute(cur, PRECOMPUTED_NEIGHBORS_SQL, (top_k, product_id))
+    except Exception as e:
+        # Most likely precompute_neighbors.py hasn't been run yet.
+        print(f"Precomputed neighbors unavailable: {e}")
+        conn.rollback()
+        return None
+    # Short lists (neighbors deleted since, or a top_k above the stored count)
+    # go to live search.
+    return rows if len(rows) >= top_k else None
+
+
+def find_similar_by_image(product_id: str, top_k: int = 5, ef_search: int = None,
+                          probes: int = None):
     """
     Finds visually similar products based on the image embedding of a given product.
     """
     results = []
     try:
-        conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT)
-        register_vector(conn)
-        cur = conn.cursor()
-        
-        # Step 1: Get the image embedding of the source product.
-        cur.execute("SELECT image_embedding FROM products WHERE id = %s", (product_id,))
-        source_embedding = cur.fetchone()
-        
-        if not source_embedding or source_embedding[0] is None:
-            print(f"No image embedding found for product {product_id}")
-            return []
-
-        source_vector = np.array(source_embedding[0])
-        
-        # Step 2: Find other products with the closest image embeddings.
-        # We search against the 'image_embedding' column and exclude the source product itself.
-        cur.execute(
-            """
-            SELECT id, summary, price, color, neckline, img_paths 
-            FROM products 
-            WHERE id != %s
-            ORDER BY image_embedding <=> %s 
-            LIMIT %s
-            """,
-            (product_id, source_vector, top_k)
-        )
-        
-        rows = cur.fetchall()
-        for row in rows:
-            results.append({
-                "id": row[0], "summary": row[1], "price": row[2], "color": row[3],
-                "neckline": row[4], "image": row[5][0] if row[5] else None
-            })
+        if SEARCH_BACKEND == "numpy":
+            return get_vector_store().similar_by_product(product_id, top_k)
+
+        with get_connection() as conn, conn.cursor() as cur:
+            if USE_PRECOMPUTED_NEIGHBORS:
+                rows = _precomputed_neighbors(conn, cur, product_id, top_k)
+                if rows is not None:
+                    _neighbor_lookups["precomputed"] += 1
+                    return [_image_result(row) for row in rows]
+            _neighbor_lookups["live"] += 1
+
+            # Step 1: Get the image embedding of the source product.
+            source_embedding = _execute(
+                cur, "SELECT image_embedding FROM products WHERE id = %s", (product_id,)
+            )
+
+            if not source_embedding or source_embedding[0][0] is None:
+                print(f"No image embedding found for product {product_id}")
+                return []
+
+            source_vector = np.array(source_embedding[0][0])
+
+            # Step 2: Find other products with the closest image embeddings.
+            # We search against the 'image_embedding' column and exclude the source product itself.
+            sql, params, ef_search = _image_search_query(source_vector, top_k, ef_search, product_id)
+            _apply_search_settings(cur, ef_search, probes)
+            rows = _execute(cur, sql, params, ef_search, probes)
+
+        results = [_image_result(row) for row in rows]
+
+    except Exception as e:
+        print(f"An error occurred during visual search: {e}")
+
+    return results
+
+
+def find_similar_by_image_embedding(image_embedding, top_k: int = 5, ef_search: int = None,
+                                    probes: int = None):
+    """
+    Finds the products whose image embeddings are closest to the given CLIP vector.
+    Used for uploaded images, which have no row of their own in the database.
+    """
+    if SEARCH_BACKEND == "numpy":
+        return get_vector_store().search_image(image_embedding, top_k)
+
+    sql, params, ef_search = _image_search_query(image_embedding, top_k, ef_search)
+    with get_connection() as conn, conn.cursor() as cur:
+        _apply_search_settings(cur, ef_search, probes)
+        rows = _execute(cur, sql, params, ef_search, probes)
+
+    return [_image_result(row) for row in rows]
+
+
+# === Async Variants (used by the FastAPI routes) ===
+# Same queries as above, but on the asyncpg pool. Query encoding goes through
+# the embedding server when EMBEDDING_SERVER is set, else the in-process
+# micro-batcher; NumPy scoring (for the in-process backend) runs on the
+# encoding executor, so the event loop never blocks.
+
+async def encode_query_async(text: str):
+    query_embedding = query_embedding_cache.get(text)
+    if query_embedding is None:
+        with stage_timer("encode_text"):
+            query_embedding = await embedding_client.encode_one(QUERY_MODEL, text, text_batcher.submit)
+        query_embedding_cache.put(text, query_embedding)
+    return query_embedding
+
+
+async def _search_text_rows_async(query_embedding, filters: dict, top_k: int, ef_search: int = None,
+                                  probes: int = None, columns: str = TEXT_RESULT_COLUMNS):
+    await planner.ensure_fresh_async()
+    plan, attempts = plan_text_search(filters, query_embedding, top_k, ef_search, columns)
+    attempt_count = 0
+    async with async_connection() as conn, conn.transaction():
+        for sql_query, final_params, attempt_ef_search in attempts:
+            attempt_count += 1
+            await _apply_search_settings_async(conn, attempt_ef_search, probes)
+            rows = await _fetch(conn, sql_query, final_params, attempt_ef_search, probes)
+            if len(rows) >= top_k:
+                break
+    planner.record(plan, attempt_count)
+    return rows
+
+
+async def find_filtered_similar_products_async(analysis: dict, top_k: int = 5,
+                                               ef_search: int = None, probes: int = None):
+    refined_query = analysis['refined_query']
+    filters = analysis.get('filters', {})
+
+    query_embedding = await encode_query_async(refined_query)
+
+    results = []
+    try:
+        if SEARCH_BACKEND == "numpy":
+            return await run_encode(get_vector_store().search_text, query_embedding, filters, top_k)
+
+        rows = await _search_text_rows_async(query_embedding, filters, top_k, ef_search, probes)
+        results = [_text_result(row) for row in rows]
+
+    except Exception as e:
+        print(f"An error occurred during search: {e}")
+
+    return results
+
+
+async def find_candidates_async(query_embedding, filters: dict, limit: int,
+                                ef_search: int = None, probes: int = None):
+    """
+    Like find_filtered_similar_products_async, but for a precomputed embedding
+    and with category/neckline in each dict, so the candidates can be
+    re-filtered in memory with matches_filters.
+    """
+    if SEARCH_BACKEND == "numpy":
+        return await run_encode(get_vector_store().search_text, query_embedding, filters, limit, True)
+    rows = await _search_text_rows_async(query_embedding, filters, limit, ef_search, probes,
+                                         columns=FILTERABLE_COLUMNS)
+    return [_candidate_result(row) for row in rows]
+
+
+async def _precomputed_neighbors_async(conn, product_id, top_k):
+    try:
+        # A savepoint, so a failed lookup doesn't abort the outer transaction.
+        async with conn.transaction():
+            rows = await _fetch(conn, PRECOMPUTED_NEIGHBORS_SQL, (top_k, product_id))
+    except Exception as e:
+        print(f"Precomputed neighbors unavailable: {e}")
+        return None
+    return rows if len(rows) >= top_k else None
+
+
+async def find_similar_by_image_async(product_id: str, top_k: int = 5, ef_search: int = None,
+                                      probes: int = None):
+    results = []
+    try:
+        if SEARCH_BACKEND == "numpy":
+            return await run_encode(get_vector_store().similar_by_product, product_id, top_k)
+
+        async with async_connection() as conn, conn.transaction():
+            if USE_PRECOMPUTED_NEIGHBORS:
+                rows = await _precomputed_neighbors_async(conn, product_id, top_k)
+                if rows is not None:
+                    _neighbor_lookups["precomputed"] += 1
+                    return [_image_result(row) for row in rows]
+            _neighbor_lookups["live"] += 1
+
+            source_rows = await _fetch(
+                conn, "SELECT image_embedding FROM products WHERE id = %s", (product_id,)
+            )
+            source_vector = source_rows[0][0] if source_rows else None
+            if source_vector is None:
+                print(f"No image embedding found for product {product_id}")
+                return []
+
+            sql, params, ef_search = _image_search_query(source_vector, top_k, ef_search, product_id)
+            await _apply_search_settings_async(conn, ef_search, probes)
+            rows = await _fetch(conn, sql, params, ef_search, probes)
+        results = [_image_result(row) for row in rows]
 
     except Exception as e:
         print(f"An error occurred during visual search: {e}")
-    finally:
-        if 'cur' in locals(): cur.close()
-        if 'conn' in locals(): conn.close()
-            
+
     return results
 
 
+async def find_similar_by_image_embedding_async(image_embedding, top_k: int = 5,
+                                                ef_search: int = None, probes: int = None):
+    if SEARCH_BACKEND == "numpy":
+        return await run_encode(get_vector_store().search_image, image_embedding, top_k)
+
+    sql, params, ef_search = _image_search_query(image_embedding, top_k, ef_search)
+    async with async_connection() as conn, conn.transaction():
+        await _apply_search_settings_async(conn, ef_search, probes)
+        rows = await _fetch(conn, sql, params, ef_search, probes)
+    return [_image_result(row) for row in rows]
+
+
+
+# === Batch Search ===
+# Many analyses in one go: all refined queries are encoded in a single
+# model.encode call and all lookups run as one SQL round-trip. Each query's
+# vector and filters travel as array elements, and a LATERAL subquery runs the
+# usual filtered ORDER BY ... LIMIT once per element. With VECTOR_STORAGE set,
+# that subquery is the compact candidate pass and the re-rank, like single
+# searches.
+
+_BATCH_SPEC_FILTERS = """(q.spec->>'category' IS NULL OR p.category = q.spec->>'category')
+          AND (q.spec->'color' IS NULL
+               OR p.color = ANY(ARRAY(SELECT jsonb_array_elements_text(q.spec->'color'))))
+          AND (q.spec->'neckline' IS NULL
+               OR p.neckline = ANY(ARRAY(SELECT jsonb_array_elements_text(q.spec->'neckline'))))
+          AND (q.spec->'price_lt' IS NULL OR p.price < (q.spec->>'price_lt')::int)
+          AND (q.spec->'price_gt' IS NULL OR p.price > (q.spec->>'price_gt')::int)"""
+if SKIP_NULL_SEARCH_VECTORS:
+    _BATCH_SPEC_FILTERS += f"\n          AND p.{TEXT_SEARCH_COLUMN} IS NOT NULL"
+
+
+def _batch_search_sql(shadow):
+    """
+    The batch query. Params: vector literals, filter specs, then top_k, or
+    with a shadow column rerank_count(top_k) and top_k.
+    """
+    if shadow is None:
+        lookup = f"""
+        SELECT p.id, p.summary, p.price, p.color, p.img_paths,
+               p.{TEXT_SEARCH_COLUMN} <=> q.embedding AS distance
+        FROM products p
+        WHERE {_BATCH_SPEC_FILTERS}
+        ORDER BY p.{TEXT_SEARCH_COLUMN} <=> q.embedding
+        LIMIT %s
+        """
+    else:
+        lookup = f"""
+        SELECT c.id, c.summary, c.price, c.color, c.img_paths,
+               c.{TEXT_SEARCH_COLUMN} <=> q.embedding AS distance
+        FROM (
+            SELECT p.id, p.summary, p.price, p.color, p.img_paths, p.{TEXT_SEARCH_COLUMN}
+            FROM products p
+            WHERE {_BATCH_SPEC_FILTERS}
+            ORDER BY p.{shadow.name} {shadow.operator} {shadow.expression("q.embedding")}
+            LIMIT %s
+        ) c
+        ORDER BY distance
+        LIMIT %s
+        """
+    return f"""
+    WITH q AS (
+        SELECT ord, embedding::vector AS embedding, spec::jsonb AS spec
+        FROM unnest(%s::text[], %s::text[]) WITH ORDINALITY AS u(embedding, spec, ord)
+    )
+    SELECT q.ord, r.id, r.summary, r.price, r.color, r.img_paths
+    FROM q CROSS JOIN LATERAL ({lookup}) r
+    ORDER BY q.ord, r.distance
+"""
+
+
+BATCH_SEARCH_SQL = _batch_search_sql(TEXT_SHADOW)
+
+
+def _filter_spec(filters: dict):
+    """The LLM filters in the shape BATCH_SEARCH_SQL expects (lists for multi-valued ones)."""
+    spec = {}
+    if 'category' in filters:
+        spec['category'] = str(filters['category'])
+    for column in ('color', 'neckline'):
+        if column in filters:
+            values = filters[column] if isinstance(filters[column], list) else [filters[column]]
+            spec[column] = [str(v) for v in values]
+    for bound in ('price_lt', 'price_gt'):
+        if bound in filters:
+            spec[bound] = _as_int(filters[bound])
+    return spec
+
+
+def _vector_literal(vector):
+    return "[" + ",".join(repr(float(x)) for x in vector) + "]"
+
+
+async def encode_queries_async(texts):
+    """Embeddings for `texts`, with every cache miss encoded in one model.encode call."""
+    embeddings = [query_embedding_cache.get(text) for text in texts]
+    missing = sorted({text for text, e in zip(texts, embeddings) if e is None})
+    if missing:
+        with stage_timer("encode_text"):
+            vectors = await embedding_client.encode_many(
+                QUERY_MODEL, missing, lambda items: run_encode(_encode_texts, items))
+            encoded = dict(zip(missing, vectors))
+        for text, embedding in encoded.items():
+            query_embedding_cache.put(text, embedding)
+        embeddings = [e if e is not None else encoded[text] for text, e in zip(texts, embeddings)]
+    return embeddings
+
+
+async def find_filtered_similar_products_batch_async(analyses: list, top_k: int = 5,
+                                                     ef_search: int = None, probes: int = None):
+    """
+    Runs many filtered searches at once.
+
+    Returns:
+        list: One entry per analysis, in input order: a list of product
+        dictionaries, or the exception that made that item fail.
+    """
+    results = [None] * len(analyses)
+    specs = {}
+    for i, analysis in enumerate(analyses):
+        try:
+            refined_query = analysis['refined_query']
+            if not isinstance(refined_query, str) or not refined_query.strip():
+                raise ValueError("'refined_query' must be a non-empty string")
+            specs[i] = (refined_query, _filter_spec(analysis.get('filters') or {}))
+        except (KeyError, TypeError, ValueError) as e:
+            results[i] = ValueError(f"Invalid analysis: {e!r}")
+    if not specs:
+        return results
+
+    order = list(specs)
+    embeddings = await encode_queries_async([specs[i][0] for i in order])
+
+    if SEARCH_BACKEND == "numpy":
+        store = get_vector_store()
+        for i, embedding in zip(order, embeddings):
+            results[i] = await run_encode(store.search_text, embedding, specs[i][1], top_k)
+        return results
+
+    # Filtered lookups walk an ANN index and post-filter, so give the index as
+    # many candidates as the planner would over-fetch for the most selective item.
+    await planner.ensure_fresh_async()
+    if TEXT_SHADOW is None:
+        limits = (top_k,)
+        candidates = [planner.plan(specs[i][1], top_k, column=TEXT_SEARCH_COLUMN).candidates or 0
+                      for i in order]
+    else:
+        # The candidate pass fetches the re-rank pool from the shadow index.
+        limits = (rerank_count(top_k), top_k)
+        candidates = [rerank_count(top_k)] + [
+            planner.plan(specs[i][1], rerank_count(top_k), column=TEXT_SHADOW.name).candidates or 0
+            for i in order]
+    batch_ef_search = max([ef_search or HNSW_EF_SEARCH or 0] + candidates) or None
+
+    try:
+        async with async_connection() as conn, conn.transaction():
+            await _apply_search_settings_async(conn, batch_ef_search, probes)
+            rows = await _fetch(
+                conn, BATCH_SEARCH_SQL,
+                ([_vector_literal(e) for e in embeddings],
+                 [json.dumps(specs[i][1]) for i in order],
+                 *limits),
+                batch_ef_search, probes,
+            )
+    except Exception as e:
+        print(f"An error occurred during batch search: {e}")
+        for i in order:
+            results[i] = e
+        return results
+
+    for i in order:
+        results[i] = []
+    for row in rows:
+        results[order[row[0] - 1]].append(_text_result(tuple(row)[1:]))
+    return results
+
 
 
 # --- Example Usage ---
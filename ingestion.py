@@ -0,0 +1,268 @@
+import hashlib
+import io
+import json
+import os
+import re
+import struct
+import time
+from contextlib import contextmanager
+from itertools import islice
+
+import numpy as np
+from PIL import Image
+
+# === Shared helpers for the population scripts ===
+# Streaming JSON parsing, fixed-size batching, binary COPY encoding and
+# per-stage progress reporting. Everything here works one batch at a time so
+# memory stays flat no matter how large products.json gets.
+
+PRODUCT_COLUMNS = [
+    "id", "category", "gender", "description", "summary", "neckline", "sleeve", "length",
+    "style", "fabric", "occasion", "season", "special_design", "price", "color", "img_paths",
+]
+
+
+def get_searchable_text(item):
+    """Combines key product attributes into a single string for embedding."""
+    return f"A {item['color']} {item['gender']} {item['category']} for {item['occasion']}. Style: {item['style']} with a {item['neckline']} neckline. Details: {item['summary']}"
+
+
+def text_hash(item, model_name):
+    """
+    Fingerprint of everything the text embedding depends on: the searchable
+    text and the model that embeds it.
+    """
+    data = f"{model_name}\n{get_searchable_text(item)}".encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def image_hash(image_bytes, model_name):
+    """Fingerprint of an image file's bytes and the model that embeds it."""
+    digest = hashlib.sha256(model_name.encode("utf-8") + b"\n")
+    digest.update(image_bytes)
+    return digest.hexdigest()
+
+
+def product_row(item):
+    """Product attributes in PRODUCT_COLUMNS order, cleaned up the same way as before."""
+    return [
+        item['id'], item['category'], item['gender'], item['description'], item['summary'],
+        item['neckline'], item['sleeve'], item['length'], item['style'], item['fabric'],
+        item['occasion'], item['season'], item['special_design'], item['price'],
+        item['color'].strip(), item['img_paths'],
+    ]
+
+
+# CLIP resizes the short side to 224px before center-cropping, so decoding
+# anything larger than that is wasted work.
+CLIP_INPUT_SIZE = 224
+
+
+def image_path_for(item, static_dir="static"):
+    """Local path of a product's primary image ('/img/...' lives under static/)."""
+    relative_img_path = item['img_paths'][0].lstrip('/')  # removes leading slash
+    return os.path.join(static_dir, relative_img_path)
+
+
+def load_image(source, size=CLIP_INPUT_SIZE):
+    """
+    Decodes an image (a path or a file-like object) and shrinks it so its short
+    side is `size` pixels.
+
+    JPEGs are decoded at a reduced scale directly (`draft`), which is much
+    cheaper than decoding at full resolution and resizing afterwards.
+    """
+    with Image.open(source) as image:
+        image.draft("RGB", (size, size))
+        image = image.convert("RGB")
+    short_side = min(image.size)
+    if short_side > size:
+        scale = size / short_side
+        image = image.resize(
+            (max(size, round(image.width * scale)), max(size, round(image.height * scale))),
+            Image.BICUBIC,
+        )
+    return image
+
+
+# === Incremental JSON parsing ===
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def iter_json_array(path, chunk_size=1 << 16):
+    """
+    Yields the elements of a top-level JSON array one at a time, reading the
+    file in `chunk_size` pieces instead of loading it whole.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf = ""
+        pos = 0
+        eof = False
+
+        def read_more():
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+                return False
+            buf = buf[pos:] + chunk
+            pos = 0
+            return True
+
+        # Find the opening bracket.
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos < len(buf):
+                break
+            if not read_more():
+                raise json.JSONDecodeError("Expected a JSON array", buf, pos)
+        if buf[pos] != "[":
+            raise json.JSONDecodeError("Expected a top-level JSON array", buf, pos)
+        pos += 1
+
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos >= len(buf):
+                if not read_more():
+                    raise json.JSONDecodeError("Unterminated JSON array", buf, pos)
+                continue
+            if buf[pos] == "]":
+                return
+            if buf[pos] == ",":
+                pos += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Most likely the element is cut off at the end of the buffer.
+                if not read_more():
+                    raise
+                continue
+            if end == len(buf) and not eof and read_more():
+                # A scalar at the very end of the buffer may still be growing.
+                continue
+            pos = end
+            yield item
+
+
+def batched(iterable, size):
+    """Yields lists of up to `size` items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# === Binary COPY encoding ===
+# PostgreSQL's binary COPY format: a fixed header, then per row a field count
+# followed by length-prefixed fields, then a -1 trailer.
+
+_PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_PGCOPY_TRAILER = struct.pack("!h", -1)
+_NULL_FIELD = struct.pack("!i", -1)
+_TEXT_OID = 25
+
+
+def _encode_text(value):
+    data = str(value).encode("utf-8")
+    return struct.pack("!i", len(data)) + data
+
+
+def _encode_int4(value):
+    return struct.pack("!ii", 4, int(value))
+
+
+def _encode_text_array(values):
+    values = list(values)
+    if not values:
+        body = struct.pack("!iii", 0, 0, _TEXT_OID)
+    else:
+        has_null = any(v is None for v in values)
+        parts = [struct.pack("!iiiii", 1, int(has_null), _TEXT_OID, len(values), 1)]
+        for value in values:
+            parts.append(_NULL_FIELD if value is None else _encode_text(value))
+        body = b"".join(parts)
+    return struct.pack("!i", len(body)) + body
+
+
+def _encode_vector(values):
+    # pgvector's binary format: int16 dimensions, int16 unused, float4 values.
+    array = np.asarray(values, dtype=">f4")
+    body = struct.pack("!hh", array.shape[0], 0) + array.tobytes()
+    return struct.pack("!i", len(body)) + body
+
+
+_ENCODERS = {
+    "text": _encode_text,
+    "int4": _encode_int4,
+    "text[]": _encode_text_array,
+    "vector": _encode_vector,
+}
+
+
+def encode_copy_binary(rows, column_types):
+    """Encodes rows (sequences matching `column_types`) as one binary COPY payload."""
+    encoders = [_ENCODERS[t] for t in column_types]
+    field_count = struct.pack("!h", len(encoders))
+    parts = [_PGCOPY_HEADER]
+    for row in rows:
+        parts.append(field_count)
+        for encode, value in zip(encoders, row):
+            parts.append(_NULL_FIELD if value is None else encode(value))
+    parts.append(_PGCOPY_TRAILER)
+    return b"".join(parts)
+
+
+def copy_rows_binary(cur, table, columns, column_types, rows):
+    """Streams `rows` into `table` with a single binary COPY."""
+    payload = encode_copy_binary(rows, column_types)
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT binary)",
+        io.BytesIO(payload),
+    )
+
+
+# === Progress reporting ===
+
+class PipelineProgress:
+    """
+    Tracks rows and busy time per stage and prints a one-line summary at most
+    every `report_every` seconds, plus a final summary at the end.
+    """
+
+    def __init__(self, stages, report_every=5.0):
+        self.stages = list(stages)
+        self.report_every = report_every
+        self.rows = {stage: 0 for stage in self.stages}
+        self.seconds = {stage: 0.0 for stage in self.stages}
+        self.started = time.perf_counter()
+        self._last_report = self.started
+
+    @contextmanager
+    def stage(self, name, rows):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.rows[name] += rows
+            if time.perf_counter() - self._last_report >= self.report_every:
+                self.report()
+
+    def rate(self, name):
+        seconds = self.seconds[name]
+        return self.rows[name] / seconds if seconds else 0.0
+
+    def report(self, final=False):
+        self._last_report = time.perf_counter()
+        elapsed = self._last_report - self.started
+        parts = [
+            f"{name}: {self.rows[name]:,} rows ({self.rate(name):,.0f} rows/s)"
+            for name in self.stages
+        ]
+        label = "Done" if final else "Progress"
+        print(f"  [{label} {elapsed:6.1f}s] " + " | ".join(parts))
@@ -1,35 +1,132 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from contextlib import asynccontextmanager
+import asyncio
+import json
+import time
+from typing import List, Optional
+from fastapi import BackgroundTasks, FastAPI, File, UploadFile, HTTPException, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel, Field
+import io
 import os
-import uuid
-from PIL import Image
-import numpy as np
-from sentence_transformers import SentenceTransformer
-from filtered_retrieval import find_filtered_similar_products, find_similar_by_image
-from query_analysis import analyze_query_with_llm
-import shutil
-import psycopg2
-from pgvector.psycopg2 import register_vector
+from filtered_retrieval import (
+    SEARCH_BACKEND,
+    find_filtered_similar_products_batch_async,
+    find_similar_by_image_async,
+    find_similar_by_image_embedding_async,
+    neighbor_lookup_stats,
+    query_embedding_cache,
+    text_batcher,
+)
+from query_analysis import analyze_query_async, analysis_cache, parser_path_stats
+from concurrency import MicroBatcher, run_encode, shutdown_encode_executor
+from db_utils import get_async_pool, close_async_pool, pool_stats
+from search_planner import planner
+from speculative_search import search_with_speculation, speculation_stats
+from numpy_backend import get_vector_store
+from embedding_cache import EmbeddingCache
+from embedding_client import embedding_client
+from ingestion import image_hash, load_image
+from upload_store import UploadStore
+from model_registry import (
+    EMBEDDING_BACKEND,
+    IMAGE_MODEL_NAME,
+    MODEL_WARMUP,
+    SERVING_MODELS,
+    TEXT_SEARCH_MODEL,
+    embedding_namespace,
+    models,
+)
+from metrics import REQUEST_SECONDS, register_gauge, render_metrics, slow_queries, stage_timer
 
 # === CONFIG ===
 UPLOAD_DIR = "static/uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
-DB_NAME = "fashion_db"
-DB_USER = "postgres"
-DB_PASSWORD = "postgres"
-DB_HOST = "localhost"
-DB_PORT = "5432"
+upload_store = UploadStore(UPLOAD_DIR)
+# Uploads are searched from memory; keeping a copy on disk is optional and
+# happens after the response has been sent.
+SAVE_UPLOADS = os.environ.get("SAVE_UPLOADS", "1") != "0"
+MAX_BATCH_QUERIES = int(os.environ.get("MAX_BATCH_QUERIES", "256"))
 
 # === MODEL ===
-print("Loading CLIP model for image embeddings...")
-clip_model = SentenceTransformer('clip-ViT-B-32')
-print("CLIP model loaded.")
+# CLIP (and the text model) load on first use or during the startup warm-up;
+# see model_registry.py.
+
+# Repeat uploads of the same photo are served from here, keyed by content hash.
+upload_embedding_cache = EmbeddingCache(namespace=embedding_namespace(IMAGE_MODEL_NAME))
+
+
+def _encode_images(images):
+    return models.get("image").encode(images, batch_size=len(images))
+
+
+image_batcher = MicroBatcher(_encode_images, name="image")
 
 # === FASTAPI SETUP ===
-app = FastAPI()
+# Set by the lifespan hook; GET /ready reports 503 until both are true.
+_readiness = {"backend": False, "warm_up_error": None, "embedding_server": False}
+_warm_up_task = None
+
+
+async def _warm_up_models():
+    # Runs off the event loop so the server accepts connections (and answers
+    # /ready) while the models load; a request that arrives first just waits
+    # for the same load.
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, models.warm_up, SERVING_MODELS)
+    except Exception as e:
+        _readiness["warm_up_error"] = str(e)
+        print(f"Model warm-up failed: {e}")
+
+
+def _start_warm_up():
+    # At startup without an embedding server, or the first time the client
+    # falls back to in-process encoding; either way only once per worker.
+    global _warm_up_task
+    if MODEL_WARMUP and _warm_up_task is None:
+        _warm_up_task = asyncio.ensure_future(_warm_up_models())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # With a reachable embedding server the models stay out of this worker
+    # (they only load here if the server later fails and we fall back).
+    embedding_client.on_fallback = _start_warm_up
+    if embedding_client.enabled:
+        _readiness["embedding_server"] = await embedding_client.ping() is not None
+    if not _readiness["embedding_server"]:
+        _start_warm_up()
+    if SEARCH_BACKEND == "numpy":
+        # Map the vector store before serving; no database is needed.
+        get_vector_store()
+        _readiness["backend"] = True
+    else:
+        # Open the shared pool (and its pre-warmed connections) before serving.
+        try:
+            await get_async_pool()
+            _readiness["backend"] = True
+        except Exception as e:
+            print(f"Could not open the database pool: {e}")
+    upload_store.start_janitor()
+    yield
+    if _warm_up_task is not None:
+        _warm_up_task.cancel()
+    await upload_store.stop_janitor()
+    await text_batcher.close()
+    await image_batcher.close()
+    await embedding_client.close()
+    await close_async_pool()
+    shutdown_encode_executor()
+
+
+class TimedJSONResponse(JSONResponse):
+    # Response bodies are serialized in render(); time it as its own stage.
+    def render(self, content):
+        with stage_timer("serialize"):
+            return super().render(content)
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=TimedJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -41,72 +138,315 @@ app.add_middleware(
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # The route template ("/search"), not the raw path, keeps label values bounded.
+        route = request.scope.get("route")
+        endpoint = getattr(route, "path", None) or "unmatched"
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint,
+                                method=request.method, status=str(status))
+
+
+# === GAUGES (read at scrape time by GET /metrics) ===
+
+def _pool_gauge(key):
+    def read():
+        stats = pool_stats()
+        return {"sync": stats[key], "async": stats["async"][key]}
+    return read
+
+
+register_gauge("db_pool_in_use", "Database connections checked out.", _pool_gauge("in_use"), "pool")
+register_gauge("db_pool_idle", "Idle database connections.", _pool_gauge("idle"), "pool")
+register_gauge("encode_queue_depth", "Inputs waiting for the encoder.",
+               lambda: {"text": text_batcher.stats()["queue_depth"],
+                        "image": image_batcher.stats()["queue_depth"]}, "model")
+register_gauge("cache_hit_rate", "Hit rate of each cache since startup.",
+               lambda: {"analysis": analysis_cache.stats()["hit_rate"],
+                        "text_embedding": query_embedding_cache.stats()["hit_rate"],
+                        "upload_embedding": upload_embedding_cache.stats()["hit_rate"]}, "cache")
+
+# === HELPERS ===
+
+def _save_upload(data, ext):
+    try:
+        upload_store.save(data, ext)
+    except OSError as e:
+        print(f"Could not save upload: {e}")
+
+
+async def _encode_upload(data, digest):
+    image_embedding = upload_embedding_cache.get(digest)
+    if image_embedding is None:
+        # Decoding (downscaled to CLIP's input size) blocks, so it runs off the
+        # event loop; the forward pass is batched with other concurrent uploads.
+        with stage_timer("image_decode"):
+            image = await run_encode(load_image, io.BytesIO(data))
+        with stage_timer("encode_image"):
+            image_embedding = await embedding_client.encode_one("image", image, image_batcher.submit)
+        upload_embedding_cache.put(digest, image_embedding)
+    return image_embedding
+
+
+class BatchSearchItem(BaseModel):
+    # Either a raw query (analyzed like /search) or a pre-built analysis
+    # ({"refined_query": ..., "filters": {...}}), which skips the LLM.
+    query: Optional[str] = None
+    analysis: Optional[dict] = None
+
+
+class BatchSearchRequest(BaseModel):
+    items: List[BatchSearchItem]
+    top_k: int = Field(5, ge=1, le=100)
+    ef_search: Optional[int] = None
+    probes: Optional[int] = None
+
+
+async def _batch_item_analysis(item):
+    if item.analysis is not None:
+        return item.analysis
+    if item.query:
+        return await analyze_query_async(item.query)
+    raise ValueError("Each item needs a 'query' or an 'analysis'")
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _search_events(query, deadline_ms, ef_search, probes):
+    """
+    Server-Sent Events for one search: "analysis" as soon as the filters are
+    known; "products" with "final": false as soon as the speculative search
+    returns, if that is before the analysis; then "products" with
+    "final": true (the complete list, replacing any earlier one) and "done".
+    """
+    started = time.perf_counter()
+
+    def elapsed_ms():
+        return round(1000 * (time.perf_counter() - started), 1)
+
+    events = asyncio.Queue()
+
+    async def on_analysis(analysis):
+        await events.put(("analysis", {"analysis": analysis, "elapsed_ms": elapsed_ms()}))
+
+    async def on_candidates(products):
+        await events.put(("products", {"products": products, "final": False,
+                                       "elapsed_ms": elapsed_ms()}))
+
+    search = asyncio.ensure_future(search_with_speculation(
+        query, deadline_ms=deadline_ms, ef_search=ef_search, probes=probes,
+        on_analysis=on_analysis, on_candidates=on_candidates,
+    ))
+    search.add_done_callback(lambda _: events.put_nowait(None))
+    try:
+        while True:
+            item = await events.get()
+            if item is None:
+                break
+            yield _sse(*item)
+
+        try:
+            _, products, outcome = search.result()
+        except Exception as e:
+            yield _sse("error", {"detail": str(e)})
+            return
+        if outcome == "deadline":
+            yield _sse("analysis", {"analysis": None, "elapsed_ms": elapsed_ms()})
+        yield _sse("products", {"products": products, "final": True, "elapsed_ms": elapsed_ms()})
+        yield _sse("done", {"response_text": "Here are some results:", "search_path": outcome,
+                            "elapsed_ms": elapsed_ms()})
+    finally:
+        # The client may have disconnected mid-stream.
+        search.cancel()
+
+
 # === ROUTES ===
 
 @app.post("/search")
-async def search_products(query: str = Form(...)):
+async def search_products(query: str = Form(...), ef_search: Optional[int] = Form(None),
+                          probes: Optional[int] = Form(None),
+                          deadline_ms: Optional[float] = Form(None)):
     try:
-        analysis = analyze_query_with_llm(query)
-        products = find_filtered_similar_products(analysis)
-        return {"response_text": "Here are some results:", "products": products}
+        # Retrieval starts alongside the LLM analysis; see speculative_search.py.
+        _, products, outcome = await search_with_speculation(
+            query, deadline_ms=deadline_ms, ef_search=ef_search, probes=probes
+        )
+        return {"response_text": "Here are some results:", "products": products,
+                "search_path": outcome}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/search/stream")
+async def search_products_stream(query: str = Form(...), ef_search: Optional[int] = Form(None),
+                                 probes: Optional[int] = Form(None),
+                                 deadline_ms: Optional[float] = Form(None)):
+    return StreamingResponse(
+        _search_events(query, deadline_ms, ef_search, probes),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/search/batch")
+async def search_products_batch(request: BatchSearchRequest):
+    if len(request.items) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400,
+                            detail=f"At most {MAX_BATCH_QUERIES} items per batch")
+
+    analyses = await asyncio.gather(
+        *(_batch_item_analysis(item) for item in request.items), return_exceptions=True
+    )
+    searchable = [i for i, a in enumerate(analyses) if not isinstance(a, Exception)]
+    found = await find_filtered_similar_products_batch_async(
+        [analyses[i] for i in searchable], top_k=request.top_k,
+        ef_search=request.ef_search, probes=request.probes,
+    )
+    products = dict(zip(searchable, found))
+
+    results = []
+    for i, item in enumerate(request.items):
+        outcome = products.get(i, analyses[i])
+        if isinstance(outcome, Exception):
+            results.append({"query": item.query, "error": str(outcome)})
+        else:
+            results.append({"query": item.query, "analysis": analyses[i], "products": outcome})
+    return {"results": results}
+
+
 @app.post("/similar-by-image")
-async def similar_by_image(product_id: str = Form(...)):
+async def similar_by_image(product_id: str = Form(...), ef_search: Optional[int] = Form(None),
+                           probes: Optional[int] = Form(None)):
     try:
-        products = find_similar_by_image(product_id)
+        products = await find_similar_by_image_async(
+            product_id, ef_search=ef_search, probes=probes
+        )
         return {"response_text": "Products visually similar to this:", "products": products}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/upload-and-search")
-async def upload_and_search(file: UploadFile = File(...)):
+async def upload_and_search(background_tasks: BackgroundTasks, file: UploadFile = File(...),
+                            ef_search: Optional[int] = Form(None),
+                            probes: Optional[int] = Form(None)):
     try:
         ext = file.filename.split(".")[-1].lower()
         if ext not in ["jpg", "jpeg", "png"]:
             raise HTTPException(status_code=400, detail="Only jpg, jpeg, png files allowed")
 
-        filename = f"{uuid.uuid4().hex}.{ext}"
-        image_path = os.path.join(UPLOAD_DIR, filename)
-
-        with open(image_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        data = await file.read()
+        digest = image_hash(data, IMAGE_MODEL_NAME)
+        image_embedding = await _encode_upload(data, digest)
 
-        image = Image.open(image_path)
-        image_embedding = clip_model.encode(image)
+        if SAVE_UPLOADS:
+            background_tasks.add_task(_save_upload, data, ext)
 
         # Search similar from DB
-        conn = psycopg2.connect(
-            dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT
-        )
-        register_vector(conn)
-        cur = conn.cursor()
-
-        cur.execute(
-            """
-            SELECT id, summary, price, color, neckline, img_paths 
-            FROM products 
-            ORDER BY image_embedding <=> %s 
-            LIMIT 5
-            """,
-            (np.array(image_embedding),)
+        results = await find_similar_by_image_embedding_async(
+            image_embedding, ef_search=ef_search, probes=probes
         )
-        rows = cur.fetchall()
-
-        results = []
-        for row in rows:
-            results.append({
-                "id": row[0], "summary": row[1], "price": row[2], "color": row[3],
-                "neckline": row[4], "image": row[5][0] if row[5] else None
-            })
-
-        cur.close()
-        conn.close()
 
         return {"response_text": "Results based on uploaded image:", "products": results}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/pool-stats")
+async def get_pool_stats():
+    return pool_stats()
+
+
+@app.get("/analysis-cache-stats")
+async def get_analysis_cache_stats():
+    return analysis_cache.stats()
+
+
+@app.get("/embedding-cache-stats")
+async def get_embedding_cache_stats():
+    return {"text": query_embedding_cache.stats(), "upload": upload_embedding_cache.stats()}
+
+
+@app.get("/upload-stats")
+async def get_upload_stats():
+    return upload_store.stats()
+
+
+@app.get("/neighbor-stats")
+async def get_neighbor_stats():
+    return neighbor_lookup_stats()
+
+
+@app.get("/speculation-stats")
+async def get_speculation_stats():
+    return speculation_stats()
+
+
+@app.get("/encoder-stats")
+async def get_encoder_stats():
+    return {"text": text_batcher.stats(), "image": image_batcher.stats(),
+            "remote": embedding_client.stats()}
+
+
+@app.get("/parser-stats")
+async def get_parser_stats():
+    return parser_path_stats()
+
+
+@app.get("/planner-stats")
+async def get_planner_stats():
+    return planner.stats()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/slow-queries")
+async def get_slow_queries():
+    return slow_queries()
+
+
+@app.get("/ready")
+async def get_ready():
+    # Models count as ready once warmed up, here or in the embedding server;
+    # with MODEL_WARMUP=0 they load lazily, so only the search backend is checked.
+    # A failed ping starts the local warm-up, so a worker that lost its server
+    # turns ready again once it can encode in-process.
+    server = await embedding_client.ping() if embedding_client.enabled else None
+    models_ready = (bool(server and server.get("ready")) or models.is_ready(SERVING_MODELS)
+                    or not MODEL_WARMUP)
+    if not _readiness["backend"] and SEARCH_BACKEND != "numpy":
+        # The database may have been down at startup; the pool opens lazily.
+        try:
+            await get_async_pool()
+            _readiness["backend"] = True
+        except Exception:
+            pass
+    ready = models_ready and _readiness["backend"]
+    body = {
+        "ready": ready,
+        "backend": SEARCH_BACKEND,
+        "backend_ready": _readiness["backend"],
+        "embedding_backend": EMBEDDING_BACKEND,
+        "text_search_model": TEXT_SEARCH_MODEL,
+        "models": {key: status for key, status in models.status().items() if key in SERVING_MODELS},
+        "warm_up_error": _readiness["warm_up_error"],
+        "embedding_server": {"address": embedding_client.address, "stats": server}
+        if embedding_client.enabled else None,
+    }
+    return JSONResponse(body, status_code=200 if ready else 503)
@@ -0,0 +1,252 @@
+import argparse
+import json
+import math
+import re
+import time
+from db_utils import connect
+from vector_storage import shadow_columns
+
+# === ANN index management for the vector columns ===
+# Builds, rebuilds and drops HNSW / IVFFlat indexes on 'embedding' and
+# 'image_embedding'. Everything runs with CREATE/DROP INDEX CONCURRENTLY so the
+# API keeps serving (and writing) while an index is being built.
+#
+# Examples:
+#   python manage_indexes.py build --column all --method hnsw --m 16 --ef-construction 64
+#   python manage_indexes.py build --column embedding --method ivfflat --lists 100
+#   python manage_indexes.py rebuild --column image_embedding --method hnsw --m 32
+#   python manage_indexes.py drop --column all --method hnsw
+#   python manage_indexes.py build --column embedding --facet category=Dresses
+#   python manage_indexes.py status
+#
+# The compact shadow columns from vector_storage.py (e.g. embedding_half,
+# image_embedding_bin) can be indexed the same way, with their own opclass.
+#
+# --facet builds a partial index covering only rows with that attribute value.
+# The search planner uses such an index for queries filtered on a hot facet,
+# where the full index would return too few matching rows.
+
+TABLE = "products"
+VECTOR_COLUMNS = ["embedding", "image_embedding"]
+# Searches use `<=>`, i.e. cosine distance.
+OPCLASS = "vector_cosine_ops"
+SHADOW_OPCLASSES = {shadow.name: shadow.opclass for shadow in shadow_columns()}
+
+
+FACET_COLUMNS = ["category", "color", "neckline"]
+
+
+def index_name(column, method, suffix=""):
+    return f"{TABLE}_{column}_{method}{suffix}_idx"
+
+
+def parse_facet(text):
+    column, sep, value = text.partition("=")
+    if not sep or column not in FACET_COLUMNS or not value:
+        raise argparse.ArgumentTypeError(
+            f"--facet must look like column=value with column in {FACET_COLUMNS}"
+        )
+    return column, value
+
+
+def facet_suffix(facet):
+    if not facet:
+        return ""
+    slug = re.sub(r"[^a-z0-9]+", "_", facet[1].lower()).strip("_")
+    return f"_{facet[0]}_{slug}"
+
+
+def default_lists(row_count):
+    # pgvector's guidance: rows / 1000 up to 1M rows, sqrt(rows) beyond that.
+    if row_count <= 1_000_000:
+        return max(1, row_count // 1000)
+    return int(math.sqrt(row_count))
+
+
+def _index_options(args, row_count):
+    if args.method == "hnsw":
+        return {"m": args.m, "ef_construction": args.ef_construction}
+    return {"lists": args.lists or default_lists(row_count)}
+
+
+def _create_index_sql(name, column, method, options, where=None):
+    with_clause = ", ".join(f"{key} = {int(value)}" for key, value in options.items())
+    sql = (
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} "
+        f"ON {TABLE} USING {method} ({column} {SHADOW_OPCLASSES.get(column, OPCLASS)}) "
+        f"WITH ({with_clause})"
+    )
+    if where:
+        sql += f" WHERE {where}"
+    return sql
+
+
+def _apply_build_settings(cur, args):
+    if args.maintenance_work_mem:
+        cur.execute("SET maintenance_work_mem = %s", (args.maintenance_work_mem,))
+    if args.parallel_workers is not None:
+        cur.execute("SET max_parallel_maintenance_workers = %s", (args.parallel_workers,))
+
+
+def _row_count(cur, column, facet=None):
+    sql = f"SELECT count(*) FROM {TABLE} WHERE {column} IS NOT NULL"
+    params = ()
+    if facet:
+        sql += f" AND {facet[0]} = %s"
+        params = (facet[1],)
+    cur.execute(sql, params)
+    return cur.fetchone()[0]
+
+
+def _index_size(cur, name):
+    cur.execute("SELECT pg_size_pretty(pg_relation_size(%s::regclass))", (name,))
+    return cur.fetchone()[0]
+
+
+def _is_valid(cur, name):
+    cur.execute(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = %s",
+        (name,),
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def build_index(cur, column, args, name=None):
+    """Creates one index concurrently and records its parameters and build time."""
+    facet = args.facet
+    name = name or index_name(column, args.method, facet_suffix(facet))
+    # A failed CONCURRENTLY build leaves an invalid index behind; IF NOT EXISTS
+    # would then silently skip the build, so clean it up first.
+    valid = _is_valid(cur, name)
+    if valid is False:
+        print(f"Dropping invalid leftover index {name}...")
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    elif valid:
+        # Its comment describes how it was really built; keep it. New
+        # parameters go through `rebuild`.
+        print(f"  ⏭️ {name} already exists; use rebuild to change its parameters.")
+        return name
+
+    rows = _row_count(cur, column, facet)
+    options = _index_options(args, rows)
+    print(f"Building {args.method} index {name} on {column} ({rows} rows, {options})...")
+
+    where = None
+    if facet:
+        where = cur.mogrify(f"{facet[0]} = %s", (facet[1],)).decode()
+
+    start = time.perf_counter()
+    cur.execute(_create_index_sql(name, column, args.method, options, where))
+    build_seconds = time.perf_counter() - start
+
+    details = {"method": args.method, "options": options,
+               "rows": rows, "build_seconds": round(build_seconds, 3)}
+    if facet:
+        details["facet"] = {"column": facet[0], "value": facet[1]}
+    comment = json.dumps(details)
+    cur.execute(f"COMMENT ON INDEX {name} IS %s", (comment,))
+    print(f"  ✅ {name} built in {build_seconds:.1f}s, size {_index_size(cur, name)}")
+    return name
+
+
+def drop_index(cur, name):
+    start = time.perf_counter()
+    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    print(f"  🗑️ Dropped {name} ({time.perf_counter() - start:.1f}s)")
+
+
+def rebuild_index(cur, column, args):
+    """
+    Builds the replacement under a temporary name, then swaps it in, so there
+    is never a moment without an index.
+    """
+    suffix = facet_suffix(args.facet)
+    name = index_name(column, args.method, suffix)
+    new_name = index_name(column, args.method, suffix + "_new")
+    drop_index(cur, new_name)
+    build_index(cur, column, args, name=new_name)
+    drop_index(cur, name)
+    cur.execute(f"ALTER INDEX {new_name} RENAME TO {name}")
+    print(f"  🔁 {new_name} renamed to {name}")
+
+
+def show_status(cur):
+    cur.execute(
+        """
+        SELECT c.relname, am.amname, i.indisvalid,
+               pg_size_pretty(pg_relation_size(c.oid)), obj_description(c.oid, 'pg_class'),
+               pg_get_indexdef(c.oid)
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_am am ON am.oid = c.relam
+        WHERE i.indrelid = %s::regclass AND am.amname IN ('hnsw', 'ivfflat')
+        ORDER BY c.relname
+        """,
+        (TABLE,),
+    )
+    rows = cur.fetchall()
+    if not rows:
+        print("No vector indexes found: searches will use sequential scans.")
+        return
+    for name, method, valid, size, comment, definition in rows:
+        details = json.loads(comment) if comment else {}
+        status = "valid" if valid else "INVALID"
+        print(f"{name}: {method}, {size}, {status}")
+        if details:
+            facet = details.get("facet")
+            facet_text = f" facet={facet['column']}={facet['value']!r}" if facet else ""
+            print(f"    options={details.get('options')} rows={details.get('rows')} "
+                  f"build_seconds={details.get('build_seconds')}{facet_text}")
+        print(f"    {definition}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage ANN indexes on the product vector columns.")
+    parser.add_argument("command", choices=["build", "rebuild", "drop", "status"])
+    parser.add_argument("--column", choices=VECTOR_COLUMNS + list(SHADOW_OPCLASSES) + ["all"],
+                        default="all")
+    parser.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+    parser.add_argument("--m", type=int, default=16, help="HNSW: max connections per layer.")
+    parser.add_argument("--ef-construction", type=int, default=64,
+                        help="HNSW: candidate list size while building.")
+    parser.add_argument("--lists", type=int, default=None,
+                        help="IVFFlat: number of lists (default: derived from row count).")
+    parser.add_argument("--maintenance-work-mem", default=None,
+                        help="e.g. '1GB'; HNSW builds are much faster when the graph fits.")
+    parser.add_argument("--parallel-workers", type=int, default=None,
+                        help="max_parallel_maintenance_workers for the build.")
+    parser.add_argument("--facet", type=parse_facet, default=None,
+                        help="Partial index for one attribute value, e.g. category=Dresses.")
+    args = parser.parse_args()
+
+    columns = VECTOR_COLUMNS if args.column == "all" else [args.column]
+
+    try:
+        conn = connect()
+        # CREATE/DROP INDEX CONCURRENTLY cannot run inside a transaction block.
+        conn.autocommit = True
+        cur = conn.cursor()
+
+        if args.command == "status":
+            show_status(cur)
+            return
+        _apply_build_settings(cur, args)
+        for column in columns:
+            if args.command == "build":
+                build_index(cur, column, args)
+            elif args.command == "rebuild":
+                rebuild_index(cur, column, args)
+            elif args.command == "drop":
+                drop_index(cur, index_name(column, args.method, facet_suffix(args.facet)))
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        if 'cur' in locals(): cur.close()
+        if 'conn' in locals(): conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# === Hot-path instrumentation ===
+# Histograms and counters kept in process and rendered in the Prometheus text
+# format by GET /metrics (no client library needed):
+#   search_stage_seconds{stage}          rules, llm, encode_text, encode_image,
+#                                        image_decode, pool_acquire, sql, serialize
+#   http_request_duration_seconds{endpoint,method,status}
+#   llm_fallbacks_total{reason}          analyses that fell back to the raw query
+#   slow_queries_total                   SQL statements over SLOW_QUERY_MS
+# Gauges (pool sizes, queue depths, cache hit rates) are read from callbacks at
+# scrape time. SQL statements slower than SLOW_QUERY_MS are re-run with
+# EXPLAIN ANALYZE and kept in a small ring buffer (GET /slow-queries).
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+SLOW_QUERY_MS = float(os.environ["SLOW_QUERY_MS"]) if os.environ.get("SLOW_QUERY_MS") else None
+SLOW_QUERY_LOG_SIZE = int(os.environ.get("SLOW_QUERY_LOG_SIZE", "50"))
+# At most one EXPLAIN ANALYZE per this many seconds: it runs the query again.
+SLOW_QUERY_COOLDOWN = float(os.environ.get("SLOW_QUERY_COOLDOWN", "10"))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}   # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        for key, series in items:
+            for bound, count in zip(self.buckets, series):
+                labels = _format_labels(self.labels, key, [("le", repr(bound))])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labels, key, [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "search_stage_seconds", "Time spent in each stage of a request.", labels=("stage",)
+)
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "End-to-end request latency per endpoint.",
+    labels=("endpoint", "method", "status"),
+)
+LLM_FALLBACKS = Counter(
+    "llm_fallbacks_total", "Query analyses that fell back to the raw query.", labels=("reason",)
+)
+SLOW_QUERIES = Counter("slow_queries_total", "SQL statements slower than SLOW_QUERY_MS.")
+
+_metrics = [STAGE_SECONDS, REQUEST_SECONDS, LLM_FALLBACKS, SLOW_QUERIES]
+_gauges = []   # (name, help, callback returning a number or {label value: number}, label)
+
+
+def stage_timer(stage):
+    """`with stage_timer("sql"): ...` records the block's duration for that stage."""
+    return STAGE_SECONDS.time(stage=stage)
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def register_gauge(name, help_text, callback, label=None):
+    _gauges.append((name, help_text, callback, label))
+
+
+def render_metrics():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for name, help_text, callback, label in _gauges:
+        try:
+            value = callback()
+        except Exception:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        if isinstance(value, dict):
+            for label_value, number in sorted(value.items()):
+                lines.append(f"{name}{_format_labels((label,), (label_value,))} {number}")
+        else:
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# === Slow queries ===
+
+_slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+_slow_lock = threading.Lock()
+_last_explain = 0.0
+
+
+def is_slow(seconds):
+    return SLOW_QUERY_MS is not None and seconds * 1000 >= SLOW_QUERY_MS
+
+
+def should_explain():
+    """True at most once per SLOW_QUERY_COOLDOWN seconds."""
+    global _last_explain
+    with _slow_lock:
+        now = time.monotonic()
+        if now - _last_explain < SLOW_QUERY_COOLDOWN:
+            return False
+        _last_explain = now
+        return True
+
+
+def describe_params(params):
+    # Query vectors are long and meaningless in a log; keep their size only.
+    described = []
+    for value in params:
+        if hasattr(value, "shape") and getattr(value, "ndim", 0) >= 1:
+            described.append(f"<vector dim={value.shape[-1]}>")
+        elif isinstance(value, (list, tuple)) and len(value) > 10:
+            described.append(f"<list len={len(value)}>")
+        elif isinstance(value, str) and len(value) > 200:
+            described.append(value[:200] + "...")
+        elif value is None or isinstance(value, (str, int, float, bool)):
+            described.append(value)
+        else:
+            described.append(str(value))
+    return described
+
+
+def record_slow_query(sql, params, seconds, plan=None):
+    SLOW_QUERIES.inc()
+    entry = {
+        "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "duration_ms": round(seconds * 1000, 1),
+        "sql": " ".join(sql.split()),
+        "params": describe_params(params),
+        "plan": plan,
+    }
+    with _slow_lock:
+        _slow_queries.append(entry)
+    print(f"[slow-query] {entry['duration_ms']} ms: {entry['sql'][:200]}")
+
+
+def slow_queries():
+    with _slow_lock:
+        return list(_slow_queries)
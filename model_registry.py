@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+
+# === Model Registry ===
+# Models are loaded on first use instead of at import, so importing the API
+# (or a test, or a script that only needs the helpers) stays fast. Each model
+# has its own lock: concurrent first callers wait for one load rather than
+# loading twice, and loading one model never blocks the other.
+#
+# warm_up() loads the models and runs a dummy forward pass through each, so
+# the first real request doesn't pay for lazy initialisation inside torch
+# either. The API runs it in the background at startup (MODEL_WARMUP=0 turns
+# that off) and reports readiness on GET /ready.
+#
+# EMBEDDING_BACKEND picks the runtime: "torch" (SentenceTransformer) or "onnx"
+# (onnxruntime on graphs exported by onnx_backend.py, int8 unless
+# ONNX_QUANTIZED=0).
+#
+# TEXT_SEARCH_MODEL=clip is the single-model mode: /search encodes queries
+# with CLIP's text tower and ranks them against the image embeddings, so a
+# worker only ever loads CLIP. The default ("minilm") keeps MiniLM against
+# the text embeddings. SERVING_MODELS lists what the API actually needs.
+
+TEXT_MODEL_NAME = 'all-MiniLM-L6-v2'
+IMAGE_MODEL_NAME = 'clip-ViT-B-32'
+MODEL_WARMUP = os.environ.get("MODEL_WARMUP", "1") != "0"
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch")
+TEXT_SEARCH_MODEL = os.environ.get("TEXT_SEARCH_MODEL", "minilm")
+# Registry key of the model that encodes search queries.
+QUERY_MODEL = "clip_text" if TEXT_SEARCH_MODEL == "clip" else "text"
+SERVING_MODELS = [QUERY_MODEL, "image"]
+
+
+def _load_sentence_transformer(name):
+    # Imported here: sentence_transformers pulls in torch, which alone takes seconds.
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(name)
+
+
+def _load_model(name):
+    if EMBEDDING_BACKEND == "onnx":
+        from onnx_backend import load_onnx_encoder
+        return load_onnx_encoder(name)
+    return _load_sentence_transformer(name)
+
+
+def _load_clip_text(name):
+    # PyTorch's CLIP encodes text and images alike, so share the loaded model;
+    # the ONNX export keeps the text tower in a graph of its own.
+    if EMBEDDING_BACKEND == "onnx":
+        from onnx_backend import load_onnx_encoder
+        return load_onnx_encoder(name, variant="text")
+    return models.get("image")
+
+
+def embedding_namespace(name):
+    """
+    Cache namespace for vectors from `name` under the configured backend:
+    quantized vectors differ slightly, so they never share cache entries.
+    """
+    if EMBEDDING_BACKEND == "onnx":
+        from onnx_backend import ONNX_QUANTIZED
+        return f"{name}:onnx-int8" if ONNX_QUANTIZED else f"{name}:onnx"
+    return name
+
+
+def _warm_up_text(model):
+    model.encode(["warm up"], batch_size=1)
+
+
+def _warm_up_image(model):
+    from PIL import Image
+    from ingestion import CLIP_INPUT_SIZE
+    model.encode([Image.new("RGB", (CLIP_INPUT_SIZE, CLIP_INPUT_SIZE))], batch_size=1)
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def register(self, key, name, loader, warm_up=None):
+        """`loader(name)` builds the model; `warm_up(model)` runs one dummy forward pass."""
+        with self._lock:
+            self._entries[key] = {
+                "name": name,
+                "loader": loader,
+                "warm_up": warm_up,
+                "lock": threading.Lock(),
+                "model": None,
+                "warm": False,
+                "load_seconds": None,
+                "warm_up_seconds": None,
+                "error": None,
+            }
+
+    def get(self, key):
+        """Returns the model, loading it on first use."""
+        entry = self._entries[key]
+        model = entry["model"]
+        if model is not None:
+            return model
+        with entry["lock"]:
+            if entry["model"] is None:
+                print(f"Loading {entry['name']}...")
+                start = time.perf_counter()
+                try:
+                    entry["model"] = entry["loader"](entry["name"])
+                except Exception as e:
+                    entry["error"] = str(e)
+                    raise
+                entry["load_seconds"] = round(time.perf_counter() - start, 3)
+                entry["error"] = None
+                print(f"{entry['name']} loaded in {entry['load_seconds']:.1f}s.")
+            return entry["model"]
+
+    def name(self, key):
+        return self._entries[key]["name"]
+
+    def warm_up(self, keys=None):
+        """Loads the given models (default: all) and runs a dummy forward pass through each."""
+        for key in keys or list(self._entries):
+            entry = self._entries[key]
+            model = self.get(key)
+            if entry["warm"]:
+                continue
+            with entry["lock"]:
+                if entry["warm"]:
+                    continue
+                start = time.perf_counter()
+                if entry["warm_up"] is not None:
+                    try:
+                        entry["warm_up"](model)
+                    except Exception as e:
+                        entry["error"] = str(e)
+                        raise
+                entry["warm_up_seconds"] = round(time.perf_counter() - start, 3)
+                entry["warm"] = True
+
+    def is_ready(self, keys=None):
+        return all(self._entries[key]["warm"] for key in keys or self._entries)
+
+    def status(self):
+        return {
+            key: {
+                "model": entry["name"],
+                "loaded": entry["model"] is not None,
+                "warm": entry["warm"],
+                "load_seconds": entry["load_seconds"],
+                "warm_up_seconds": entry["warm_up_seconds"],
+                "error": entry["error"],
+            }
+            for key, entry in self._entries.items()
+        }
+
+
+models = ModelRegistry()
+models.register("text", TEXT_MODEL_NAME, _load_model, _warm_up_text)
+models.register("image", IMAGE_MODEL_NAME, _load_model, _warm_up_image)
+models.register("clip_text", IMAGE_MODEL_NAME, _load_clip_text, _warm_up_text)
@@ -0,0 +1,378 @@
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from model_registry import IMAGE_MODEL_NAME, QUERY_MODEL, TEXT_MODEL_NAME, models
+
+# === In-process vector search ===
+# Serves the same searches as filtered_retrieval.py without PostgreSQL, for
+# edge deployments and tests. The catalog is exported once into
+# VECTOR_STORE_DIR:
+#   text.npy, image.npy   L2-normalized embedding matrices (float32 or float16),
+#                         memory-mapped so workers share them via the page cache
+#   has_text.npy, has_image.npy
+#                         rows that actually have an embedding
+#   price.npy             float32, NaN where unknown
+#   category.npy, color.npy, neckline.npy
+#                         int32 codes into the vocabularies in meta.json (-1 = NULL)
+#   meta.json             ids, summaries, image paths, vocabularies, models
+# Filters become boolean masks, cosine distance on normalized vectors is a
+# single matrix-vector product, and argpartition picks the exact top-k without
+# sorting every score.
+#
+# Build a store with:
+#   python numpy_backend.py export                    # from the products table
+#   python numpy_backend.py export --source json      # encode products.json locally
+#   python numpy_backend.py export --dtype float16    # half the memory
+# and serve from it with SEARCH_BACKEND=numpy.
+
+VECTOR_STORE_DIR = os.environ.get("VECTOR_STORE_DIR", "vector_store")
+# float16 matrices are scored in float32 chunks of this many rows, so a query
+# never materializes a full-precision copy of the matrix.
+SCORE_CHUNK_ROWS = int(os.environ.get("SCORE_CHUNK_ROWS", "65536"))
+FACET_COLUMNS = ("category", "color", "neckline")
+# Text queries rank against this matrix (CLIP-only mode: the image embeddings).
+TEXT_SEARCH_MATRIX = "image" if QUERY_MODEL == "clip_text" else "text"
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _as_int(value):
+    # The LLM sometimes returns prices as strings ("2000") or floats.
+    return int(float(value))
+
+
+class VectorStore:
+    """Read-only, memory-mapped copy of the products table for exact vector search."""
+
+    def __init__(self, path=VECTOR_STORE_DIR, mmap=True):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        mode = "r" if mmap else None
+
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode)
+
+        self.meta = meta
+        self.ids = meta["ids"]
+        self.summaries = meta["summaries"]
+        self.colors = meta["colors"]
+        self.necklines = meta["necklines"]
+        self.img_paths = meta["img_paths"]
+        self.text = load("text")
+        self.image = load("image")
+        # Masks and columns are small; keep them in memory.
+        self.has_text = np.asarray(load("has_text"))
+        self.has_image = np.asarray(load("has_image"))
+        self.price = np.asarray(load("price"))
+        self.facets = {column: np.asarray(load(column)) for column in FACET_COLUMNS}
+        self.vocab = {column: {value: code for code, value in enumerate(meta["vocab"][column])}
+                      for column in FACET_COLUMNS}
+        self._rows = {product_id: row for row, product_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    # --- Filtering ---
+
+    def _facet_mask(self, column, value):
+        codes = [self.vocab[column][v] for v in _as_list(value) if v in self.vocab[column]]
+        return np.isin(self.facets[column], codes)
+
+    def _searchable(self):
+        return self.has_image if TEXT_SEARCH_MATRIX == "image" else self.has_text
+
+    def filter_mask(self, filters):
+        """Boolean mask of the rows matching the LLM filters (same rules as the SQL path)."""
+        mask = self._searchable().copy()
+        for column in FACET_COLUMNS:
+            if column in filters:
+                mask &= self._facet_mask(column, filters[column])
+        # NaN compares False, so rows without a price drop out like NULLs do in SQL.
+        if 'price_lt' in filters:
+            mask &= self.price < _as_int(filters['price_lt'])
+        if 'price_gt' in filters:
+            mask &= self.price > _as_int(filters['price_gt'])
+        return mask
+
+    # --- Scoring ---
+
+    @staticmethod
+    def _scores(matrix, query, rows):
+        """Cosine similarity of `query` with `matrix[rows]`."""
+        if matrix.dtype == np.float32:
+            return matrix[rows] @ query
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), SCORE_CHUNK_ROWS):
+            chunk = rows[start:start + SCORE_CHUNK_ROWS]
+            scores[start:start + len(chunk)] = matrix[chunk].astype(np.float32) @ query
+        return scores
+
+    def top_k(self, matrix, query, mask, k):
+        """Row numbers of the `k` rows in `mask` closest to `query`, best first."""
+        rows = np.flatnonzero(mask)
+        if not rows.size or k <= 0:
+            return rows[:0]
+        scores = self._scores(matrix, _normalize(query), rows)
+        k = min(k, rows.size)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return rows[best]
+
+    # --- Results (same dicts as filtered_retrieval._text_result / _image_result) ---
+
+    def _price(self, row):
+        price = self.price[row]
+        return None if np.isnan(price) else int(price)
+
+    def _image(self, row):
+        paths = self.img_paths[row]
+        return paths[0] if paths else None
+
+    def text_result(self, row):
+        return {
+            "id": self.ids[row],
+            "summary": self.summaries[row],
+            "price": self._price(row),
+            "color": self.colors[row],
+            "image": self._image(row),
+        }
+
+    def image_result(self, row):
+        return {
+            "id": self.ids[row], "summary": self.summaries[row], "price": self._price(row),
+            "color": self.colors[row], "neckline": self.necklines[row], "image": self._image(row),
+        }
+
+    # --- Searches ---
+
+    def candidate_result(self, row):
+        # Text result plus the filter columns, for re-filtering in memory.
+        result = self.text_result(row)
+        code = self.facets["category"][row]
+        result["category"] = self.meta["vocab"]["category"][code] if code >= 0 else None
+        result["neckline"] = self.necklines[row]
+        return result
+
+    def search_text(self, query_embedding, filters, top_k=5, with_facets=False):
+        mask = self.filter_mask(filters or {})
+        matrix = self.image if TEXT_SEARCH_MATRIX == "image" else self.text
+        to_result = self.candidate_result if with_facets else self.text_result
+        return [to_result(row) for row in self.top_k(matrix, query_embedding, mask, top_k)]
+
+    def image_embedding(self, product_id):
+        row = self._rows.get(product_id)
+        if row is None or not self.has_image[row]:
+            return None
+        return np.asarray(self.image[row], dtype=np.float32)
+
+    def search_image(self, image_embedding, top_k=5, exclude_id=None):
+        mask = self.has_image.copy()
+        if exclude_id in self._rows:
+            mask[self._rows[exclude_id]] = False
+        return [self.image_result(row) for row in self.top_k(self.image, image_embedding, mask, top_k)]
+
+    def similar_by_product(self, product_id, top_k=5):
+        source_vector = self.image_embedding(product_id)
+        if source_vector is None:
+            print(f"No image embedding found for product {product_id}")
+            return []
+        return self.search_image(source_vector, top_k, exclude_id=product_id)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_vector_store():
+    """Returns the process-wide store, loading it from VECTOR_STORE_DIR on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                start = time.perf_counter()
+                _store = VectorStore()
+                print(f"Loaded vector store from {VECTOR_STORE_DIR}: {len(_store)} products "
+                      f"in {time.perf_counter() - start:.2f}s")
+    return _store
+
+
+# === Export ===
+
+EXPORT_SQL = """
+    SELECT id, category, color, neckline, summary, price, img_paths, embedding, image_embedding
+    FROM products ORDER BY id
+"""
+
+
+class _StoreWriter:
+    """Fills the store files row by row, so exporting never holds the catalog twice."""
+
+    def __init__(self, path, count, text_dim, image_dim, dtype):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        def create(name, shape, array_dtype):
+            return np.lib.format.open_memmap(
+                os.path.join(path, f"{name}.npy"), mode="w+", dtype=array_dtype, shape=shape
+            )
+
+        self.text = create("text", (count, text_dim), dtype)
+        self.image = create("image", (count, image_dim), dtype)
+        self.has_text = create("has_text", (count,), np.bool_)
+        self.has_image = create("has_image", (count,), np.bool_)
+        self.price = create("price", (count,), np.float32)
+        self.facets = {column: create(column, (count,), np.int32) for column in FACET_COLUMNS}
+        self.vocab = {column: {} for column in FACET_COLUMNS}
+        self.meta = {"ids": [], "summaries": [], "colors": [], "necklines": [], "img_paths": []}
+        self.row = 0
+
+    def _code(self, column, value):
+        if value is None:
+            return -1
+        return self.vocab[column].setdefault(value, len(self.vocab[column]))
+
+    def add(self, product_id, category, color, neckline, summary, price, img_paths,
+            text_embedding, image_embedding):
+        row = self.row
+        self.meta["ids"].append(product_id)
+        self.meta["summaries"].append(summary)
+        self.meta["colors"].append(color)
+        self.meta["necklines"].append(neckline)
+        self.meta["img_paths"].append(list(img_paths or []))
+        self.price[row] = np.nan if price is None else price
+        for column, value in zip(FACET_COLUMNS, (category, color, neckline)):
+            self.facets[column][row] = self._code(column, value)
+        if text_embedding is not None:
+            self.text[row] = _normalize(text_embedding)
+            self.has_text[row] = True
+        if image_embedding is not None:
+            self.image[row] = _normalize(image_embedding)
+            self.has_image[row] = True
+        self.row += 1
+
+    def close(self, text_model, image_model):
+        arrays = [self.text, self.image, self.has_text, self.has_image, self.price,
+                  *self.facets.values()]
+        for array in arrays:
+            array.flush()
+        self.meta.update({
+            "vocab": {column: list(values) for column, values in self.vocab.items()},
+            "dtype": str(self.text.dtype),
+            "text_model": text_model,
+            "image_model": image_model,
+            "exported_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        })
+        with open(os.path.join(self.path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+
+
+def _replace_dir(tmp_path, path):
+    # Swap the finished export in, so a running server never sees half a store.
+    old_path = path + ".old"
+    if os.path.exists(path):
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def export_from_database(path, dtype):
+    from db_utils import connect
+
+    conn = connect()
+    # One snapshot for the row count and the rows themselves.
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*), max(vector_dims(embedding)), max(vector_dims(image_embedding)) "
+                        "FROM products")
+            count, text_dim, image_dim = cur.fetchone()
+        writer = _StoreWriter(path, count, text_dim or 384, image_dim or 512, dtype)
+        # A named (server-side) cursor streams the rows instead of fetching them all.
+        with conn.cursor(name="vector_store_export") as cur:
+            cur.itersize = 2000
+            cur.execute(EXPORT_SQL)
+            for row in cur:
+                writer.add(*row)
+        writer.close(TEXT_MODEL_NAME, IMAGE_MODEL_NAME)
+        return writer.row
+    finally:
+        conn.close()
+
+
+def export_from_json(path, dtype, products_json, batch_size):
+    from ingestion import batched, get_searchable_text, image_path_for, iter_json_array, load_image
+
+    text_model = models.get("text")
+    image_model = models.get("image")
+
+    count = sum(1 for _ in iter_json_array(products_json))
+    writer = _StoreWriter(path, count, text_model.get_sentence_embedding_dimension(),
+                          image_model.get_sentence_embedding_dimension(), dtype)
+    for batch in batched(iter_json_array(products_json), batch_size):
+        text_embeddings = text_model.encode([get_searchable_text(item) for item in batch],
+                                            batch_size=batch_size)
+        images = {}
+        for i, item in enumerate(batch):
+            image_path = image_path_for(item)
+            try:
+                images[i] = load_image(image_path)
+            except Exception as e:
+                print(f"[Warning] Could not read {image_path}: {e}. Skipping image.")
+        image_embeddings = {}
+        if images:
+            encoded = image_model.encode(list(images.values()), batch_size=batch_size)
+            image_embeddings = dict(zip(images, encoded))
+        for i, item in enumerate(batch):
+            writer.add(item['id'], item['category'], item['color'].strip(), item['neckline'],
+                       item['summary'], item['price'], item['img_paths'],
+                       text_embeddings[i], image_embeddings.get(i))
+        print(f"  {writer.row}/{count} products encoded")
+    writer.close(TEXT_MODEL_NAME, IMAGE_MODEL_NAME)
+    return writer.row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the in-process vector store.")
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("--source", choices=["db", "json"], default="db",
+                        help="Copy embeddings from the products table, or encode products.json.")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    parser.add_argument("--path", default=VECTOR_STORE_DIR)
+    parser.add_argument("--products-json", default=os.environ.get("PRODUCTS_JSON", "products.json"))
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    tmp_path = args.path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    start = time.perf_counter()
+    try:
+        if args.source == "db":
+            count = export_from_database(tmp_path, args.dtype)
+        else:
+            count = export_from_json(tmp_path, args.dtype, args.products_json, args.batch_size)
+        _replace_dir(tmp_path, args.path)
+        print(f"✅ Exported {count} products to {args.path} ({args.dtype}) "
+              f"in {time.perf_counter() - start:.1f}s")
+    except Exception as e:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        print(f"An error occurred: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,501 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+# === ONNX Runtime inference backend ===
+# The PyTorch models behind SentenceTransformer are exported once to ONNX and
+# served with onnxruntime on the CPU, optionally with dynamically quantized
+# int8 weights. At runtime only onnxruntime, tokenizers and PIL are needed:
+# no torch import, much less resident memory, and a faster forward pass.
+#
+# Each model is exported with its SentenceTransformer head (pooling and
+# normalization for the text model, the projection for CLIP), so the outputs
+# keep their 384 / 512 dimensions and match the PyTorch vectors up to the
+# drift that `parity` reports. Layout of ONNX_MODEL_DIR/<model name>/:
+#   model.onnx          float32 graph
+#   model.int8.onnx     dynamically quantized graph (export --quantize)
+#   config.json         kind, dimension and pre-processing settings
+#   tokenizer.json      text models only
+#   parity.json         drift per graph from the last `parity` run
+# CLIP's text tower (for TEXT_SEARCH_MODEL=clip) goes to <model name>-text/.
+#
+#   python onnx_backend.py export --quantize     # needs torch + sentence_transformers
+#   python onnx_backend.py parity                # cosine drift and latency vs PyTorch
+# and serve with EMBEDDING_BACKEND=onnx (see model_registry.py).
+#
+# `parity` fails (exit 1) when any vector's cosine distance from PyTorch is above
+# ONNX_MAX_DRIFT, and records the verdict in parity.json; a graph that failed
+# its last check refuses to load.
+
+ONNX_MODEL_DIR = os.environ.get("ONNX_MODEL_DIR", "onnx_models")
+ONNX_QUANTIZED = os.environ.get("ONNX_QUANTIZED", "1") != "0"
+# 0 leaves the thread count to onnxruntime (one per physical core).
+ONNX_THREADS = int(os.environ.get("ONNX_THREADS", "0"))
+ONNX_OPSET = 17
+# Largest cosine distance (1 - cosine) from the PyTorch vector a graph may show.
+ONNX_MAX_DRIFT = float(os.environ.get("ONNX_MAX_DRIFT", "0.01"))
+
+
+class ParityError(Exception):
+    pass
+
+
+def model_dir(name, root=ONNX_MODEL_DIR, variant=""):
+    directory = name.replace("/", "__")
+    return os.path.join(root, f"{directory}-{variant}" if variant else directory)
+
+
+def _session(path):
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if ONNX_THREADS:
+        options.intra_op_num_threads = ONNX_THREADS
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+class OnnxEncoder:
+    """
+    Drop-in for the parts of SentenceTransformer this repo uses: encode() and
+    get_sentence_embedding_dimension(). A single input returns a 1-D vector,
+    a list returns a (n, dim) float32 matrix.
+    """
+
+    def __init__(self, directory, quantized=ONNX_QUANTIZED):
+        with open(os.path.join(directory, "config.json"), "r", encoding="utf-8") as f:
+            self.config = json.load(f)
+        path = os.path.join(directory, "model.onnx")
+        int8_path = os.path.join(directory, "model.int8.onnx")
+        if quantized:
+            if os.path.exists(int8_path):
+                path = int8_path
+            else:
+                print(f"[onnx] {int8_path} not found; using the float32 graph.")
+        self.path = path
+        self.quantized = path == int8_path
+        _check_recorded_parity(directory, "onnx-int8" if self.quantized else "onnx")
+        self.session = _session(path)
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.dimension = self.config["dimension"]
+
+        self.tokenizer = None
+        if self.config["kind"] == "text":
+            from tokenizers import Tokenizer
+            self.tokenizer = Tokenizer.from_file(os.path.join(directory, "tokenizer.json"))
+            self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+            self.tokenizer.enable_padding(pad_id=self.config["pad_id"],
+                                          pad_token=self.config["pad_token"])
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    # --- Pre-processing ---
+
+    def _text_inputs(self, texts):
+        encodings = self.tokenizer.encode_batch(list(texts))
+        inputs = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+        }
+        return {key: value for key, value in inputs.items() if key in self.input_names}
+
+    def _image_inputs(self, images):
+        return {"pixel_values": np.stack([preprocess_image(image, self.config) for image in images])}
+
+    # --- Public API ---
+
+    def encode(self, inputs, batch_size=32, **kwargs):
+        single = isinstance(inputs, str) or not isinstance(inputs, (list, tuple))
+        items = [inputs] if single else list(inputs)
+        vectors = np.zeros((len(items), self.dimension), dtype=np.float32)
+        if self.tokenizer is not None:
+            # Like SentenceTransformer: similar lengths share a batch, so less padding.
+            order = sorted(range(len(items)), key=lambda i: -len(items[i]))
+        else:
+            order = list(range(len(items)))
+        for start in range(0, len(order), max(batch_size, 1)):
+            chunk = order[start:start + batch_size]
+            batch = [items[i] for i in chunk]
+            feed = self._text_inputs(batch) if self.tokenizer is not None else self._image_inputs(batch)
+            vectors[chunk] = self.session.run(None, feed)[0]
+        return vectors[0] if single else vectors
+
+
+def preprocess_image(image, config):
+    """CLIP pre-processing without torch: resize the short side, center-crop, normalize, CHW."""
+    from PIL import Image
+    image = image.convert("RGB")
+    size, crop = config["image_size"], config["crop_size"]
+    width, height = image.size
+    short, long = (width, height) if width <= height else (height, width)
+    new_short, new_long = size, int(size * long / short)
+    new_size = (new_short, new_long) if width <= height else (new_long, new_short)
+    if new_size != image.size:
+        image = image.resize(new_size, Image.BICUBIC)
+    width, height = image.size
+    left, top = (width - crop) // 2, (height - crop) // 2
+    image = image.crop((left, top, left + crop, top + crop))
+    pixels = np.asarray(image, dtype=np.float32) / 255.0
+    pixels = (pixels - np.array(config["image_mean"], dtype=np.float32)) / np.array(
+        config["image_std"], dtype=np.float32)
+    return pixels.transpose(2, 0, 1)
+
+
+def _check_recorded_parity(directory, label):
+    path = os.path.join(directory, "parity.json")
+    if not os.path.exists(path):
+        print(f"[onnx] No parity record in {directory}; run `python onnx_backend.py parity`.")
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        entry = json.load(f).get(label)
+    if entry is not None and not entry["passed"]:
+        raise ParityError(
+            f"{label} graph in {directory} drifted {entry['max_drift']:.2e} from PyTorch "
+            f"(limit {entry['max_allowed_drift']:.2e}); re-export it or serve with torch."
+        )
+
+
+def load_onnx_encoder(name, root=ONNX_MODEL_DIR, quantized=ONNX_QUANTIZED, variant=""):
+    directory = model_dir(name, root, variant)
+    if not os.path.exists(os.path.join(directory, "config.json")):
+        raise FileNotFoundError(
+            f"No ONNX export of {name} in {directory}; run `python onnx_backend.py export`."
+        )
+    return OnnxEncoder(directory, quantized)
+
+
+# === Export ===
+
+def _first(value, *keys):
+    # Image processor settings are ints in older transformers, dicts in newer ones.
+    if isinstance(value, dict):
+        for key in keys:
+            if key in value:
+                return value[key]
+    return value
+
+
+def _export_text(st_model, directory, opset):
+    import torch
+
+    class TextGraph(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            features = {"input_ids": input_ids, "attention_mask": attention_mask}
+            return self.model(features)["sentence_embedding"]
+
+    sample = st_model.tokenizer(["a sample sentence", "another one"], padding=True,
+                                return_tensors="pt")
+    torch.onnx.export(
+        TextGraph(st_model), (sample["input_ids"], sample["attention_mask"]),
+        os.path.join(directory, "model.onnx"),
+        input_names=["input_ids", "attention_mask"], output_names=["embedding"],
+        dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                      "attention_mask": {0: "batch", 1: "sequence"},
+                      "embedding": {0: "batch"}},
+        opset_version=opset, do_constant_folding=True,
+    )
+    st_model.tokenizer.backend_tokenizer.save(os.path.join(directory, "tokenizer.json"))
+    return {
+        "kind": "text",
+        "dimension": st_model.get_sentence_embedding_dimension(),
+        "max_seq_length": st_model.max_seq_length,
+        "pad_id": st_model.tokenizer.pad_token_id,
+        "pad_token": st_model.tokenizer.pad_token,
+    }
+
+
+def _export_image(st_model, directory, opset):
+    import torch
+
+    clip = st_model[0].model
+    processor = st_model[0].processor
+    image_processor = getattr(processor, "image_processor", None) or processor.feature_extractor
+
+    class ImageGraph(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.vision_model = model.vision_model
+            self.visual_projection = model.visual_projection
+
+        def forward(self, pixel_values):
+            pooled = self.vision_model(pixel_values=pixel_values)[1]
+            return self.visual_projection(pooled)
+
+    crop = int(_first(image_processor.crop_size, "height", "shortest_edge"))
+    torch.onnx.export(
+        ImageGraph(clip), (torch.zeros(1, 3, crop, crop),),
+        os.path.join(directory, "model.onnx"),
+        input_names=["pixel_values"], output_names=["embedding"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "embedding": {0: "batch"}},
+        opset_version=opset, do_constant_folding=True,
+    )
+    return {
+        "kind": "image",
+        "dimension": clip.config.projection_dim,
+        "image_size": int(_first(image_processor.size, "shortest_edge", "height")),
+        "crop_size": crop,
+        "image_mean": list(image_processor.image_mean),
+        "image_std": list(image_processor.image_std),
+    }
+
+
+def _export_clip_text(st_model, directory, opset):
+    import torch
+
+    clip = st_model[0].model
+    tokenizer = st_model[0].processor.tokenizer
+
+    class ClipTextGraph(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.text_model = model.text_model
+            self.text_projection = model.text_projection
+
+        def forward(self, input_ids, attention_mask):
+            pooled = self.text_model(input_ids=input_ids, attention_mask=attention_mask)[1]
+            return self.text_projection(pooled)
+
+    sample = tokenizer(["a sample sentence", "another one"], padding=True, return_tensors="pt")
+    torch.onnx.export(
+        ClipTextGraph(clip), (sample["input_ids"], sample["attention_mask"]),
+        os.path.join(directory, "model.onnx"),
+        input_names=["input_ids", "attention_mask"], output_names=["embedding"],
+        dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                      "attention_mask": {0: "batch", 1: "sequence"},
+                      "embedding": {0: "batch"}},
+        opset_version=opset, do_constant_folding=True,
+    )
+    tokenizer.backend_tokenizer.save(os.path.join(directory, "tokenizer.json"))
+    return {
+        "kind": "text",
+        "dimension": clip.config.projection_dim,
+        "max_seq_length": clip.config.text_config.max_position_embeddings,
+        "pad_id": tokenizer.pad_token_id,
+        "pad_token": tokenizer.pad_token,
+    }
+
+
+def export(name, kind, root=ONNX_MODEL_DIR, quantize=False, opset=ONNX_OPSET):
+    from sentence_transformers import SentenceTransformer
+
+    st_model = SentenceTransformer(name, device="cpu")
+    st_model.eval()
+    if kind == "text":
+        _export_graph(_export_text, st_model, name, model_dir(name, root), quantize, opset)
+    else:
+        _export_graph(_export_image, st_model, name, model_dir(name, root), quantize, opset)
+        _export_graph(_export_clip_text, st_model, name, model_dir(name, root, "text"),
+                      quantize, opset)
+
+
+def _export_graph(exporter, st_model, name, directory, quantize, opset):
+    os.makedirs(directory, exist_ok=True)
+    print(f"Exporting {name} to {directory}/ ...")
+    config = exporter(st_model, directory, opset)
+    config["model"] = name
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        # Only the matrix multiplies: that's where the weights and the time are,
+        # and integer convolutions (CLIP's patch embedding) are slow on CPU.
+        quantize_dynamic(os.path.join(directory, "model.onnx"),
+                         os.path.join(directory, "model.int8.onnx"),
+                         op_types_to_quantize=["MatMul", "Gemm"], weight_type=QuantType.QInt8)
+    with open(os.path.join(directory, "config.json"), "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+    for file_name in ("model.onnx", "model.int8.onnx"):
+        path = os.path.join(directory, file_name)
+        if os.path.exists(path):
+            print(f"  {file_name}: {os.path.getsize(path) / 1e6:.1f} MB")
+
+
+# === Parity check ===
+
+def _rss_mb():
+    # Linux only; None elsewhere.
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _timed_load(load):
+    before = _rss_mb()
+    start = time.perf_counter()
+    model = load()
+    seconds = time.perf_counter() - start
+    after = _rss_mb()
+    return model, seconds, (after - before) if before is not None and after is not None else None
+
+
+def _single_latency_ms(model, inputs, repeats):
+    model.encode(inputs[:1], batch_size=1)   # first call initializes lazily
+    timings = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        model.encode(inputs[i % len(inputs)], batch_size=1)
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+
+def _cosines(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return np.sum(a * b, axis=1)
+
+
+def parity(name, inputs, root=ONNX_MODEL_DIR, repeats=50, batch_size=32, variant="",
+           max_drift=ONNX_MAX_DRIFT):
+    """
+    Encodes `inputs` with PyTorch and with each ONNX graph and reports, per
+    graph, the cosine drift (1 - cosine) from the PyTorch vectors, the median
+    single-input encode latency, the load time and the resident memory the
+    load added. The ONNX graphs are measured first, so their memory figure
+    isn't hidden behind torch's.
+
+    Each graph passes if no vector drifts more than `max_drift`; the verdicts
+    are written to parity.json (checked when the graph is loaded for serving).
+    """
+    report = {}
+    directory = model_dir(name, root, variant)
+    parity_path = os.path.join(directory, "parity.json")
+    if os.path.exists(parity_path):
+        os.remove(parity_path)   # measure every graph, including ones that failed before
+    for quantized in (False, True):
+        if quantized and not os.path.exists(os.path.join(directory, "model.int8.onnx")):
+            continue
+        label = "onnx-int8" if quantized else "onnx"
+        model, load_seconds, rss = _timed_load(lambda: OnnxEncoder(directory, quantized))
+        report[label] = {
+            "vectors": model.encode(inputs, batch_size=batch_size),
+            "load_seconds": round(load_seconds, 2),
+            "rss_mb": round(rss, 1) if rss is not None else None,
+            "single_ms": round(_single_latency_ms(model, inputs, repeats), 2),
+        }
+        del model
+
+    from sentence_transformers import SentenceTransformer
+    model, load_seconds, rss = _timed_load(lambda: SentenceTransformer(name, device="cpu"))
+    reference = model.encode(inputs, batch_size=batch_size)
+    report["torch"] = {
+        "load_seconds": round(load_seconds, 2),
+        "rss_mb": round(rss, 1) if rss is not None else None,
+        "single_ms": round(_single_latency_ms(model, inputs, repeats), 2),
+    }
+
+    for label, entry in report.items():
+        vectors = entry.pop("vectors", None)
+        if vectors is None:
+            continue
+        drift = 1.0 - _cosines(reference, vectors)
+        entry.update({
+            "dimension": int(vectors.shape[1]),
+            "mean_drift": float(drift.mean()),
+            "p99_drift": float(np.percentile(drift, 99)),
+            "max_drift": float(drift.max()),
+            "min_cosine": float(1.0 - drift.max()),
+            "max_allowed_drift": max_drift,
+            "passed": bool(drift.max() <= max_drift),
+        })
+    with open(parity_path, "w", encoding="utf-8") as f:
+        json.dump({label: {key: entry[key] for key in ("max_drift", "max_allowed_drift", "passed")}
+                   for label, entry in report.items() if "passed" in entry}, f, indent=2)
+    return report
+
+
+def _parity_inputs(products_json, static_dir, count):
+    from ingestion import get_searchable_text, image_path_for, iter_json_array, load_image
+
+    texts, images = [], []
+    for item in iter_json_array(products_json):
+        if len(texts) < count:
+            texts.append(get_searchable_text(item))
+            # Short queries too: that's what the API encodes at request time.
+            texts.append(f"{item['color'].strip()} {item['category'].lower()}")
+        if len(images) < count:
+            try:
+                images.append(load_image(image_path_for(item, static_dir)))
+            except Exception:
+                pass
+        if len(texts) >= count and len(images) >= count:
+            break
+    return texts[:count], images
+
+
+def main():
+    from model_registry import IMAGE_MODEL_NAME, TEXT_MODEL_NAME
+
+    parser = argparse.ArgumentParser(description="Export the embedding models to ONNX and check them.")
+    parser.add_argument("command", choices=["export", "parity"])
+    parser.add_argument("--model", choices=["text", "image", "all"], default="all")
+    parser.add_argument("--path", default=ONNX_MODEL_DIR)
+    parser.add_argument("--quantize", action="store_true",
+                        help="export: also write a dynamically quantized int8 graph.")
+    parser.add_argument("--opset", type=int, default=ONNX_OPSET)
+    parser.add_argument("--products-json", default=os.environ.get("PRODUCTS_JSON", "products.json"))
+    parser.add_argument("--static-dir", default="static")
+    parser.add_argument("--samples", type=int, default=200,
+                        help="parity: texts/images compared against PyTorch.")
+    parser.add_argument("--max-drift", type=float, default=ONNX_MAX_DRIFT,
+                        help="parity: fail if any vector's cosine distance from PyTorch exceeds this.")
+    parser.add_argument("--output", default=None, help="parity: also write the report as JSON.")
+    args = parser.parse_args()
+
+    kinds = ["text", "image"] if args.model == "all" else [args.model]
+    names = {"text": TEXT_MODEL_NAME, "image": IMAGE_MODEL_NAME}
+
+    if args.command == "export":
+        for kind in kinds:
+            export(names[kind], kind, args.path, args.quantize, args.opset)
+        print("✅ Export complete. Serve with EMBEDDING_BACKEND=onnx.")
+        return
+
+    texts, images = _parity_inputs(args.products_json, args.static_dir, args.samples)
+    checks = []   # (report key, model, export variant, inputs)
+    if "text" in kinds:
+        checks.append(("text", TEXT_MODEL_NAME, "", texts))
+    if "image" in kinds:
+        checks.append(("image", IMAGE_MODEL_NAME, "", images))
+        if os.path.exists(os.path.join(model_dir(IMAGE_MODEL_NAME, args.path, "text"), "config.json")):
+            checks.append(("clip_text", IMAGE_MODEL_NAME, "text", texts))
+    reports, failed = {}, False
+    for key, name, variant, inputs in checks:
+        if not inputs:
+            print(f"No inputs found for {key}; skipping it.")
+            continue
+        reports[key] = parity(name, inputs, args.path, variant=variant, max_drift=args.max_drift)
+        print(f"\n{name}{' (' + variant + ')' if variant else ''}: {len(inputs)} inputs")
+        print(f"  {'backend':<10}{'min cos':>10}{'mean drift':>12}{'max drift':>12}"
+              f"{'1-item ms':>11}{'load s':>8}{'RSS MB':>9}")
+        for label, entry in reports[key].items():
+            rss = entry["rss_mb"]
+            verdict = ""
+            if "passed" in entry:
+                failed |= not entry["passed"]
+                verdict = "" if entry["passed"] else "  FAIL"
+                drift = (f"{entry['min_cosine']:>10.5f}{entry['mean_drift']:>12.2e}"
+                         f"{entry['max_drift']:>12.2e}")
+            else:
+                drift = f"{'(reference)':>34}"
+            print(f"  {label:<10}{drift}{entry['single_ms']:>11.2f}{entry['load_seconds']:>8.2f}"
+                  f"{rss if rss is not None else float('nan'):>9.1f}{verdict}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=2)
+    if failed:
+        print(f"\n❌ Some vectors drifted more than {args.max_drift} (cosine distance) from PyTorch; "
+              "those graphs won't load until they pass.")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import argparse
+import os
+import time
+
+import numpy as np
+from psycopg2.extras import execute_values
+from db_utils import connect
+
+# === WHAT IS BEING DONE HERE ===
+# "Visually similar" results for a catalog product only change when the
+# catalog does, so they are computed offline and stored in
+# product_image_neighbors. /similar-by-image then becomes one primary-key lookup.
+#
+# All image embeddings are loaded once, L2-normalized, and compared in blocks
+# of NEIGHBOR_BLOCK_ROWS products: one matrix multiply per block, then
+# argpartition for the top N of each row.
+#
+# Each stored row records the image_hash it was computed for. A re-run only
+# recomputes:
+#   - products that are new or whose image changed,
+#   - products whose stored neighbors include a changed or removed product.
+# For every other product the changed images are merged into its existing list.
+# Use --full to recompute everything.
+
+NEIGHBOR_COUNT = int(os.environ.get("NEIGHBOR_COUNT", "50"))
+NEIGHBOR_BLOCK_ROWS = int(os.environ.get("NEIGHBOR_BLOCK_ROWS", "256"))
+WRITE_BATCH_SIZE = 1000
+
+CREATE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS product_image_neighbors (
+        product_id VARCHAR(255) PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,
+        neighbor_ids TEXT[] NOT NULL,
+        distances REAL[] NOT NULL,
+        image_hash TEXT,
+        computed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+
+UPSERT_SQL = """
+    INSERT INTO product_image_neighbors (product_id, neighbor_ids, distances, image_hash)
+    VALUES %s
+    ON CONFLICT (product_id) DO UPDATE SET
+        neighbor_ids = EXCLUDED.neighbor_ids,
+        distances = EXCLUDED.distances,
+        image_hash = EXCLUDED.image_hash,
+        computed_at = now()
+"""
+
+
+def load_embeddings(cur):
+    cur.execute(
+        "SELECT id, image_hash, image_embedding FROM products "
+        "WHERE image_embedding IS NOT NULL ORDER BY id"
+    )
+    rows = cur.fetchall()
+    ids = [row[0] for row in rows]
+    hashes = [row[1] for row in rows]
+    if not rows:
+        return ids, hashes, np.zeros((0, 0), dtype=np.float32)
+    matrix = np.vstack([np.asarray(row[2], dtype=np.float32) for row in rows])
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+    return ids, hashes, matrix
+
+
+def load_stored(cur):
+    cur.execute("SELECT product_id, image_hash, neighbor_ids, distances FROM product_image_neighbors")
+    return {row[0]: (row[1], list(row[2]), list(row[3])) for row in cur.fetchall()}
+
+
+def top_neighbors(matrix, rows, count, block_rows=NEIGHBOR_BLOCK_ROWS):
+    """
+    Yields (row, neighbor_rows, distances) for each row in `rows`, nearest
+    first, comparing against every row of `matrix` except itself.
+    """
+    count = min(count, matrix.shape[0] - 1)
+    if count <= 0:
+        for row in rows:
+            yield row, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return
+    rows = np.asarray(rows, dtype=np.int64)
+    for start in range(0, len(rows), block_rows):
+        block = rows[start:start + block_rows]
+        similarity = matrix[block] @ matrix.T
+        similarity[np.arange(len(block)), block] = -np.inf   # never your own neighbor
+        best = np.argpartition(-similarity, count - 1, axis=1)[:, :count]
+        best_sim = np.take_along_axis(similarity, best, axis=1)
+        order = np.argsort(-best_sim, axis=1, kind="stable")
+        best = np.take_along_axis(best, order, axis=1)
+        best_sim = np.take_along_axis(best_sim, order, axis=1)
+        for i, row in enumerate(block):
+            yield row, best[i], 1.0 - best_sim[i]
+
+
+def merge_changed(stored_ids, stored_distances, candidate_ids, candidate_distances, count):
+    """Merges fresh candidates into a stored neighbor list, keeping the `count` nearest."""
+    merged = sorted(zip(stored_distances + candidate_distances, stored_ids + candidate_ids))
+    return [pid for _, pid in merged[:count]], [d for d, _ in merged[:count]]
+
+
+def compute_updates(ids, hashes, matrix, stored, count, block_rows=NEIGHBOR_BLOCK_ROWS):
+    """Returns {product_id: (neighbor_ids, distances)} for every list that needs writing."""
+    row_of = {pid: row for row, pid in enumerate(ids)}
+    changed = {pid for pid, h in zip(ids, hashes) if pid not in stored or stored[pid][0] != h}
+    removed = set(stored) - set(ids)
+    stale = changed | removed
+    # Lists that mention a changed or removed product can't be patched: that
+    # product's stored distance is meaningless now, and its replacement unknown.
+    # Short lists (from a smaller --count or a smaller catalog) are redone too.
+    full_length = min(count, len(ids) - 1)
+    recompute = set(changed)
+    for pid, (_, neighbor_ids, _) in stored.items():
+        if pid in row_of and (stale.intersection(neighbor_ids) or len(neighbor_ids) < full_length):
+            recompute.add(pid)
+    patch = [pid for pid in ids if pid not in recompute] if changed else []
+    print(f"{len(changed)} new/changed, {len(removed)} removed: recomputing "
+          f"{len(recompute)} lists, patching up to {len(patch)}.")
+
+    updates = {}
+    recompute_rows = sorted(row_of[pid] for pid in recompute)
+    for row, neighbors, distances in top_neighbors(matrix, recompute_rows, count, block_rows):
+        updates[ids[row]] = ([ids[n] for n in neighbors], [float(d) for d in distances])
+
+    # Every other list only needs to consider the changed products.
+    if patch:
+        changed_rows = np.array(sorted(row_of[pid] for pid in changed), dtype=np.int64)
+        changed_ids = [ids[r] for r in changed_rows]
+        changed_matrix = matrix[changed_rows]
+        for block_start in range(0, len(patch), block_rows):
+            block = patch[block_start:block_start + block_rows]
+            distances = 1.0 - matrix[[row_of[pid] for pid in block]] @ changed_matrix.T
+            for i, pid in enumerate(block):
+                _, stored_ids, stored_distances = stored[pid]
+                worst = stored_distances[-1] if len(stored_distances) >= count else np.inf
+                closer = np.flatnonzero(distances[i] < worst)
+                if not closer.size:
+                    continue
+                updates[pid] = merge_changed(
+                    stored_ids, stored_distances,
+                    [changed_ids[j] for j in closer], [float(distances[i][j]) for j in closer],
+                    count,
+                )
+    return updates
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute visual neighbors for every product.")
+    parser.add_argument("--count", type=int, default=NEIGHBOR_COUNT,
+                        help="Neighbors stored per product.")
+    parser.add_argument("--block-rows", type=int, default=NEIGHBOR_BLOCK_ROWS,
+                        help="Products compared per matrix multiply.")
+    parser.add_argument("--full", action="store_true",
+                        help="Recompute every product instead of only what changed.")
+    args = parser.parse_args()
+
+    try:
+        conn = connect()
+        cur = conn.cursor()
+        print("\nSuccessfully connected to the database.")
+        cur.execute(CREATE_TABLE_SQL)
+
+        start = time.perf_counter()
+        ids, hashes, matrix = load_embeddings(cur)
+        stored = {} if args.full else load_stored(cur)
+        print(f"Loaded {len(ids)} image embeddings and {len(stored)} stored neighbor lists "
+              f"in {time.perf_counter() - start:.1f}s.")
+
+        start = time.perf_counter()
+        updates = compute_updates(ids, hashes, matrix, stored, args.count, args.block_rows)
+        print(f"Computed {len(updates)} neighbor lists in {time.perf_counter() - start:.1f}s.")
+
+        hash_of = dict(zip(ids, hashes))
+        values = [(pid, neighbor_ids, distances, hash_of[pid])
+                  for pid, (neighbor_ids, distances) in updates.items()]
+        for batch_start in range(0, len(values), WRITE_BATCH_SIZE):
+            execute_values(cur, UPSERT_SQL, values[batch_start:batch_start + WRITE_BATCH_SIZE],
+                           template="(%s, %s, %s::real[], %s)")
+        # Products that lost their image embedding (deleted products cascade).
+        cur.execute(
+            "DELETE FROM product_image_neighbors n USING products p "
+            "WHERE p.id = n.product_id AND p.image_embedding IS NULL"
+        )
+        conn.commit()
+        print(f"✅ Stored {len(values)} neighbor lists ({args.count} neighbors each).")
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        if 'cur' in locals(): cur.close()
+        if 'conn' in locals(): conn.close()
+        print("Database connection closed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
-import ollama
 import json
+import os
+import threading
+from analysis_cache import AnalysisCache, prompt_fingerprint
+from query_rules import RuleBasedParser
+from metrics import LLM_FALLBACKS, stage_timer
 
-def analyze_query_with_llm(user_query: str):
-    """
-    Uses a local LLM to analyze the user's query, extract filters,
-    and create a refined search query.
-    """
+LLM_MODEL = 'phi3'
 
-    system_prompt = """
+# === Query Routing ===
+# "hybrid": rule-based parser first, LLM only when its confidence is low.
+# "llm":    always the LLM.   "rules": never the LLM (unless the parser fails).
+# "shadow": always the LLM, but also run the parser and record how often it
+#           would have been used and whether it agreed with the LLM.
+QUERY_PARSER_MODE = os.environ.get("QUERY_PARSER_MODE", "hybrid")
+RULE_CONFIDENCE_THRESHOLD = float(os.environ.get("RULE_CONFIDENCE_THRESHOLD", "0.85"))
+
+SYSTEM_PROMPT = """
 You are an expert AI assistant for a fashion chatbot. Your job is to extract a structured JSON from a user query.
 
 Return a JSON with:
@@ -52,26 +60,195 @@ Now, analyze the following user query. Respond only with JSON.
 """
 
 
+# Results are cached per normalized query; the namespace ties every entry to
+# this exact prompt and model, so editing either starts from a clean cache.
+analysis_cache = AnalysisCache(namespace=prompt_fingerprint(LLM_MODEL, SYSTEM_PROMPT))
+
+
+def _build_messages(user_query: str):
+    return [
+        {'role': 'system', 'content': SYSTEM_PROMPT},  # ✅ FIXED HERE
+        {'role': 'user', 'content': user_query}
+    ]
+
+
+def _fallback_analysis(user_query: str, error: Exception):
+    reason = "invalid_json" if isinstance(error, json.JSONDecodeError) else "error"
+    LLM_FALLBACKS.inc(reason=reason)
+    return {
+        "refined_query": user_query,
+        "filters": {}
+    }
+
+
+def analyze_query_with_llm(user_query: str):
+    """
+    Uses a local LLM to analyze the user's query, extract filters,
+    and create a refined search query.
+    """
+    cached = analysis_cache.get(user_query)
+    if cached is not None:
+        return cached
+
+    # Imported on first use: the client library alone adds ~0.3s to startup.
+    import ollama
+    try:
+        with stage_timer("llm"):
+            response = ollama.chat(
+                model=LLM_MODEL,
+                messages=_build_messages(user_query),
+                options={'temperature': 0.0},
+                format='json'
+            )
+
+        content = response['message']['content']
+        analysis = json.loads(content)
+
+    except Exception as e:
+        print(f"An error occurred while analyzing the query: {e}")
+        return _fallback_analysis(user_query, e)
+
+    # Fallbacks are deliberately not cached: the LLM may be back next time.
+    analysis_cache.put(user_query, analysis)
+    return analysis
+
+
+_async_client = None
+
+
+async def analyze_query_with_llm_async(user_query: str):
+    """
+    Same as `analyze_query_with_llm`, but talks to Ollama without blocking
+    the event loop.
+    """
+    global _async_client
+    cached = analysis_cache.get(user_query)
+    if cached is not None:
+        return cached
+
+    if _async_client is None:
+        import ollama
+        _async_client = ollama.AsyncClient()
+
     try:
-        response = ollama.chat(
-            model='phi3',
-            messages=[
-                {'role': 'system', 'content': system_prompt},  # ✅ FIXED HERE
-                {'role': 'user', 'content': user_query}
-            ],
-            options={'temperature': 0.0},
-            format='json'
-        )
+        with stage_timer("llm"):
+            response = await _async_client.chat(
+                model=LLM_MODEL,
+                messages=_build_messages(user_query),
+                options={'temperature': 0.0},
+                format='json'
+            )
 
         content = response['message']['content']
-        return json.loads(content)
+        analysis = json.loads(content)
 
     except Exception as e:
         print(f"An error occurred while analyzing the query: {e}")
-        return {
-            "refined_query": user_query,
-            "filters": {}
-        }
+        return _fallback_analysis(user_query, e)
+
+    analysis_cache.put(user_query, analysis)
+    return analysis
+
+
+rule_parser = RuleBasedParser()
+
+_path_lock = threading.Lock()
+_path_counts = {"rules": 0, "llm": 0, "shadow_compared": 0, "shadow_confident": 0,
+                "shadow_agreed": 0}
+
+
+def _count(*keys):
+    with _path_lock:
+        for key in keys:
+            _path_counts[key] += 1
+
+
+def _parse_with_rules(user_query: str):
+    if QUERY_PARSER_MODE == "llm":
+        return None, 0.0
+    try:
+        with stage_timer("rules"):
+            return rule_parser.parse(user_query)
+    except Exception as e:
+        print(f"Rule-based parser failed, falling back to the LLM: {e}")
+        return None, 0.0
+
+
+def _use_rules(analysis, confidence):
+    if analysis is None:
+        return False
+    if QUERY_PARSER_MODE == "rules":
+        return True
+    return QUERY_PARSER_MODE == "hybrid" and confidence >= RULE_CONFIDENCE_THRESHOLD
+
+
+# The filter keys build_filter_clauses searches on; others (e.g. the LLM's
+# "gender") don't change results, so they don't count against agreement.
+SEARCHED_FILTERS = ("category", "color", "neckline", "price_lt", "price_gt")
+
+
+def _searched_filters(analysis):
+    return {k: v for k, v in (analysis.get("filters") or {}).items() if k in SEARCHED_FILTERS}
+
+
+def _record_shadow(rule_analysis, confidence, llm_analysis):
+    keys = ["shadow_compared"]
+    if confidence >= RULE_CONFIDENCE_THRESHOLD:
+        keys.append("shadow_confident")
+        if _searched_filters(rule_analysis) == _searched_filters(llm_analysis):
+            keys.append("shadow_agreed")
+    _count(*keys)
+
+
+def analyze_query(user_query: str):
+    """
+    Returns `{"refined_query", "filters"}` for a query, using the rule-based
+    parser when it is confident enough and the LLM otherwise.
+    """
+    rule_analysis, confidence = _parse_with_rules(user_query)
+    if _use_rules(rule_analysis, confidence):
+        _count("rules")
+        return rule_analysis
+
+    analysis = analyze_query_with_llm(user_query)
+    _count("llm")
+    if QUERY_PARSER_MODE == "shadow" and rule_analysis is not None:
+        _record_shadow(rule_analysis, confidence, analysis)
+    return analysis
+
+
+async def analyze_query_async(user_query: str):
+    rule_analysis, confidence = _parse_with_rules(user_query)
+    if _use_rules(rule_analysis, confidence):
+        _count("rules")
+        return rule_analysis
+
+    analysis = await analyze_query_with_llm_async(user_query)
+    _count("llm")
+    if QUERY_PARSER_MODE == "shadow" and rule_analysis is not None:
+        _record_shadow(rule_analysis, confidence, analysis)
+    return analysis
+
+
+def preview_analysis(user_query: str):
+    """
+    The rule parser's (possibly partial) analysis, and whether analyze_query
+    would stop there without calling the LLM.
+    """
+    rule_analysis, confidence = _parse_with_rules(user_query)
+    return rule_analysis, _use_rules(rule_analysis, confidence)
+
+
+def parser_path_stats():
+    """How often each path (rules vs LLM) was taken since startup."""
+    with _path_lock:
+        stats = dict(_path_counts)
+    total = stats["rules"] + stats["llm"]
+    stats["mode"] = QUERY_PARSER_MODE
+    stats["confidence_threshold"] = RULE_CONFIDENCE_THRESHOLD
+    stats["rules_share"] = stats["rules"] / total if total else 0.0
+    return stats
+
 
 # --- Example Usage ---
 if __name__ == "__main__":
@@ -0,0 +1,336 @@
+import json
+import os
+import re
+import sys
+import threading
+
+# === Rule-Based Query Parser ===
+# A deterministic stand-in for the LLM on formulaic queries ("red dresses under
+# 2000", "black v-neck tops above 1500"). The gazetteers are built from the
+# category / color / neckline values that actually exist in the catalog, so the
+# filters it emits always match what `find_filtered_similar_products` filters on.
+
+PRODUCTS_JSON = os.environ.get("PRODUCTS_JSON", "products.json")
+# "json" reads products.json; "db" reads the distinct values from the products table.
+GAZETTEER_SOURCE = os.environ.get("GAZETTEER_SOURCE", "json")
+
+# Words that carry no search intent and are ignored when scoring confidence.
+STOPWORDS = {
+    "a", "an", "the", "me", "i", "im", "i'm", "my", "we", "you", "show", "find", "get", "give",
+    "want", "wanna", "need", "looking", "look", "search", "searching", "buy", "some", "any",
+    "please", "pls", "can", "could", "would", "like", "to", "for", "in", "of", "with", "and",
+    "or", "on", "that", "is", "are", "color", "colour", "colored", "coloured", "neck",
+    "neckline", "rs", "inr", "rupees", "price", "priced", "cost", "costing", "items", "item",
+    "something", "one", "ones", "all", "only", "just", "under", "below", "above", "over",
+    "from", "between", "than", "less", "more", "up", "upto", "at", "least", "most", "max",
+}
+
+# Everyday words for catalog categories. Only targets present in the catalog are used.
+CATEGORY_SYNONYMS = {
+    "dress": "Dresses", "gown": "Dresses", "frock": "Dresses", "tee": "Tees_Tanks",
+    "t-shirt": "Tees_Tanks", "tshirt": "Tees_Tanks", "t shirt": "Tees_Tanks",
+    "top": "Tees_Tanks", "tank top": "Tees_Tanks",
+    "graphic tee": "Graphic_Tees", "graphic t-shirt": "Graphic_Tees",
+    "hoodie": "Sweatshirts_Hoodies", "sweatshirt": "Sweatshirts_Hoodies",
+    "sweater": "Sweaters", "pullover": "Sweaters", "jumper": "Sweaters",
+    "coat": "Jackets_Coats", "vest": "Jackets_Vests",
+    "blouse": "Blouses_Shirts", "polo": "Shirts_Polos",
+    "jeans": "Denim", "denim": "Denim",
+    "trousers": "Pants", "pant": "Pants", "pants": "Pants",
+    "legging": "Leggings", "leggings": "Leggings",
+    "jumpsuit": "Jumpsuits", "romper": "Jumpsuits",
+    "suit": "Suiting", "blazer": "Blazers", "cardigan": "Cardigans",
+    "skirt": "Skirts", "shorts": "Shorts",
+}
+
+GENDER_WORDS = {
+    "men": "Men", "man": "Men", "mens": "Men", "men's": "Men", "male": "Men", "boys": "Men",
+    "women": "Women", "woman": "Women", "womens": "Women", "women's": "Women",
+    "female": "Women", "ladies": "Women", "girls": "Women",
+}
+
+# Plural-only words whose singular means something else ("short" is a length).
+_PLURAL_ONLY = {"shorts", "pants", "leggings", "jeans", "trousers"}
+
+# Neckline values that say nothing about the neckline.
+_IGNORED_NECKLINES = {"unknown", ""}
+
+_NUMBER = r"(?:₹|rs\.?|inr)?\s*(\d[\d,]*(?:\.\d+)?)(?:\s*(k)\b)?"
+_PRICE_PATTERNS = [
+    ("between", re.compile(r"\bbetween\s+" + _NUMBER + r"\s+(?:and|to|-)\s+" + _NUMBER)),
+    ("between", re.compile(r"(?<![\w.])" + _NUMBER + r"\s*(?:-|to)\s*" + _NUMBER + r"\b")),
+    ("lt", re.compile(
+        r"(?:\bunder|\bbelow|\bless than|\bcheaper than|\bup ?to|\bwithin|\bmax(?:imum)?|"
+        r"\bat most|\bnot more than|<)\s*" + _NUMBER
+    )),
+    ("gt", re.compile(
+        r"(?:\babove|\bover|\bmore than|\bgreater than|\bstarting(?: at| from)?|\bfrom|"
+        r"\bmin(?:imum)?|\bat least|>)\s*" + _NUMBER
+    )),
+]
+
+
+def _to_price(digits, k_suffix):
+    value = float(digits.replace(",", ""))
+    if k_suffix:
+        value *= 1000
+    return int(value)
+
+
+def _singular(word):
+    if word in _PLURAL_ONLY:
+        return word
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith(("sses", "shes", "ches", "xes")):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+def _neckline_key(value):
+    """Collapses "V-neck", "v neck", "V Neck" and "vneck" to the same key."""
+    key = re.sub(r"[\s\-]+", "", value.lower())
+    for suffix in ("neckline", "neck"):
+        if key.endswith(suffix) and key != suffix:
+            key = key[: -len(suffix)]
+            break
+    return key
+
+
+# === Gazetteers ===
+
+def _catalog_values_from_json(path):
+    with open(path, "r", encoding="utf-8") as f:
+        products = json.load(f)
+    return (
+        [p.get("category") for p in products],
+        [p.get("color") for p in products],
+        [p.get("neckline") for p in products],
+        [p.get("gender") for p in products],
+    )
+
+
+def _catalog_values_from_db():
+    from db_utils import get_connection
+
+    values = []
+    with get_connection() as conn, conn.cursor() as cur:
+        for column in ("category", "color", "neckline", "gender"):
+            cur.execute(f"SELECT DISTINCT {column} FROM products WHERE {column} IS NOT NULL")
+            values.append([row[0] for row in cur.fetchall()])
+    return tuple(values)
+
+
+class Gazetteer:
+    """Phrase -> canonical value lookups for category, color, neckline and gender."""
+
+    def __init__(self, categories, colors, necklines, genders):
+        self.categories = {}   # phrase -> set of category values
+        self.colors = {}       # phrase -> color value
+        self.necklines = {}    # neckline key -> list of raw column values
+        self.neckline_patterns = []
+        self.genders = {}
+
+        category_values = {c.strip() for c in categories if c and c.strip()}
+        for category in category_values:
+            phrases = {category.lower(), category.lower().replace("_", " ")}
+            for part in category.lower().split("_"):
+                phrases.update({part, _singular(part)})
+            for phrase in phrases:
+                self.categories.setdefault(phrase, set()).add(category)
+        # An exact category name beats a partial match ("shirts" -> Shirts, not Blouses_Shirts).
+        for category in category_values:
+            for phrase in (category.lower(), _singular(category.lower())):
+                self.categories[phrase] = {category}
+        for phrase, category in CATEGORY_SYNONYMS.items():
+            if category in category_values:
+                self.categories[phrase] = {category}
+
+        for raw in colors:
+            for part in (raw or "").split(","):
+                color = " ".join(part.split()).title()
+                if color:
+                    self.colors.setdefault(color.lower(), color)
+        # A few common spellings the catalog doesn't use.
+        for alias, target in (("gray", "grey"), ("navy", "dark blue"), ("navy blue", "dark blue")):
+            if target in self.colors:
+                self.colors.setdefault(alias, self.colors[target])
+
+        for raw in necklines:
+            value = (raw or "").strip()
+            # Multi-valued cells ("Halter, Tie neck") can't be matched with `=`.
+            if "," in value or "/" in value or value.startswith("["):
+                continue
+            key = _neckline_key(value)
+            if key in _IGNORED_NECKLINES:
+                continue
+            # Keep the raw cell value: that is what the `neckline = ANY(...)` filter compares.
+            self.necklines.setdefault(key, [])
+            if raw not in self.necklines[key]:
+                self.necklines[key].append(raw)
+
+        for key in sorted(self.necklines, key=len, reverse=True):
+            letters = r"[\s\-]?".join(re.escape(ch) for ch in key)
+            # Short keys ("v", "tie", "high") only count when followed by "neck".
+            suffix = r"[\s\-]?neck(?:line)?" if len(key) < 5 else r"(?:[\s\-]?neck(?:line)?)?"
+            pattern = re.compile(r"(?<![a-z])" + letters + suffix + r"(?![a-z])")
+            self.neckline_patterns.append((key, pattern))
+
+        gender_values = {g.strip() for g in genders if g and g.strip()}
+        for word, gender in GENDER_WORDS.items():
+            if gender in gender_values:
+                self.genders[word] = gender
+
+    @classmethod
+    def load(cls, source=GAZETTEER_SOURCE, path=PRODUCTS_JSON):
+        if source == "db":
+            return cls(*_catalog_values_from_db())
+        return cls(*_catalog_values_from_json(path))
+
+
+# === Parser ===
+
+class RuleBasedParser:
+    """
+    Extracts `{"refined_query", "filters"}` from a query without calling the LLM.
+
+    `parse()` also returns a confidence in [0, 1]: the share of meaningful words
+    that were recognised. Queries with words it doesn't understand ("farewell",
+    "sunny day outfit") score low and should go to the LLM instead.
+    """
+
+    def __init__(self, gazetteer=None):
+        self._gazetteer = gazetteer
+        self._lock = threading.Lock()
+
+    @property
+    def gazetteer(self):
+        if self._gazetteer is None:
+            with self._lock:
+                if self._gazetteer is None:
+                    self._gazetteer = Gazetteer.load()
+        return self._gazetteer
+
+    def parse(self, user_query: str):
+        gaz = self.gazetteer
+        text = " " + user_query.lower().strip() + " "
+        filters = {}
+        ambiguous = False
+
+        # --- Prices ---
+        for kind, pattern in _PRICE_PATTERNS:
+            match = pattern.search(text)
+            if not match:
+                continue
+            if kind == "between":
+                if "price_gt" in filters or "price_lt" in filters:
+                    continue
+                low = _to_price(match.group(1), match.group(2))
+                high = _to_price(match.group(3), match.group(4))
+                filters["price_gt"], filters["price_lt"] = min(low, high), max(low, high)
+            elif kind == "lt" and "price_lt" not in filters:
+                filters["price_lt"] = _to_price(match.group(1), match.group(2))
+            elif kind == "gt" and "price_gt" not in filters:
+                filters["price_gt"] = _to_price(match.group(1), match.group(2))
+            else:
+                continue
+            text = text[:match.start()] + " " + text[match.end():]
+
+        # --- Necklines (before tokenising, they often contain hyphens) ---
+        neckline_values = []
+        for key, pattern in gaz.neckline_patterns:
+            match = pattern.search(text)
+            if match:
+                neckline_values.extend(gaz.necklines[key])
+                text = text[:match.start()] + " " + key + "_neckline " + text[match.end():]
+        if neckline_values:
+            filters["neckline"] = neckline_values if len(neckline_values) > 1 else neckline_values[0]
+
+        words = re.findall(r"[a-z0-9_]+(?:['\-][a-z0-9]+)*", text)
+
+        # --- Greedy longest-phrase matching over the remaining words ---
+        kept = []          # words that make up the refined query
+        recognised = 0
+        unknown = 0
+        i = 0
+        while i < len(words):
+            matched = False
+            for size in (3, 2, 1):
+                phrase = " ".join(words[i:i + size])
+                if len(words[i:i + size]) < size:
+                    continue
+                singular = _singular(phrase)
+                if size == 1 and phrase.endswith("_neckline"):
+                    kept.append(phrase.replace("_neckline", " neck"))
+                elif phrase in gaz.colors:
+                    colors = filters.setdefault("color", [])
+                    if gaz.colors[phrase] not in colors:
+                        colors.append(gaz.colors[phrase])
+                    kept.append(phrase)
+                elif singular in gaz.categories or phrase in gaz.categories:
+                    options = gaz.categories.get(singular) or gaz.categories[phrase]
+                    if len(options) > 1:
+                        ambiguous = True
+                    elif "category" in filters and filters["category"] not in options:
+                        ambiguous = True
+                    else:
+                        filters["category"] = next(iter(options))
+                    kept.append(singular)
+                elif phrase in gaz.genders:
+                    # Search has no gender filter; the word stays in the refined
+                    # query so the embedding still carries it.
+                    kept.append(phrase)
+                else:
+                    continue
+                recognised += size
+                i += size
+                matched = True
+                break
+            if matched:
+                continue
+            word = words[i]
+            if word not in STOPWORDS and not word.isdigit():
+                unknown += 1
+                kept.append(word)
+            i += 1
+
+        if "color" in filters and len(filters["color"]) == 1:
+            filters["color"] = filters["color"][0]
+
+        price_words = sum(1 for key in ("price_lt", "price_gt") if key in filters)
+        total = recognised + unknown + price_words
+        confidence = (recognised + price_words) / total if total else 0.0
+        if ambiguous:
+            confidence *= 0.5
+        if not filters:
+            confidence = 0.0
+
+        refined_query = " ".join(kept) or user_query.strip()
+        return {"refined_query": refined_query, "filters": filters}, confidence
+
+
+# --- Example Usage ---
+if __name__ == "__main__":
+    # Reports how the queries in a file (one per line) would be routed.
+    from query_analysis import RULE_CONFIDENCE_THRESHOLD
+
+    parser = RuleBasedParser()
+    queries = (
+        [line.strip() for line in open(sys.argv[1], encoding="utf-8") if line.strip()]
+        if len(sys.argv) > 1
+        else [
+            "show me red dresses under 2000",
+            "black v-neck top above 1500",
+            "i want to buy a coat for my farewell under 4000",
+            "sunny day outfit",
+        ]
+    )
+    fast = 0
+    for query in queries:
+        analysis, confidence = parser.parse(query)
+        route = "rules" if confidence >= RULE_CONFIDENCE_THRESHOLD else "llm"
+        fast += route == "rules"
+        print(f"[{route:5}] {confidence:.2f}  {query!r} -> {json.dumps(analysis)}")
+    print(f"\n{fast}/{len(queries)} queries ({fast / len(queries):.0%}) would skip the LLM.")
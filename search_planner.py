@@ -0,0 +1,326 @@
+import json
+import math
+import os
+import threading
+import time
+from bisect import bisect_right
+
+# === Selectivity-aware planning for filtered vector search ===
+# With an ANN index, `WHERE <filters> ORDER BY embedding <=> q LIMIT k` walks
+# the index and post-filters, so selective filters come back with fewer than k
+# rows. Without one, every query is a full scan. The planner estimates how many
+# rows the filters keep (from per-facet counts and price quantiles) and picks:
+#
+#   seq_scan              no ANN index on the column: the plain query.
+#   index_scan            no filters: the plain query, served by the index.
+#   exact_scan            few matching rows: rank just the filtered subset
+#                         exactly, bypassing the ANN index.
+#   partial_index_scan    a partial index exists for one of the equality
+#                         filters: walk that index, over-fetching as below.
+#   iterative_index_scan  walk the full index for N candidates, filter them,
+#                         and grow N until top_k rows survive.
+
+FACET_COLUMNS = ("category", "color", "neckline")
+EXACT_SCAN_MAX_ROWS = int(os.environ.get("EXACT_SCAN_MAX_ROWS", "5000"))
+OVERFETCH_FACTOR = float(os.environ.get("OVERFETCH_FACTOR", "2.0"))
+OVERFETCH_GROWTH = 4
+# pgvector caps hnsw.ef_search at 1000, so an HNSW scan can't return more.
+MAX_CANDIDATES = int(os.environ.get("MAX_CANDIDATES", "1000"))
+FACET_STATS_TTL = float(os.environ.get("FACET_STATS_TTL", "300"))
+# PLANNER_LOG=1 prints every plan; off by default, /planner-stats has the counts.
+PLANNER_LOG = os.environ.get("PLANNER_LOG", "0") == "1"
+
+_PRICE_QUANTILES = ", ".join(str(i / 100) for i in range(101))
+
+TOTAL_SQL = "SELECT count(*) FROM products"
+PRICE_QUANTILES_SQL = (
+    f"SELECT percentile_disc(ARRAY[{_PRICE_QUANTILES}]) WITHIN GROUP (ORDER BY price) "
+    "FROM products WHERE price IS NOT NULL"
+)
+INDEXES_SQL = """
+    SELECT a.attname, am.amname, i.indpred IS NOT NULL, obj_description(c.oid, 'pg_class')
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    JOIN pg_am am ON am.oid = c.relam
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+    WHERE i.indrelid = 'products'::regclass AND i.indisvalid
+      AND am.amname IN ('hnsw', 'ivfflat')
+"""
+
+
+def _facet_sql(column):
+    return f"SELECT {column}, count(*) FROM products GROUP BY {column}"
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+class SearchPlan:
+    def __init__(self, strategy, column, selectivity, estimated_rows, method=None,
+                 candidates=None, facet=None):
+        self.strategy = strategy
+        self.column = column
+        self.selectivity = selectivity
+        self.estimated_rows = estimated_rows
+        self.method = method          # 'hnsw' / 'ivfflat' for index strategies
+        self.candidates = candidates  # first over-fetch size
+        self.facet = facet            # (column, value) served by a partial index
+
+    def describe(self):
+        parts = [f"strategy={self.strategy}", f"column={self.column}",
+                 f"selectivity={self.selectivity:.4f}", f"est_rows={self.estimated_rows:.0f}"]
+        if self.candidates:
+            parts.append(f"candidates={self.candidates}")
+        if self.facet:
+            parts.append(f"facet={self.facet[0]}={self.facet[1]!r}")
+        return " ".join(parts)
+
+
+class SearchPlanner:
+    """Keeps facet statistics and the list of vector indexes, and plans searches."""
+
+    def __init__(self, ttl=FACET_STATS_TTL):
+        self.ttl = ttl
+        self.total = 0
+        self.facet_counts = {column: {} for column in FACET_COLUMNS}
+        self.price_quantiles = []
+        # column -> {"method": 'hnsw'/'ivfflat' or None, "partial": {(facet, value): method}}
+        self.indexes = {}
+        self.loaded_at = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._strategy_counts = {}
+        self._retries = 0
+
+    # --- Statistics ---
+
+    def _load(self, total, facet_rows, quantiles, index_rows):
+        facet_counts = {
+            column: {value: count for value, count in rows if value is not None}
+            for column, rows in facet_rows.items()
+        }
+        indexes = {}
+        for column, method, is_partial, comment in index_rows:
+            entry = indexes.setdefault(column, {"method": None, "partial": {}})
+            if not is_partial:
+                entry["method"] = method
+                continue
+            # Partial indexes built by `manage_indexes.py --facet` record their facet.
+            try:
+                facet = json.loads(comment or "{}").get("facet")
+            except ValueError:
+                facet = None
+            if facet:
+                entry["partial"][(facet["column"], facet["value"])] = method
+        with self._lock:
+            self.total = total
+            self.facet_counts = facet_counts
+            self.price_quantiles = sorted(q for q in (quantiles or []) if q is not None)
+            self.indexes = indexes
+            self.loaded_at = time.monotonic()
+
+    def is_stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
+
+    def refresh(self):
+        from db_utils import get_connection
+
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute(TOTAL_SQL)
+            total = cur.fetchone()[0]
+            facet_rows = {}
+            for column in FACET_COLUMNS:
+                cur.execute(_facet_sql(column))
+                facet_rows[column] = cur.fetchall()
+            cur.execute(PRICE_QUANTILES_SQL)
+            quantiles = cur.fetchone()[0]
+            cur.execute(INDEXES_SQL)
+            index_rows = cur.fetchall()
+        self._load(total, facet_rows, quantiles, index_rows)
+
+    async def refresh_async(self):
+        from db_utils import async_connection
+
+        async with async_connection() as conn:
+            total = await conn.fetchval(TOTAL_SQL)
+            facet_rows = {}
+            for column in FACET_COLUMNS:
+                facet_rows[column] = [tuple(r) for r in await conn.fetch(_facet_sql(column))]
+            quantiles = await conn.fetchval(PRICE_QUANTILES_SQL)
+            index_rows = [tuple(r) for r in await conn.fetch(INDEXES_SQL)]
+        self._load(total, facet_rows, quantiles, index_rows)
+
+    def ensure_fresh(self):
+        if self.is_stale():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"[planner] Could not load facet statistics: {e}")
+                self.loaded_at = time.monotonic()  # don't retry on every request
+
+    async def ensure_fresh_async(self):
+        if self.is_stale():
+            try:
+                await self.refresh_async()
+            except Exception as e:
+                print(f"[planner] Could not load facet statistics: {e}")
+                self.loaded_at = time.monotonic()
+
+    # --- Estimation ---
+
+    def _price_fraction_at_most(self, price):
+        if not self.price_quantiles:
+            return 1.0
+        return bisect_right(self.price_quantiles, price) / len(self.price_quantiles)
+
+    def facet_fraction(self, column, values):
+        if not self.total:
+            return 1.0
+        count = sum(self.facet_counts[column].get(v, 0) for v in _as_list(values))
+        return min(1.0, count / self.total)
+
+    def selectivity(self, filters):
+        """Estimated fraction of rows kept by the filters (facets assumed independent)."""
+        if not self.total:
+            return 1.0
+        fraction = 1.0
+        for column in FACET_COLUMNS:
+            if column in filters:
+                fraction *= self.facet_fraction(column, filters[column])
+        if "price_lt" in filters or "price_gt" in filters:
+            upper = self._price_fraction_at_most(float(filters["price_lt"]) - 1) if "price_lt" in filters else 1.0
+            lower = self._price_fraction_at_most(float(filters["price_gt"])) if "price_gt" in filters else 0.0
+            fraction *= max(0.0, upper - lower)
+        return fraction
+
+    # --- Planning ---
+
+    def plan(self, filters, top_k, column="embedding"):
+        filters = {k: v for k, v in (filters or {}).items()
+                   if k in FACET_COLUMNS or k in ("price_lt", "price_gt")}
+        selectivity = self.selectivity(filters)
+        estimated_rows = selectivity * self.total
+        index = self.indexes.get(column, {"method": None, "partial": {}})
+
+        if not filters:
+            strategy = "index_scan" if index["method"] else "seq_scan"
+            return SearchPlan(strategy, column, selectivity, estimated_rows, method=index["method"])
+
+        # Small subsets are cheapest (and exact) to rank directly.
+        if estimated_rows <= max(EXACT_SCAN_MAX_ROWS, top_k):
+            return SearchPlan("exact_scan", column, selectivity, estimated_rows)
+
+        for facet_column in FACET_COLUMNS:
+            value = filters.get(facet_column)
+            if isinstance(value, str) and (facet_column, value) in index["partial"]:
+                facet_fraction = self.facet_fraction(facet_column, value) or 1.0
+                residual = selectivity / facet_fraction
+                return SearchPlan(
+                    "partial_index_scan", column, selectivity, estimated_rows,
+                    method=index["partial"][(facet_column, value)],
+                    candidates=self._initial_candidates(top_k, residual),
+                    facet=(facet_column, value),
+                )
+
+        if not index["method"]:
+            return SearchPlan("seq_scan", column, selectivity, estimated_rows)
+
+        return SearchPlan(
+            "iterative_index_scan", column, selectivity, estimated_rows,
+            method=index["method"], candidates=self._initial_candidates(top_k, selectivity),
+        )
+
+    def _initial_candidates(self, top_k, selectivity):
+        wanted = math.ceil(top_k / max(selectivity, 1e-6) * OVERFETCH_FACTOR)
+        return max(top_k * 2, min(wanted, MAX_CANDIDATES))
+
+    # --- Bookkeeping ---
+
+    def record(self, plan, attempts):
+        with self._stats_lock:
+            self._strategy_counts[plan.strategy] = self._strategy_counts.get(plan.strategy, 0) + 1
+            self._retries += max(0, attempts - 1)
+        if PLANNER_LOG:
+            print(f"[planner] {plan.describe()} attempts={attempts}")
+
+    def stats(self):
+        with self._stats_lock:
+            stats = {"strategies": dict(self._strategy_counts), "overfetch_retries": self._retries}
+        stats.update({
+            "total_rows": self.total,
+            "indexes": {
+                column: {"method": entry["method"],
+                         "partial": [f"{c}={v}" for c, v in entry["partial"]]}
+                for column, entry in self.indexes.items()
+            },
+        })
+        return stats
+
+
+def plan_attempts(plan, where_clauses, params, query_embedding, top_k, select_columns,
+                  inner_columns, ef_search=None, operator="<=>", query_sql="%s"):
+    """
+    Yields the SQL to run for a plan as (sql, params, ef_search) tuples.
+
+    Over-fetching plans yield growing candidate counts; the caller stops as
+    soon as an attempt returns `top_k` rows. The last attempt is always an
+    exact scan, so a search never returns short when enough rows match.
+
+    `operator` and `query_sql` spell the distance for columns other than the
+    float32 ones (see vector_storage.ShadowColumn).
+    """
+    column = plan.column
+    where_sql = " AND ".join(where_clauses) or "TRUE"
+    distance = f"{operator} {query_sql}"
+
+    if plan.strategy in ("seq_scan", "index_scan"):
+        sql = f"SELECT {select_columns} FROM products"
+        if where_clauses:
+            sql += f" WHERE {where_sql}"
+        sql += f" ORDER BY {column} {distance} LIMIT %s"
+        yield sql, params + [query_embedding, top_k], ef_search
+        return
+
+    exact_sql = f"""
+        WITH candidates AS MATERIALIZED (
+            SELECT {select_columns}, {column} AS search_vector FROM products WHERE {where_sql}
+        )
+        SELECT {select_columns} FROM candidates ORDER BY search_vector {distance} LIMIT %s
+    """
+    exact = (exact_sql, params + [query_embedding, top_k], ef_search)
+    if plan.strategy == "exact_scan":
+        yield exact
+        return
+
+    facet_sql, facet_params = "", []
+    if plan.facet:
+        facet_sql = f"WHERE {plan.facet[0]} = %s"
+        facet_params = [plan.facet[1]]
+
+    candidates = plan.candidates
+    while True:
+        sql = f"""
+            SELECT {select_columns} FROM (
+                SELECT {inner_columns}, {column} {distance} AS distance
+                FROM products {facet_sql}
+                ORDER BY {column} {distance}
+                LIMIT %s
+            ) candidates
+            WHERE {where_sql}
+            ORDER BY distance
+            LIMIT %s
+        """
+        attempt_ef = ef_search
+        if plan.method == "hnsw":
+            # An HNSW scan returns at most ef_search rows, so widen it to match.
+            attempt_ef = max(ef_search or 0, min(candidates, MAX_CANDIDATES))
+        yield (sql, [query_embedding] + facet_params + [query_embedding, candidates]
+               + params + [top_k], attempt_ef)
+        if candidates >= MAX_CANDIDATES:
+            break
+        candidates = min(candidates * OVERFETCH_GROWTH, MAX_CANDIDATES)
+    yield exact
+
+
+planner = SearchPlanner()
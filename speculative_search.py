@@ -0,0 +1,146 @@
+import asyncio
+import os
+import re
+import threading
+
+from filtered_retrieval import (
+    encode_query_async,
+    find_candidates_async,
+    find_filtered_similar_products_async,
+    matches_filters,
+)
+from query_analysis import analyze_query_async, preview_analysis
+
+# === Speculative retrieval ===
+# The LLM analysis is by far the slowest stage of /search. When a query needs
+# it, the raw query is encoded and searched at the same time, under whatever
+# filters the rule parser could find, for SPECULATIVE_CANDIDATE_FACTOR * top_k
+# candidates. When the analysis arrives:
+#   reused    its refined query is the raw query and its filters include the
+#             speculative ones: the candidates are re-filtered in memory.
+#   refined   otherwise: the refined query is searched as usual.
+#   deadline  the LLM took longer than the deadline: the speculative results
+#             are returned as they are (the analysis still finishes in the
+#             background and lands in the analysis cache).
+# Streaming callers can also be handed the speculative top_k as soon as that
+# search returns, while the analysis is still running (on_candidates).
+# Queries the rule parser handles on its own ("direct") skip all of this.
+
+SPECULATIVE_SEARCH = os.environ.get("SPECULATIVE_SEARCH", "1") != "0"
+SPECULATIVE_CANDIDATE_FACTOR = int(os.environ.get("SPECULATIVE_CANDIDATE_FACTOR", "8"))
+SEARCH_DEADLINE_MS = float(os.environ["SEARCH_DEADLINE_MS"]) if os.environ.get("SEARCH_DEADLINE_MS") else None
+
+_outcome_lock = threading.Lock()
+_outcomes = {"direct": 0, "reused": 0, "refined": 0, "deadline": 0}
+# Analyses still running after a deadline; kept referenced so they can finish.
+_background = set()
+
+
+def _count(outcome):
+    with _outcome_lock:
+        _outcomes[outcome] += 1
+
+
+def speculation_stats():
+    with _outcome_lock:
+        stats = dict(_outcomes)
+    speculated = stats["reused"] + stats["refined"] + stats["deadline"]
+    stats["reuse_rate"] = stats["reused"] / speculated if speculated else 0.0
+    return stats
+
+
+def _same_text(a, b):
+    # The text model is uncased, so only case and spacing are allowed to differ.
+    return re.sub(r"\s+", " ", a).strip().lower() == re.sub(r"\s+", " ", b).strip().lower()
+
+
+def _covers(filters, speculative_filters):
+    """True if every speculative filter also holds under `filters`."""
+    return all(filters.get(key) == value for key, value in speculative_filters.items())
+
+
+def _strip(products):
+    return [{key: p[key] for key in ("id", "summary", "price", "color", "image")} for p in products]
+
+
+async def _speculate(query, filters, limit, ef_search, probes):
+    embedding = await encode_query_async(query)
+    return await find_candidates_async(embedding, filters, limit, ef_search, probes)
+
+
+async def _report_candidates(speculation, top_k, on_candidates):
+    try:
+        candidates = await asyncio.shield(speculation)
+    except (asyncio.CancelledError, Exception):
+        return   # cancelled because the analysis made it moot, or failed (reported elsewhere)
+    await on_candidates(_strip(candidates[:top_k]))
+
+
+async def search_with_speculation(query: str, top_k: int = 5, deadline_ms: float = None,
+                                  ef_search: int = None, probes: int = None, on_analysis=None,
+                                  on_candidates=None):
+    """
+    Returns (analysis, products, outcome); analysis is None when the deadline
+    passed before the LLM answered. `on_analysis`, if given, is awaited with
+    the analysis as soon as it is known, before retrieval finishes.
+    `on_candidates`, if given, is awaited with the speculative results as soon
+    as they are in, unless the analysis has already replaced them.
+    """
+    deadline_ms = deadline_ms if deadline_ms is not None else SEARCH_DEADLINE_MS
+    rule_analysis, rules_suffice = preview_analysis(query)
+    if rules_suffice or not SPECULATIVE_SEARCH:
+        analysis = await analyze_query_async(query)
+        if on_analysis is not None:
+            await on_analysis(analysis)
+        products = await find_filtered_similar_products_async(analysis, top_k, ef_search, probes)
+        _count("direct")
+        return analysis, products, "direct"
+
+    speculative_filters = (rule_analysis or {}).get("filters", {})
+    limit = top_k * SPECULATIVE_CANDIDATE_FACTOR
+    speculation = asyncio.ensure_future(_speculate(query, speculative_filters, limit, ef_search, probes))
+    # Its result may end up unused; don't let an unused failure go unreported.
+    speculation.add_done_callback(lambda task: task.cancelled() or task.exception())
+    analysis_task = asyncio.ensure_future(analyze_query_async(query))
+    if on_candidates is not None:
+        report = asyncio.ensure_future(_report_candidates(speculation, top_k, on_candidates))
+        # Nothing to preview once the analysis is in: the final results follow.
+        analysis_task.add_done_callback(lambda _: speculation.done() or report.cancel())
+
+    done, _ = await asyncio.wait(
+        {analysis_task}, timeout=deadline_ms / 1000 if deadline_ms is not None else None
+    )
+    if not done:
+        _background.add(analysis_task)
+        analysis_task.add_done_callback(_background.discard)
+        try:
+            candidates = await speculation
+        except Exception as e:
+            print(f"Speculative search failed: {e}")
+            candidates = []
+        _count("deadline")
+        return None, _strip(candidates[:top_k]), "deadline"
+
+    analysis = analysis_task.result()
+    if on_analysis is not None:
+        await on_analysis(analysis)
+    filters = analysis.get("filters", {})
+    if _same_text(analysis["refined_query"], query) and _covers(filters, speculative_filters):
+        try:
+            candidates = await speculation
+        except Exception as e:
+            print(f"Speculative search failed: {e}")
+            candidates = []
+        matching = [p for p in candidates if matches_filters(p, filters)]
+        # The candidates are the nearest under the speculative filters only; if
+        # too few survive the full filters, nearer matches may be missing,
+        # unless the candidates already were every row the filters allow.
+        if len(matching) >= top_k or len(candidates) < limit:
+            _count("reused")
+            return analysis, _strip(matching[:top_k]), "reused"
+    else:
+        speculation.cancel()
+
+    products = await find_filtered_similar_products_async(analysis, top_k, ef_search, probes)
+    _count("refined")
+    return analysis, products, "refined"
@@ -0,0 +1,155 @@
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# === Stub Ollama server ===
+# Stands in for Ollama during benchmarks so results don't depend on a GPU, a
+# model download or the network. It answers POST /api/chat with a canned
+# analysis for the query (the last user message) after a configurable delay.
+# Queries without a canned analysis get {"refined_query": <query>, "filters": {}}.
+# Point the app at it with OLLAMA_HOST=http://127.0.0.1:<port>.
+
+STUB_OLLAMA_PORT = 11435
+
+
+class StubOllama:
+    def __init__(self, canned=None, latency_ms=300.0, jitter_ms=0.0, invalid_json_rate=0.0,
+                 host="127.0.0.1", port=STUB_OLLAMA_PORT, seed=0):
+        self.canned = dict(canned or {})
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.invalid_json_rate = invalid_json_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "canned": 0, "uncanned": 0, "invalid_json": 0}
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != "/api/chat":
+                    self.send_error(404)
+                    return
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    request = json.loads(self.rfile.read(length) or b"{}")
+                except json.JSONDecodeError:
+                    self.send_error(400)
+                    return
+                body = json.dumps(stub.reply(request)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                # Ollama answers "Ollama is running" on /; handy for readiness checks.
+                body = json.dumps(stub.stats()).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def reply(self, request):
+        query = ""
+        for message in request.get("messages", []):
+            if message.get("role") == "user":
+                query = message.get("content", "")
+
+        with self._lock:
+            delay = self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)
+            invalid = self._random.random() < self.invalid_json_rate
+            self._stats["requests"] += 1
+        time.sleep(max(delay, 0.0) / 1000)
+
+        analysis = self.canned.get(query)
+        with self._lock:
+            if invalid:
+                self._stats["invalid_json"] += 1
+            elif analysis is not None:
+                self._stats["canned"] += 1
+            else:
+                self._stats["uncanned"] += 1
+        if invalid:
+            content = "Sure! Here is the JSON you asked for:"
+        else:
+            content = json.dumps(analysis or {"refined_query": query, "filters": {}})
+        return {
+            "model": request.get("model", "stub"),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+        }
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        """Serves from a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread = None
+        self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve canned query analyses in place of Ollama.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=STUB_OLLAMA_PORT)
+    parser.add_argument("--latency-ms", type=float, default=300.0,
+                        help="Delay before each answer, like a real LLM call.")
+    parser.add_argument("--jitter-ms", type=float, default=0.0,
+                        help="Delays are drawn uniformly from latency +/- jitter.")
+    parser.add_argument("--invalid-json-rate", type=float, default=0.0,
+                        help="Share of answers that aren't JSON (exercises the fallback).")
+    parser.add_argument("--canned", default=None,
+                        help='JSON file mapping query -> {"refined_query", "filters"}.')
+    args = parser.parse_args()
+
+    canned = {}
+    if args.canned:
+        with open(args.canned, "r", encoding="utf-8") as f:
+            canned = json.load(f)
+    stub = StubOllama(canned, args.latency_ms, args.jitter_ms, args.invalid_json_rate,
+                      args.host, args.port)
+    print(f"Stub Ollama listening on {stub.url} ({len(canned)} canned analyses, "
+          f"{args.latency_ms:.0f} ms latency).")
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+from analysis_cache import normalize_query
+
+
+def test_comparison_direction_is_part_of_the_key():
+    assert normalize_query("dress < 2000") != normalize_query("dress > 2000")
+
+
+def test_comparison_operators_match_their_words():
+    assert normalize_query("Red dresses < ₹2000") == normalize_query("red dress under 2000")
+    assert normalize_query("kurtas >= 500") == normalize_query("kurta over 500")
+
+
+def test_non_latin_queries_get_their_own_keys():
+    keys = {normalize_query(q) for q in ["लाल साड़ी", "नीली साड़ी", "红色连衣裙", "黑色裙子", "???", "!!"]}
+    assert len(keys) == 6
+    assert "" not in keys
+    assert normalize_query("लाल  साड़ी ") == "लाल साड़ी"
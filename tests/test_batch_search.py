@@ -0,0 +1,21 @@
+import asyncio
+
+import filtered_retrieval
+from filtered_retrieval import build_filter_clauses, find_filtered_similar_products_batch_async
+
+
+def test_bad_refined_queries_fail_per_item():
+    analyses = [{"refined_query": None}, {"refined_query": 5}, {"refined_query": "  "}, {}]
+    results = asyncio.run(find_filtered_similar_products_batch_async(analyses))
+
+    assert len(results) == 4
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+def test_clip_only_mode_skips_rows_without_a_search_vector(monkeypatch):
+    monkeypatch.setattr(filtered_retrieval, "SKIP_NULL_SEARCH_VECTORS", True)
+    monkeypatch.setattr(filtered_retrieval, "TEXT_SEARCH_COLUMN", "image_embedding")
+    where_clauses, params = build_filter_clauses({"color": "Red"})
+
+    assert where_clauses == ["color = %s", "image_embedding IS NOT NULL"]
+    assert params == ["Red"]
@@ -0,0 +1,21 @@
+import asyncio
+
+from embedding_client import EmbeddingClient
+
+
+def test_losing_the_server_triggers_fallback_once(tmp_path):
+    calls = []
+    client = EmbeddingClient(str(tmp_path / "missing.sock"), timeout=0.5, retry_after=60)
+    client.on_fallback = lambda: calls.append("fallback")
+
+    async def run():
+        assert await client.ping() is None
+        assert await client.ping() is None
+
+        async def local(items):
+            return ["local"] * len(items)
+        return await client.encode_many("text", ["red dress"], local)
+
+    assert asyncio.run(run()) == ["local"]
+    assert calls == ["fallback"]
+    assert client.stats()["in_fallback"]
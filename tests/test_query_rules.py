@@ -0,0 +1,10 @@
+from query_rules import Gazetteer, RuleBasedParser
+
+GAZETTEER = Gazetteer(["Dresses", "Shorts"], ["Red", "Black"], ["V-Neck"], ["Men", "Women"])
+
+
+def test_gender_words_do_not_become_filters():
+    analysis, confidence = RuleBasedParser(GAZETTEER).parse("red dresses for women under 2000")
+    assert analysis["filters"] == {"category": "Dresses", "color": "Red", "price_lt": 2000}
+    assert "women" in analysis["refined_query"]
+    assert confidence == 1.0
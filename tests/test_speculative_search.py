@@ -0,0 +1,57 @@
+import asyncio
+
+import speculative_search
+
+PRODUCT = {"id": "p1", "summary": "red dress", "price": 900, "color": "Red", "image": None,
+           "category": "Dresses", "neckline": "Round"}
+
+
+def _patch(monkeypatch, llm_seconds, log):
+    async def analyze(query):
+        await asyncio.sleep(llm_seconds)
+        log.append("analysis done")
+        return {"refined_query": "crimson gown", "filters": {}}
+
+    async def speculate(query, filters, limit, ef_search, probes):
+        return [PRODUCT]
+
+    async def search(analysis, top_k, ef_search, probes):
+        return [dict(PRODUCT, id="p2")]
+
+    monkeypatch.setattr(speculative_search, "preview_analysis", lambda q: (None, False))
+    monkeypatch.setattr(speculative_search, "analyze_query_async", analyze)
+    monkeypatch.setattr(speculative_search, "_speculate", speculate)
+    monkeypatch.setattr(speculative_search, "find_filtered_similar_products_async", search)
+
+
+def _run(**kwargs):
+    return asyncio.run(speculative_search.search_with_speculation("red dress", **kwargs))
+
+
+def test_candidates_are_reported_before_the_analysis_finishes(monkeypatch):
+    log = []
+    _patch(monkeypatch, 0.05, log)
+
+    async def on_candidates(products):
+        log.append(("candidates", [p["id"] for p in products]))
+
+    _, products, outcome = _run(on_candidates=on_candidates)
+    assert log == [("candidates", ["p1"]), "analysis done"]
+    assert outcome == "refined" and products[0]["id"] == "p2"
+
+
+def test_no_preview_once_the_analysis_is_in(monkeypatch):
+    log = []
+    _patch(monkeypatch, 0, log)
+
+    async def slow_speculate(query, filters, limit, ef_search, probes):
+        await asyncio.sleep(0.05)
+        return [PRODUCT]
+
+    monkeypatch.setattr(speculative_search, "_speculate", slow_speculate)
+
+    async def on_candidates(products):
+        log.append("candidates")
+
+    _run(on_candidates=on_candidates)
+    assert log == ["analysis done"]
@@ -0,0 +1,34 @@
+import os
+import time
+
+from upload_store import UploadStore
+
+
+def _age(path, seconds):
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_sweep_keeps_files_the_store_did_not_create(tmp_path):
+    fixture = tmp_path / "01c4512d2995484b9df9e8890f33f444.jpg"
+    fixture.write_bytes(b"committed fixture")
+    _age(fixture, 3600)
+
+    store = UploadStore(str(tmp_path), max_age=60, max_bytes=1)
+    stored = store.save(b"uploaded photo", "jpg")
+    _age(stored, 3600)
+    store.sweep()
+
+    assert fixture.exists()
+    assert not os.path.exists(stored)
+    assert store.stats()["files"] == 0
+
+
+def test_byte_budget_ignores_foreign_files(tmp_path):
+    (tmp_path / "fixture.jpg").write_bytes(b"x" * 1000)
+    store = UploadStore(str(tmp_path), max_age=3600, max_bytes=100)
+    stored = store.save(b"small", "png")
+    store.sweep()
+
+    assert os.path.exists(stored)
+    assert store.stats()["bytes"] == len(b"small")
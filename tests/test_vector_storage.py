@@ -0,0 +1,29 @@
+import numpy as np
+
+from vector_storage import (ShadowColumn, _compact_matrix, _offline_search, candidate_sql,
+                            rerank_sql)
+
+
+def test_rerank_orders_a_derived_table_of_candidates():
+    shadow = ShadowColumn("embedding", "binary")
+    sql = rerank_sql(candidate_sql(shadow, "id"), "id", "embedding")
+
+    assert "WHERE id IN" not in sql
+    assert "SELECT id, embedding FROM products" in sql
+    assert ") c" in sql and "ORDER BY c.embedding <=> %s" in sql
+    # where-less candidate pass: query, limit, then query, top_k
+    assert sql.count("%s") == 4
+
+
+def test_offline_rerank_returns_exact_order_when_all_rows_are_candidates():
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((50, 16)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    rows = np.arange(1, 50)
+    query = matrix[0]
+
+    exact = _offline_search(matrix, None, "exact", query, rows, 5)
+    for mode in ("half", "binary"):
+        # RERANK_CANDIDATES (100) covers all 49 rows, so the re-rank sees every row.
+        found = _offline_search(matrix, _compact_matrix(matrix, mode), mode, query, rows, 5)
+        assert found.tolist() == exact.tolist()
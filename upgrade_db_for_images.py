@@ -17,7 +17,13 @@ try:
     # We are adding a new column to our existing table to store image vectors.
     # We use 'ADD COLUMN IF NOT EXISTS' to make the script safe to re-run.
     # The vector dimension is 512, which is the standard for the CLIP model we'll use.
-    alter_command = "ALTER TABLE products ADD COLUMN IF NOT EXISTS image_embedding vector(512);"
+    # The hash columns let the population scripts skip products whose text or
+    # image hasn't changed since they were last embedded.
+    alter_command = """
+        ALTER TABLE products ADD COLUMN IF NOT EXISTS image_embedding vector(512);
+        ALTER TABLE products ADD COLUMN IF NOT EXISTS text_hash TEXT;
+        ALTER TABLE products ADD COLUMN IF NOT EXISTS image_hash TEXT;
+    """
     
     print("Upgrading 'products' table with 'image_embedding' column...")
     cur.execute(alter_command)
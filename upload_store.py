@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+
+# === Upload Store ===
+# Uploads are kept under their content hash (static/uploads/ab/abcdef....jpg),
+# so the same photo uploaded twice is stored once. A janitor sweeps the store
+# every UPLOAD_JANITOR_INTERVAL seconds: files unused for UPLOAD_MAX_AGE
+# seconds are deleted, then the least recently used files go until the store
+# fits in UPLOAD_MAX_BYTES. A file's mtime is its last use; storing a
+# duplicate refreshes it.
+#
+# The store only ever manages files it wrote: content-addressed names in their
+# two-character shard directories. Anything else in the directory (older
+# uploads, committed fixtures) is never counted or deleted.
+
+UPLOAD_MAX_AGE = float(os.environ.get("UPLOAD_MAX_AGE", str(7 * 24 * 3600)))
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(1024 * 1024 * 1024)))
+UPLOAD_JANITOR_INTERVAL = float(os.environ.get("UPLOAD_JANITOR_INTERVAL", "300"))
+
+_STORED_NAME = re.compile(r"([0-9a-f]{64})\.[A-Za-z0-9]+")
+
+
+class UploadStore:
+    def __init__(self, directory, max_age=UPLOAD_MAX_AGE, max_bytes=UPLOAD_MAX_BYTES,
+                 janitor_interval=UPLOAD_JANITOR_INTERVAL):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.janitor_interval = janitor_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._files = {}   # path -> (size, last_used)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._janitor = None
+        self._stats = {
+            "stored": 0,
+            "duplicates": 0,
+            "expired": 0,
+            "evicted": 0,
+            "sweeps": 0,
+            "last_sweep_seconds": None,
+        }
+        self._scan()
+
+    # --- Index ---
+
+    @staticmethod
+    def _is_stored(shard, name):
+        match = _STORED_NAME.fullmatch(name)
+        return match is not None and match.group(1)[:2] == shard
+
+    def _scan(self):
+        files = {}
+        for shard in os.listdir(self.directory):
+            shard_dir = os.path.join(self.directory, shard)
+            if len(shard) != 2 or not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                if not self._is_stored(shard, name):
+                    continue
+                path = os.path.join(shard_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (st.st_size, st.st_mtime)
+        with self._lock:
+            self._files = files
+            self._bytes = sum(size for size, _ in files.values())
+
+    def path_for(self, digest, ext):
+        return os.path.join(self.directory, digest[:2], f"{digest}.{ext}")
+
+    # --- Public API ---
+
+    def save(self, data, ext):
+        """Stores `data` under its content hash and returns the path."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest, ext)
+        now = time.time()
+        with self._lock:
+            known = path in self._files
+        if known and os.path.exists(path):
+            os.utime(path, (now, now))
+            with self._lock:
+                self._files[path] = (len(data), now)
+                self._stats["duplicates"] += 1
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            old = self._files.get(path)
+            if old is not None:
+                self._bytes -= old[0]
+            self._files[path] = (len(data), now)
+            self._bytes += len(data)
+            self._stats["stored"] += 1
+        return path
+
+    def sweep(self):
+        """Deletes expired files, then least recently used ones until under the byte budget."""
+        start = time.perf_counter()
+        self._scan()
+        cutoff = time.time() - self.max_age
+        with self._lock:
+            by_age = sorted(self._files.items(), key=lambda item: item[1][1])
+            expired = [path for path, (_, used) in by_age if used < cutoff]
+            remaining = self._bytes - sum(self._files[path][0] for path in expired)
+            evicted = []
+            for path, (size, used) in by_age[len(expired):]:
+                if remaining <= self.max_bytes:
+                    break
+                evicted.append(path)
+                remaining -= size
+
+        for path in expired + evicted:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"[uploads] Could not delete {path}: {e}")
+                continue
+            with self._lock:
+                size, _ = self._files.pop(path, (0, 0))
+                self._bytes -= size
+
+        with self._lock:
+            self._stats["expired"] += len(expired)
+            self._stats["evicted"] += len(evicted)
+            self._stats["sweeps"] += 1
+            self._stats["last_sweep_seconds"] = round(time.perf_counter() - start, 3)
+        if expired or evicted:
+            print(f"[uploads] Janitor removed {len(expired)} expired and {len(evicted)} "
+                  f"least recently used files")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({"files": len(self._files), "bytes": self._bytes,
+                          "max_bytes": self.max_bytes, "max_age_seconds": self.max_age})
+        return stats
+
+    # --- Janitor ---
+
+    async def _run_janitor(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.sweep)
+            except Exception as e:
+                print(f"[uploads] Janitor sweep failed: {e}")
+            await asyncio.sleep(self.janitor_interval)
+
+    def start_janitor(self):
+        if self._janitor is None:
+            self._janitor = asyncio.get_running_loop().create_task(self._run_janitor())
+
+    async def stop_janitor(self):
+        if self._janitor is not None:
+            self._janitor.cancel()
+            try:
+                await self._janitor
+            except asyncio.CancelledError:
+                pass
+            self._janitor = None
@@ -0,0 +1,463 @@
+import argparse
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+# === Compact vector storage ===
+# Optional shadow copies of the vector columns in a smaller format, each with
+# its own ANN index, used for a cheap candidate pass:
+#
+#   mode     shadow column       type            bytes/row (384-d)   opclass
+#   (full)   embedding           vector(384)     1544                vector_cosine_ops
+#   half     embedding_half      halfvec(384)    776                 halfvec_cosine_ops
+#   binary   embedding_bin       bit(384)        56                  bit_hamming_ops
+#
+# With VECTOR_STORAGE=half|binary the searches walk the shadow index for
+# RERANK_CANDIDATES rows, then re-rank just those against the full float32
+# vectors. Results are still ordered by exact cosine distance; only which rows
+# make it into the candidate set depends on the compact index. The index that
+# has to stay in shared_buffers shrinks 2x (half) or ~30x (binary), while the
+# full vectors are only read for the few re-ranked rows.
+#
+# The shadow columns are generated from the full ones, so every writer
+# (ingestion, the population scripts, insert_product.py) keeps them in sync as
+# is. Adding one rewrites the table under an exclusive lock: do it off-peak.
+#
+#   python vector_storage.py add --mode half                  # columns + HNSW indexes
+#   python vector_storage.py add --mode binary --column image_embedding
+#   python vector_storage.py recall --k 10 --queries 200      # recall@k and latency per mode
+#   python vector_storage.py recall --offline                 # same, on the NumPy store
+#   python vector_storage.py status
+#   python vector_storage.py drop --mode binary
+#
+# Shadow columns can also be indexed by hand, e.g.
+#   python manage_indexes.py rebuild --column embedding_half --method hnsw --m 32
+
+VECTOR_STORAGE = os.environ.get("VECTOR_STORAGE", "full")   # full | half | binary
+# Rows fetched by the candidate pass; capped like the planner's over-fetch, since
+# an HNSW scan returns at most hnsw.ef_search (<= 1000) rows.
+RERANK_CANDIDATES = min(int(os.environ.get("RERANK_CANDIDATES", "100")), 1000)
+
+TABLE = "products"
+DIMENSIONS = {"embedding": 384, "image_embedding": 512}
+STORAGE_MODES = ("half", "binary")
+
+
+class ShadowColumn:
+    """The compact copy of one vector column in one storage mode."""
+
+    def __init__(self, column, mode):
+        if mode not in STORAGE_MODES:
+            raise ValueError(f"unknown storage mode {mode!r} (expected one of {STORAGE_MODES})")
+        self.column = column
+        self.mode = mode
+        self.dimensions = DIMENSIONS[column]
+        self.name = f"{column}_half" if mode == "half" else f"{column}_bin"
+
+    @property
+    def sql_type(self):
+        return f"halfvec({self.dimensions})" if self.mode == "half" else f"bit({self.dimensions})"
+
+    @property
+    def opclass(self):
+        return "halfvec_cosine_ops" if self.mode == "half" else "bit_hamming_ops"
+
+    @property
+    def operator(self):
+        # Cosine distance on halfvec; Hamming distance between sign bits.
+        return "<=>" if self.mode == "half" else "<~>"
+
+    def expression(self, value_sql):
+        """SQL converting a full-precision vector expression to this column's type."""
+        if self.mode == "half":
+            return f"({value_sql})::{self.sql_type}"
+        return f"binary_quantize({value_sql})::{self.sql_type}"
+
+    @property
+    def query_sql(self):
+        # The query travels as a plain vector (the type every driver already
+        # encodes) and is converted server-side.
+        return self.expression(f"%s::vector({self.dimensions})")
+
+
+def shadow_column(column, mode=VECTOR_STORAGE):
+    """The ShadowColumn that searches on `column` use, or None for full-precision search."""
+    if mode == "full":
+        return None
+    return ShadowColumn(column, mode)
+
+
+def shadow_columns():
+    return [ShadowColumn(column, mode) for column in DIMENSIONS for mode in STORAGE_MODES]
+
+
+def rerank_count(top_k):
+    return max(RERANK_CANDIDATES, top_k)
+
+
+def candidate_sql(shadow, select_columns, where_sql="TRUE"):
+    """
+    The rows nearest the query by the compact column, with `select_columns`
+    and the full vector. Params: where..., query, limit.
+    """
+    return (
+        f"SELECT {select_columns}, {shadow.column} FROM {TABLE} WHERE {where_sql} "
+        f"ORDER BY {shadow.name} {shadow.operator} {shadow.query_sql} LIMIT %s"
+    )
+
+
+def rerank_sql(candidates_sql, select_columns, column):
+    """
+    Orders the rows of `candidates_sql` (which must select the full `column`)
+    by exact cosine distance. Params: the candidate params, then the query
+    and top_k.
+
+    The candidates are a derived table with its own LIMIT, so Postgres has to
+    run the compact pass first; it can't answer the outer ORDER BY from the
+    float32 index and skip it.
+    """
+    return f"""
+        SELECT {select_columns} FROM ({candidates_sql}) c
+        ORDER BY c.{column} <=> %s
+        LIMIT %s
+    """
+
+
+# === Schema ===
+
+def _existing_columns(cur):
+    cur.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = %s", (TABLE,)
+    )
+    return {row[0] for row in cur.fetchall()}
+
+
+def add_shadow(cur, shadow, args):
+    from manage_indexes import build_index
+
+    print(f"Adding {shadow.name} {shadow.sql_type} (rewrites {TABLE})...")
+    start = time.perf_counter()
+    cur.execute(
+        f"ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS {shadow.name} {shadow.sql_type} "
+        f"GENERATED ALWAYS AS ({shadow.expression(shadow.column)}) STORED"
+    )
+    print(f"  ✅ {shadow.name} added in {time.perf_counter() - start:.1f}s")
+    if args.method != "none":
+        build_index(cur, shadow.name, args)
+
+
+def drop_shadow(cur, shadow):
+    # Dropping the column drops its indexes with it.
+    cur.execute(f"ALTER TABLE {TABLE} DROP COLUMN IF EXISTS {shadow.name}")
+    print(f"  🗑️ Dropped {shadow.name}")
+
+
+def _index_sizes(cur):
+    """column -> [(index name, bytes)] for the ANN indexes on the table."""
+    cur.execute(
+        """
+        SELECT a.attname, c.relname, pg_relation_size(c.oid)
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_am am ON am.oid = c.relam
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+        WHERE i.indrelid = %s::regclass AND am.amname IN ('hnsw', 'ivfflat')
+        """,
+        (TABLE,),
+    )
+    sizes = {}
+    for column, name, size in cur.fetchall():
+        sizes.setdefault(column, []).append((name, size))
+    return sizes
+
+
+def show_status(cur):
+    existing = _existing_columns(cur)
+    indexes = _index_sizes(cur)
+    print(f"VECTOR_STORAGE={VECTOR_STORAGE} RERANK_CANDIDATES={RERANK_CANDIDATES}")
+    print(f"{'column':<24}{'type':<16}{'avg bytes':>10}{'index MB':>10}  indexes")
+    for column in DIMENSIONS:
+        rows = [(column, f"vector({DIMENSIONS[column]})")]
+        rows += [(s.name, s.sql_type) for s in shadow_columns() if s.column == column]
+        for name, sql_type in rows:
+            if name not in existing:
+                continue
+            cur.execute(f"SELECT avg(pg_column_size({name})) FROM {TABLE}")
+            avg_bytes = cur.fetchone()[0] or 0
+            column_indexes = indexes.get(name, [])
+            index_mb = sum(size for _, size in column_indexes) / 2**20
+            print(f"{name:<24}{sql_type:<16}{float(avg_bytes):>10.0f}{index_mb:>10.1f}  "
+                  f"{', '.join(index for index, _ in column_indexes) or '-'}")
+
+
+# === Recall Report ===
+# Each query runs unfiltered top-k searches in every mode: "exact" (index
+# scans disabled: the ground truth), "full" (the float32 ANN index, today's
+# path) and each compact mode whose shadow column exists (candidate pass plus
+# re-rank, the SQL the API runs). Queries are sampled catalog vectors with the
+# product itself excluded; --text-queries N adds N encoded benchmark queries
+# for the text column.
+
+def _sample_queries(cur, column, count, seed):
+    cur.execute(f"SELECT id FROM {TABLE} WHERE {column} IS NOT NULL ORDER BY id")
+    ids = [row[0] for row in cur.fetchall()]
+    ids = random.Random(seed).sample(ids, min(count, len(ids)))
+    cur.execute(f"SELECT id, {column} FROM {TABLE} WHERE id = ANY(%s)", (ids,))
+    return [(product_id, np.asarray(vector, dtype=np.float32)) for product_id, vector in cur.fetchall()]
+
+
+def _text_queries(count, seed, products_json):
+    from benchmark import build_query_mix
+    from ingestion import iter_json_array
+    from model_registry import QUERY_MODEL, models
+
+    mix = build_query_mix(list(iter_json_array(products_json)), count, seed)
+    texts = [analysis["refined_query"] for _, analysis in mix]
+    vectors = models.get(QUERY_MODEL).encode(texts, batch_size=64)
+    return [(None, np.asarray(vector, dtype=np.float32)) for vector in vectors]
+
+
+def _run(cur, sql, params, settings):
+    for name, value in settings:
+        cur.execute("SELECT set_config(%s, %s, true)", (name, value))
+    start = time.perf_counter()
+    cur.execute(sql, params)
+    ids = [row[0] for row in cur.fetchall()]
+    elapsed = time.perf_counter() - start
+    cur.connection.rollback()   # ends the transaction, and with it the local settings
+    return ids, elapsed
+
+
+def _mode_query(column, mode, exclude_id, vector, k, ef_search):
+    """(sql, params, settings) for one unfiltered top-k search in `mode`."""
+    where_sql = "id IS DISTINCT FROM %s"
+    if mode in ("exact", "full"):
+        sql = f"SELECT id FROM {TABLE} WHERE {where_sql} ORDER BY {column} <=> %s LIMIT %s"
+        settings = [("enable_indexscan", "off")] if mode == "exact" else []
+        if mode == "full" and ef_search:
+            settings.append(("hnsw.ef_search", str(ef_search)))
+        return sql, (exclude_id, vector, k), settings
+    shadow = ShadowColumn(column, mode)
+    n = rerank_count(k)
+    sql = rerank_sql(candidate_sql(shadow, "id", where_sql), "id", column)
+    settings = [("hnsw.ef_search", str(max(ef_search or 0, n)))]
+    return sql, (exclude_id, vector, n, vector, k), settings
+
+
+def recall_report(cur, queries_by_column, k, ef_search):
+    existing = _existing_columns(cur)
+    indexes = _index_sizes(cur)
+    results = []
+    for column, queries in queries_by_column.items():
+        modes = ["exact", "full"] + [m for m in STORAGE_MODES if ShadowColumn(column, m).name in existing]
+        latencies = {mode: [] for mode in modes}
+        recalls = {mode: [] for mode in modes}
+        for exclude_id, vector in queries:
+            truth = None
+            for mode in modes:
+                sql, params, settings = _mode_query(column, mode, exclude_id, vector, k, ef_search)
+                ids, elapsed = _run(cur, sql, params, settings)
+                if truth is None:
+                    truth = set(ids)
+                latencies[mode].append(elapsed * 1000)
+                recalls[mode].append(len(truth & set(ids)) / len(truth) if truth else 1.0)
+        for mode in modes:
+            index_column = column if mode in ("exact", "full") else ShadowColumn(column, mode).name
+            results.append({
+                "column": column,
+                "mode": mode,
+                "queries": len(queries),
+                f"recall_at_{k}": round(float(np.mean(recalls[mode])), 4) if queries else None,
+                "latency_ms": {
+                    "p50": round(float(np.percentile(latencies[mode], 50)), 2),
+                    "p95": round(float(np.percentile(latencies[mode], 95)), 2),
+                    "mean": round(float(np.mean(latencies[mode])), 2),
+                } if queries else {},
+                "index_mb": None if mode == "exact" else round(
+                    sum(size for _, size in indexes.get(index_column, [])) / 2**20, 2),
+            })
+    return results
+
+
+# --- Offline recall ---
+# Without a database, `recall --offline` runs the same comparison on the
+# exported NumPy store (numpy_backend.py): exact float32 top-k as the ground
+# truth, and for each mode a brute-force candidate pass over a float16 copy or
+# the sign bits (what halfvec / binary_quantize store) followed by the float32
+# re-rank. There is no ANN index here, so it measures the quantization loss of
+# the candidate pass alone; "index MB" is the size of the compact copy.
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _compact_matrix(matrix, mode):
+    if mode == "half":
+        return matrix.astype(np.float16)
+    return np.packbits(matrix > 0, axis=1)
+
+
+def _nearest(distances, rows, n):
+    n = min(n, rows.size)
+    best = np.argpartition(distances, n - 1)[:n]
+    return rows[best[np.argsort(distances[best], kind="stable")]]
+
+
+def _offline_search(matrix, compact, mode, query, rows, k):
+    """Row numbers of the top `k` of `rows` for `query` in `mode`, best first."""
+    if mode in ("exact", "full"):
+        return _nearest(-(matrix[rows] @ query), rows, k)
+    if mode == "half":
+        distances = -(compact[rows] @ query.astype(np.float16)).astype(np.float32)
+    else:
+        bits = np.packbits(query > 0)
+        distances = _POPCOUNT[compact[rows] ^ bits].sum(axis=1, dtype=np.int32)
+    candidates = _nearest(distances, rows, rerank_count(k))
+    return _nearest(-(matrix[candidates] @ query), candidates, k)
+
+
+def offline_recall_report(store, columns, count, k, seed):
+    from numpy_backend import _normalize
+
+    matrices = {"embedding": (store.text, store.has_text),
+                "image_embedding": (store.image, store.has_image)}
+    results = []
+    for column in columns:
+        matrix, present = matrices[column]
+        matrix = np.asarray(matrix, dtype=np.float32)
+        searchable = np.flatnonzero(present)
+        sample = random.Random(seed).sample(list(searchable), min(count, searchable.size))
+        modes = ["exact"] + list(STORAGE_MODES)
+        compact = {mode: _compact_matrix(matrix, mode) for mode in STORAGE_MODES}
+        latencies = {mode: [] for mode in modes}
+        recalls = {mode: [] for mode in modes}
+        for row in sample:
+            query = _normalize(matrix[row])
+            rows = searchable[searchable != row]
+            truth = None
+            for mode in modes:
+                start = time.perf_counter()
+                found = _offline_search(matrix, compact.get(mode), mode, query, rows, k)
+                latencies[mode].append((time.perf_counter() - start) * 1000)
+                if truth is None:
+                    truth = set(found.tolist())
+                recalls[mode].append(len(truth & set(found.tolist())) / len(truth) if truth else 1.0)
+        for mode in modes:
+            results.append({
+                "column": column,
+                "mode": mode,
+                "queries": len(sample),
+                f"recall_at_{k}": round(float(np.mean(recalls[mode])), 4) if sample else None,
+                "latency_ms": {
+                    "p50": round(float(np.percentile(latencies[mode], 50)), 2),
+                    "p95": round(float(np.percentile(latencies[mode], 95)), 2),
+                    "mean": round(float(np.mean(latencies[mode])), 2),
+                } if sample else {},
+                "index_mb": None if mode == "exact" else round(compact[mode].nbytes / 2**20, 2),
+            })
+    return results
+
+
+def print_report(results, k):
+    print(f"\n{'column':<18}{'mode':<8}{'queries':>8}{f'recall@{k}':>11}{'p50 ms':>9}"
+          f"{'p95 ms':>9}{'index MB':>10}")
+    for r in results:
+        lat = r["latency_ms"]
+        index_mb = "-" if r["index_mb"] is None else f"{r['index_mb']:.1f}"
+        recall = r[f"recall_at_{k}"]
+        print(f"{r['column']:<18}{r['mode']:<8}{r['queries']:>8}"
+              f"{recall if recall is not None else float('nan'):>11.3f}"
+              f"{lat.get('p50', float('nan')):>9.2f}{lat.get('p95', float('nan')):>9.2f}"
+              f"{index_mb:>10}")
+
+
+def _write_report(args, results, offline):
+    if not args.output:
+        return
+    with open(args.output, "w") as f:
+        json.dump({"k": args.k, "rerank_candidates": RERANK_CANDIDATES, "offline": offline,
+                   "results": results}, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage compact shadow vector columns.")
+    parser.add_argument("command", choices=["add", "drop", "status", "recall"])
+    parser.add_argument("--mode", choices=list(STORAGE_MODES) + ["all"], default="all")
+    parser.add_argument("--column", choices=list(DIMENSIONS) + ["all"], default="all")
+    parser.add_argument("--method", choices=["hnsw", "ivfflat", "none"], default="hnsw",
+                        help="add: index to build on the shadow column.")
+    parser.add_argument("--m", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=64)
+    parser.add_argument("--lists", type=int, default=None)
+    parser.add_argument("--k", type=int, default=10, help="recall: results per query.")
+    parser.add_argument("--queries", type=int, default=200, help="recall: sampled catalog vectors.")
+    parser.add_argument("--text-queries", type=int, default=0,
+                        help="recall: also encode this many benchmark queries for the text column.")
+    parser.add_argument("--ef-search", type=int, default=None,
+                        help="recall: hnsw.ef_search for the full-precision index.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--products-json", default=os.environ.get("PRODUCTS_JSON", "products.json"))
+    parser.add_argument("--output", default=None, help="recall: also write the results as JSON.")
+    parser.add_argument("--offline", action="store_true",
+                        help="recall: measure on the exported NumPy store instead of Postgres.")
+    parser.add_argument("--vector-store", default=None,
+                        help="recall --offline: store directory (default VECTOR_STORE_DIR).")
+    args = parser.parse_args()
+    args.facet = None   # manage_indexes.build_index option; shadow indexes are never partial
+
+    columns = list(DIMENSIONS) if args.column == "all" else [args.column]
+    modes = list(STORAGE_MODES) if args.mode == "all" else [args.mode]
+
+    if args.command == "recall" and args.offline:
+        from numpy_backend import VECTOR_STORE_DIR, VectorStore
+
+        store = VectorStore(args.vector_store or VECTOR_STORE_DIR)
+        results = offline_recall_report(store, columns, args.queries, args.k, args.seed)
+        print_report(results, args.k)
+        _write_report(args, results, offline=True)
+        return
+
+    from db_utils import connect
+
+    try:
+        conn = connect()
+        cur = conn.cursor()
+
+        if args.command == "status":
+            show_status(cur)
+        elif args.command == "recall":
+            queries = {column: _sample_queries(cur, column, args.queries, args.seed)
+                       for column in columns}
+            if args.text_queries:
+                from model_registry import QUERY_MODEL
+                text_column = "image_embedding" if QUERY_MODEL == "clip_text" else "embedding"
+                queries.setdefault(text_column, [])
+                queries[text_column] += _text_queries(args.text_queries, args.seed,
+                                                      args.products_json)
+            conn.rollback()
+            results = recall_report(cur, queries, args.k, args.ef_search)
+            print_report(results, args.k)
+            _write_report(args, results, offline=False)
+        else:
+            # CREATE INDEX CONCURRENTLY (used by add) cannot run inside a transaction block.
+            conn.autocommit = True
+            for column in columns:
+                for mode in modes:
+                    shadow = ShadowColumn(column, mode)
+                    if args.command == "add":
+                        add_shadow(cur, shadow, args)
+                    else:
+                        drop_shadow(cur, shadow)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        if 'cur' in locals(): cur.close()
+        if 'conn' in locals(): conn.close()
+
+
+if __name__ == "__main__":
+    main()